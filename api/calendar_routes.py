@@ -1,16 +1,22 @@
-from flask import Flask, request, jsonify, Blueprint
-from models import connect_db, db, Calendar, Event
+from flask import request, jsonify, Blueprint, current_app, Response, send_file, stream_with_context
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import os
+import shutil
+import tempfile
+from operator import itemgetter
+from datetime import timedelta
+from models import db, Calendar, Event, EventTombstone, bump_calendar_version, find_conflicts, remove_calendar, remove_calendar_events
+from jobs import job, enqueue, accepted, JobFailed
+from ics import ICSError, import_events, snapshot_path, write_snapshot, remove_snapshots
+from recurrence import expand_rows
+from response_cache import cached_response
+from event_stream import event_stream, DEFAULT_HEARTBEAT
+from api.helpers import after_id_filter, keyset_page, stream_ndjson, wants_ndjson, calendar_etag, not_modified, with_etag, event_feed_query, parse_range, feed_response, feed_etag
 
-app = Flask(__name__)
 api_calendars= Blueprint('api_calendars', __name__) #creating the API blueprint
 
-app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "oh-so-secret")
-app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("SUPABASE_URL", "postgresql:///calendar")
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-
-# app.app_context().push()
-connect_db(app)
+DELETE_BATCH_SIZE = 5000 #events deleted per transaction by ?background=true calendar deletes
+MAX_WINDOW_DAYS = 366 #longest start-end window recurring events are expanded over (like MAX_FREEBUSY_DAYS)
 
 
 #############################################
@@ -19,24 +25,34 @@ connect_db(app)
 
 @api_calendars.route('/api/calendars')
 def list_calendars():
-    '''Returns JSON for all calendars'''
+    '''Returns JSON for all calendars | paginate with ?after_id=&limit= or stream with ?format=ndjson'''
+    
+    query = Calendar.query
+    if wants_ndjson(request.args):
+        return stream_ndjson(after_id_filter(query, Calendar.id, request.args))
     
-    calendars = Calendar.query.all()
+    calendars, next_after_id = keyset_page(query, Calendar.id, request.args)
     calendars_JSON = [calendar.serialize() for calendar in calendars]
-    response_JSON = jsonify(calendars=calendars_JSON)
+    response_JSON = jsonify(calendars=calendars_JSON, next_after_id=next_after_id)
     
     return (response_JSON)
 
 
 @api_calendars.route('/api/calendars/<int:id>')
+@cached_response('calendar:{id}')
 def get_calendar(id):
     '''Returns JSON for a specific calendar'''
     
     calendar = Calendar.query.get_or_404(id)
+    etag = calendar_etag(calendar)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    
     calendar_JSON = calendar.serialize()
     response_JSON = jsonify(calendar=calendar_JSON)
     
-    return (response_JSON)
+    return with_etag(response_JSON, etag)
 
 
 @api_calendars.route('/api/calendars', methods=['POST'])
@@ -46,11 +62,12 @@ def create_calendar():
     name = request.json['name']
     description = request.json['description']
     is_public = request.json['is_public']
+    reject_conflicts = request.json.get('reject_conflicts', False)
     created_at = request.json['created_at']
     
     owner_id = request.json['owner_id']
     
-    new_calendar = Calendar(name=name, description=description, is_public=is_public, created_at=created_at, owner_id=owner_id)
+    new_calendar = Calendar(name=name, description=description, is_public=is_public, reject_conflicts=reject_conflicts, created_at=created_at, owner_id=owner_id)
     
     db.session.add(new_calendar)
     db.session.commit()
@@ -70,8 +87,10 @@ def update_calendar(id):
     calendar.name = request.json.get('name', calendar.name)
     calendar.description = request.json.get('description', calendar.description)
     calendar.is_public = request.json.get('is_public', calendar.is_public)
+    calendar.reject_conflicts = request.json.get('reject_conflicts', calendar.reject_conflicts)
     
     calendar.owner_id = request.json.get('owner_id', calendar.owner_id)
+    bump_calendar_version(calendar.id)
     
     db.session.commit()
     
@@ -83,30 +102,238 @@ def update_calendar(id):
 
 @api_calendars.route('/api/calendars/<int:id>', methods=['DELETE'])
 def delete_calendar(id):
-    '''Deletes a specific calendar and returns deletion confirmation'''
+    '''Deletes a specific calendar and returns deletion confirmation | one DELETE, the events go through ON DELETE CASCADE
+    | ?background=true returns 202 right away and deletes the events in batches first (for very big calendars)'''
     
-    calendar = Calendar.query.get_or_404(id)
+    Calendar.query.get_or_404(id)
+    
+    if request.args.get('background') == 'true':
+        queued = enqueue('delete_calendar', calendar_id=id)
+        db.session.commit()
+        return accepted(queued)
     
-    db.session.delete(calendar)
+    remove_calendar(id)
     db.session.commit()
+    remove_snapshots(current_app.config['FEED_DIR'], id)
     
     response_JSON = jsonify(message='Calendar has been deleted')
     
     return (response_JSON)
 
 
+@job('delete_calendar')
+def delete_calendar_in_batches(calendar_id, owner_id=None):
+    '''Background calendar delete | events go DELETE_BATCH_SIZE at a time, each batch in its own short transaction
+    so the events table is never locked for long, then the (now empty) calendar | safe to run again after a failure
+    | owner_id is unused, remove_calendar marks the owner stale itself (older queued jobs still send it)'''
+    
+    deleted = 0
+    while (batch := remove_calendar_events(calendar_id, DELETE_BATCH_SIZE)) == DELETE_BATCH_SIZE:
+        deleted += batch
+        db.session.commit()
+    remove_calendar(calendar_id)
+    db.session.commit()
+    remove_snapshots(current_app.config['FEED_DIR'], calendar_id)
+    
+    return {'events_deleted': deleted + batch}
+
+
+@api_calendars.route('/api/calendars/<int:id>/feed.ics')
+def get_calendar_feed(id):
+    '''Returns the iCalendar (.ics) feed of a public calendar, for subscribing from other calendar apps
+    | served from a snapshot file saved the first time each version is asked for, so most hits are one PK lookup and a sendfile
+    | the first hit streams the feed while it is being saved | private calendars are a 404'''
+    
+    calendar = Calendar.query.get_or_404(id)
+    if not calendar.is_public:
+        return (jsonify(message='Calendar not found'), 404)
+    
+    etag = calendar_etag(calendar)
+    cache_control = f"public, max-age={current_app.config['FEED_MAX_AGE']}, stale-while-revalidate=86400"
+    
+    response = not_modified(etag)
+    if response is None:
+        feed_dir = current_app.config['FEED_DIR']
+        path = snapshot_path(feed_dir, calendar)
+        if os.path.exists(path):
+            response = send_file(path, mimetype='text/calendar', conditional=False, etag=False, max_age=None)
+        else:
+            response = Response(stream_with_context(write_snapshot(feed_dir, calendar, current_app.config['FEED_DOMAIN'])), mimetype='text/calendar')
+        response = with_etag(response, etag)
+    
+    response.headers['Cache-Control'] = cache_control
+    response.headers['Content-Disposition'] = f'inline; filename="calendar-{id}.ics"'
+    
+    return (response)
+
+
+@api_calendars.route('/api/calendars/<int:id>/import', methods=['POST'])
+def import_calendar(id):
+    '''Imports the events of an .ics file (multipart "file" field, or a raw text/calendar body) into a calendar and returns the counts
+    | the file is parsed as it is read and inserted in batches | events with a UID already in the calendar are skipped
+    | ?tz= is the time zone UTC/TZID times are converted to (default UTC) | ?background=true saves the file and returns 202 with the import job'''
+    
+    calendar = Calendar.query.get_or_404(id)
+    
+    try:
+        tz = ZoneInfo(request.args.get('tz', 'UTC'))
+    except (ZoneInfoNotFoundError, ValueError):
+        return (jsonify(message='Unknown time zone'), 400)
+    
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    
+    if request.args.get('background') == 'true':
+        with tempfile.NamedTemporaryFile('wb', suffix='.ics', dir=current_app.config.get('IMPORT_DIR'), delete=False) as saved:
+            shutil.copyfileobj(stream, saved)
+        queued = enqueue('import_ics', path=saved.name, calendar_id=id, creator_id=calendar.owner_id, tz=tz.key)
+        db.session.commit()
+        return accepted(queued)
+    
+    try:
+        counts = import_events(stream, id, calendar.owner_id, tz)
+    except ICSError as error:
+        db.session.rollback()
+        return (jsonify(message=str(error)), 400)
+    db.session.commit()
+    
+    response_JSON = jsonify(**counts)
+    
+    return (response_JSON)
+
+
+@job('import_ics')
+def import_ics_file(path, calendar_id, creator_id, tz):
+    '''Background ICS import of a file saved by import_calendar | the file is removed once it's imported (or can't be)'''
+    
+    if db.session.get(Calendar, calendar_id) is None:
+        os.remove(path)
+        raise JobFailed('Calendar has been deleted')
+    
+    try:
+        with open(path, 'rb') as file:
+            counts = import_events(file, calendar_id, creator_id, ZoneInfo(tz))
+    except ICSError as error:
+        os.remove(path)
+        raise JobFailed(str(error))
+    db.session.commit()
+    os.remove(path)
+    
+    return counts
+
+
 #############################################
 #              CALENDAR EVENTS              #
 #############################################
 
 @api_calendars.route('/api/calendars/<int:id>/events')
+@cached_response('calendar:{id}')
 def get_calendar_events(id):
-    '''Returns JSON for events for a specific calendar'''
+    '''Returns JSON (or MessagePack, Accept: application/msgpack) for events for a specific calendar | optional start/end query params only return events overlapping that window
+    | with both start and end (at most MAX_WINDOW_DAYS apart), recurring events come back as one event per occurrence in the window
+    | ?format=fullcalendar returns events ready to render, ?fields=id,title,... only returns those keys'''
     
     calendar = Calendar.query.get_or_404(id) #chekc if the calendar exists in the DB
-    events = Event.query.filter(Event.calendar_id == id).all()
+    #the calendar version is bumped on every event write, so the events table isn't touched when nothing changed
+    etag = feed_etag(calendar_etag(calendar))
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    
+    try:
+        start, end = parse_range(request.args)
+        query = event_feed_query(request.args).filter(Event.calendar_id == id)
+        series_query = event_feed_query(request.args, series=True).filter(Event.calendar_id == id)
+    except ValueError as error:
+        return (jsonify(message=str(error)), 400)
+    if start is not None and end is not None and end - start > timedelta(days=MAX_WINDOW_DAYS):
+        return (jsonify(message=f'start and end can be at most {MAX_WINDOW_DAYS} days apart'), 400)
+    
+    occurrences = []
+    if start is not None and end is not None:
+        #recurring events are stored once per series and expanded into the occurrences inside the window
+        query = query.filter(Event.rrule.is_(None)).add_columns(Event.start_time.label('sort_start'))
+        series = (series_query
+                  .filter(Event.start_time < end, db.or_(Event.series_end.is_(None), Event.series_end >= start))
+                  .all())
+        occurrences = expand_rows(series, start, end)
+    
+    #an event overlaps the window if it starts before the window ends and ends after the window starts
+    if end is not None:
+        query = query.filter(Event.start_time < end)
+    if start is not None:
+        query = query.filter(Event.end_time >= start)
+    events = query.order_by(Event.start_time).all()
         
+    events_JSON = [event._asdict() for event in events]
+    if start is not None and end is not None:
+        #merged on the raw start times, the feed columns may not have a time in them (?fields=id,title)
+        singles = [(event.pop('sort_start'), event) for event in events_JSON]
+        events_JSON = [event for sort_start, event in sorted(singles + occurrences, key=itemgetter(0))]
+    response_JSON = feed_response(events=events_JSON)
+    
+    return with_etag(response_JSON, etag)
+
+
+@api_calendars.route('/api/calendars/<int:id>/events/stream')
+def stream_calendar_events(id):
+    '''Server-Sent Events for every change to a calendar's events, made by any worker | see event_stream.event_stream
+    | open it after loading the events, and load them again when it reconnects or sends a reset'''
+    
+    Calendar.query.get_or_404(id)
+    hub = current_app.extensions['event_stream']
+    heartbeat = current_app.config.get('EVENT_STREAM_HEARTBEAT', DEFAULT_HEARTBEAT)
+    
+    #no stream_with_context, the request's DB session is given back before the stream starts
+    return Response(event_stream(hub, id, heartbeat), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}) #nginx would buffer it otherwise
+
+
+@api_calendars.route('/api/calendars/<int:id>/conflicts')
+def get_calendar_conflicts(id):
+    '''Returns JSON for the events in a calendar that overlap ?start=&end= | ?exclude= skips the event being edited'''
+    
+    calendar = Calendar.query.get_or_404(id)
+    
+    try:
+        start, end = parse_range(request.args)
+    except ValueError as error:
+        return (jsonify(message=str(error)), 400)
+    if start is None or end is None:
+        return (jsonify(message='start and end are required'), 400)
+    if end - start > timedelta(days=MAX_WINDOW_DAYS):
+        return (jsonify(message=f'start and end can be at most {MAX_WINDOW_DAYS} days apart'), 400)
+    
+    conflicts = find_conflicts(id, start, end, exclude_id=request.args.get('exclude', type=int))
+    conflicts_JSON = [event.serialize() for event in conflicts]
+    response_JSON = jsonify(conflicts=conflicts_JSON)
+    
+    return (response_JSON)
+
+
+@api_calendars.route('/api/calendars/<int:id>/events/changes')
+def get_calendar_event_changes(id):
+    '''Returns JSON (or MessagePack) for the events created, updated or deleted in a calendar since the ?since= cursor
+    | clients keep the returned cursor and send it next time to only get what changed'''
+    
+    calendar = Calendar.query.get_or_404(id)
+    since = request.args.get('since', 0, type=int)
+    
+    events = (Event.query
+              .filter(Event.calendar_id == id, Event.change_seq > since)
+              .order_by(Event.change_seq)
+              .all())
+    tombstones = (EventTombstone.query
+                  .filter(EventTombstone.calendar_id == id, EventTombstone.change_seq > since)
+                  .order_by(EventTombstone.change_seq)
+                  .all())
+    
+    #an event can be moved out and back in again, the live event is newer than its tombstone
+    live_ids = {event.id for event in events}
+    deleted = [tombstone.event_id for tombstone in tombstones if tombstone.event_id not in live_ids]
+    cursor = max([since] + [event.change_seq for event in events] + [tombstone.change_seq for tombstone in tombstones])
+    
     events_JSON = [event.serialize() for event in events]
-    response_JSON = jsonify(events=events_JSON)
+    response_JSON = feed_response(events=events_JSON, deleted=deleted, cursor=cursor)
     
-    return (response_JSON)
\ No newline at end of file
+    return (response_JSON)
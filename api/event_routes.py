@@ -1,16 +1,17 @@
-from flask import Flask, request, jsonify, Blueprint
-from models import connect_db, db, Event
-import os
+from flask import request, jsonify, Blueprint, g
+from models import db, Event, Calendar, PendingEvents, bump_calendar_version, tombstone_events, refresh_series_end, find_conflicts, as_datetime, mark_stale, notify_calendars, event_changes
+from response_cache import cached_response, add_cache_tags
+from api.helpers import uses_current_user, after_id_filter, keyset_page, offset_page, stream_ndjson, wants_ndjson, event_feed_query, feed_response
+from sqlalchemy import insert, update, delete
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime
+from recurrence import check_rrule, series_end
 
-app = Flask(__name__)
 api_events= Blueprint('api_events', __name__) #creating the API blueprint
 
-app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "oh-so-secret")
-app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("SUPABASE_URL", "postgresql:///calendar")
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-
-# app.app_context().push()
-connect_db(app)
+EVENT_FIELDS = ['title', 'description', 'start_time', 'end_time', 'location', 'bg_color', 'txt_color', 'all_day', 'rrule', 'calendar_id', 'creator_id']
+REQUIRED_EVENT_FIELDS = ['title', 'start_time', 'end_time', 'calendar_id', 'creator_id']
+MAX_BATCH_SIZE = 5000 #most creates+updates+deletes allowed in one batch request
 
 
 ##########################################
@@ -19,20 +20,64 @@ connect_db(app)
 
 @api_events.route('/api/events')
 def list_events():
-    '''Returns JSON for all events'''
+    '''Returns JSON (or MessagePack, Accept: application/msgpack) for all events | paginate with ?after_id=&limit= or stream with ?format=ndjson
+    | ?format=fullcalendar returns events ready to render, ?fields=id,title,... only returns those keys'''
+    
+    try:
+        query = event_feed_query(request.args)
+    except ValueError as error:
+        return (jsonify(message=str(error)), 400)
+    
+    if wants_ndjson(request.args):
+        return stream_ndjson(after_id_filter(query, Event.id, request.args), serialize=lambda row: row._asdict())
+    
+    events, next_after_id = keyset_page(query, Event.id, request.args)
+    events_JSON = [event._asdict() for event in events]
+    response_JSON = feed_response(events=events_JSON, next_after_id=next_after_id)
+    
+    return (response_JSON)
+
+
+@api_events.route('/api/events/search')
+@uses_current_user
+def search_events():
+    '''Returns JSON for the logged in user's events matching ?q=, best match first | paginate with ?offset=&limit=
+    | matches come from the GIN index on Event.search_vector, ?format=/?fields= work like /api/events'''
+    
+    if g.get('user') is None:
+        return (jsonify(message='You must be logged in to search events'), 401)
+    
+    q = request.args.get('q', '').strip()
+    if not q:
+        return (jsonify(message='q is required'), 400)
+    
+    try:
+        query = event_feed_query(request.args)
+    except ValueError as error:
+        return (jsonify(message=str(error)), 400)
     
-    events = Event.query.all()
-    events_JSON = [event.serialize() for event in events]
-    response_JSON = jsonify(events=events_JSON)
+    terms = Event.search_terms(q)
+    rank = db.func.ts_rank(Event.search_vector, terms)
+    own_calendars = db.select(Calendar.id).where(Calendar.owner_id == g.user.id)
+    
+    query = (query.add_columns(rank.label('rank'))
+             .filter(Event.search_vector.op('@@')(terms), Event.calendar_id.in_(own_calendars))
+             .order_by(rank.desc(), Event.id))
+    
+    events, next_offset = offset_page(query, request.args)
+    events_JSON = [event._asdict() for event in events]
+    response_JSON = jsonify(events=events_JSON, next_offset=next_offset)
     
     return (response_JSON)
 
 
 @api_events.route('/api/events/<int:id>')
+@cached_response('event:{id}')
 def get_event(id):
     '''Returns JSON for a specific event'''
     
     event = Event.query.get_or_404(id)
+    add_cache_tags(f'calendar:{event.calendar_id}') #deleting its calendar cascades to it without touching the row in Python
     event_JSON = event.serialize()
     response_JSON = jsonify(event=event_JSON)
     
@@ -51,13 +96,23 @@ def create_event():
     bg_color = request.json['bg_color']
     txt_color = request.json['txt_color']
     all_day = request.json['all_day']
+    rrule = request.json.get('rrule') #optional | FREQ=WEEKLY;BYDAY=MO for a recurring event
     
     creator_id = request.json['creator_id']
     calendar_id = request.json['calendar_id']
     
     #NOTE: don't need the 'create_at' here, but it does get sent through JSON
-    new_event = Event(title=title, description=description, start_time=start_time, end_time=end_time, location=location, bg_color=bg_color, txt_color=txt_color, 
-                        all_day=all_day, creator_id=creator_id, calendar_id=calendar_id)
+    try:
+        new_event = Event(title=title, description=description, start_time=start_time, end_time=end_time, location=location, bg_color=bg_color, txt_color=txt_color, 
+                            all_day=all_day, rrule=rrule, creator_id=creator_id, calendar_id=calendar_id)
+    except ValueError as error: #the @validates on Event (end before start, a recurrence rule it won't store)
+        return (jsonify(message=str(error)), 400)
+    
+    bump_calendar_version(calendar_id) #locks the calendar, an overlapping create at the same time waits for this one
+    conflict_response = check_conflicts(calendar_id, start_time, end_time)
+    if conflict_response:
+        db.session.rollback()
+        return conflict_response
     
     db.session.add(new_event)
     db.session.commit()
@@ -73,6 +128,8 @@ def update_event(id):
     '''Updates a specific event and returns JSON'''
     
     event = Event.query.get_or_404(id)
+    old_calendar_id = event.calendar_id
+    bump_calendar_version(old_calendar_id, request.json.get('calendar_id', old_calendar_id)) #before the changes and conflict check, event may move calendars
     
     event.title = request.json.get('title', event.title)
     event.description = request.json.get('description', event.description)
@@ -82,10 +139,20 @@ def update_event(id):
     event.bg_color = request.json.get('bg_color', event.bg_color)
     event.txt_color = request.json.get('txt_color', event.txt_color)
     event.all_day = request.json.get('all_day', event.all_day)
+    try:
+        event.rrule = request.json.get('rrule', event.rrule)
+    except ValueError as error: #a recurrence rule Event won't store
+        db.session.rollback()
+        return (jsonify(message=str(error)), 400)
     
     event.creator_id = request.json.get('creator_id', event.creator_id)
     event.calendar_id = request.json.get('calendar_id', event.calendar_id)
     
+    conflict_response = check_conflicts(event.calendar_id, event.start_time, event.end_time, exclude_id=event.id)
+    if conflict_response:
+        db.session.rollback()
+        return conflict_response
+    
     db.session.commit()
     
     event_JSON = event.serialize()
@@ -100,9 +167,236 @@ def delete_event(id):
     
     event = Event.query.get_or_404(id)
     
+    bump_calendar_version(event.calendar_id)
     db.session.delete(event)
     db.session.commit()
     
     response_JSON = jsonify(message='Event has been deleted')
     
-    return (response_JSON)
\ No newline at end of file
+    return (response_JSON)
+
+
+def check_conflicts(calendar_id, start_time, end_time, exclude_id=None):
+    '''Returns a 409 response listing the overlapping events if the calendar rejects conflicts (or ?check_conflicts=true was sent)
+    | a 400 if the times aren't ISO formatted local times | otherwise None
+    | the calendar must already be locked (bump_calendar_version) so a concurrent write can't pass the same check'''
+    
+    try:
+        start_time, end_time = as_datetime(start_time), as_datetime(end_time)
+    except ValueError as error:
+        return (jsonify(message=str(error)), 400)
+    
+    calendar = db.session.get(Calendar, calendar_id)
+    if calendar is None or not (calendar.reject_conflicts or request.args.get('check_conflicts') == 'true'):
+        return None
+    
+    conflicts = find_conflicts(calendar_id, start_time, end_time, exclude_id=exclude_id)
+    if not conflicts:
+        return None
+    
+    conflicts_JSON = [event.serialize() for event in conflicts]
+    return (jsonify(message='Event overlaps other events in this calendar', conflicts=conflicts_JSON), 409)
+
+
+@api_events.route('/api/events/batch', methods=['POST'])
+def batch_events():
+    '''Applies a list of creates, updates and deletes in a single transaction and returns per-item results
+    | body is {"create": [{event}], "update": [{"id": 1, ...changes}], "delete": [ids]}
+    | if any item is invalid nothing is applied and the errors are reported per item'''
+    
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return (jsonify(message='The body must be a JSON object'), 400)
+    
+    creates = body.get('create', [])
+    updates = body.get('update', [])
+    deletes = body.get('delete', [])
+    
+    if not all(isinstance(items, list) for items in (creates, updates, deletes)):
+        return (jsonify(message='create, update and delete must be lists'), 400)
+    if len(creates) + len(updates) + len(deletes) > MAX_BATCH_SIZE:
+        return (jsonify(message=f'A batch can have at most {MAX_BATCH_SIZE} items'), 413)
+    
+    #one query to find every existing event the batch touches (need the current times to validate partial updates)
+    ids = [item.get('id') for item in updates if isinstance(item, dict) and is_id(item.get('id'))] + [id for id in deletes if is_id(id)]
+    existing = {row.id: row for row in db.session.execute(
+        db.select(Event.id, Event.start_time, Event.end_time, Event.rrule, Event.calendar_id).where(Event.id.in_(ids)))}
+    
+    create_results = [validate_batch_item(item, None) for item in creates]
+    update_results = [validate_batch_item(item, existing) for item in updates]
+    delete_results = [{'id': id, 'status': 400, 'error': 'id must be an integer'} if not is_id(id) else
+                      {'id': id, 'status': 200} if id in existing else {'id': id, 'status': 404, 'error': 'Event not found'}
+                      for id in deletes]
+    
+    #every calendar an event is added to, moved out of/into or deleted from | locked before the conflict checks and the writes
+    calendar_ids = [result['values']['calendar_id'] for result in create_results + update_results if 'calendar_id' in result.get('values', {})]
+    calendar_ids += [row.calendar_id for row in existing.values()]
+    bump_calendar_version(*calendar_ids)
+    check_batch_conflicts(create_results + update_results, existing)
+    
+    results = {'create': create_results, 'update': update_results, 'delete': delete_results}
+    if any('error' in result for result in create_results + update_results + delete_results):
+        db.session.rollback()
+        for result in create_results + update_results:
+            result.pop('values', None)
+        return (jsonify(message='No changes have been made', results=results), 400)
+    
+    #deleted events and events moved out of a calendar need tombstones for delta sync
+    removed = [(id, existing[id].calendar_id) for id in deletes]
+    removed += [(result['id'], existing[result['id']].calendar_id) for result in update_results
+                if result['values'].get('calendar_id', existing[result['id']].calendar_id) != existing[result['id']].calendar_id]
+    #live streams hear about updates in the calendar the event ends up in
+    updated = [(result['id'], result['values'].get('calendar_id', existing[result['id']].calendar_id)) for result in update_results]
+    
+    try:
+        if creates:
+            new_events = db.session.scalars(
+                insert(Event).returning(Event, sort_by_parameter_order=True),
+                [result.pop('values') for result in create_results]).all()
+        if updates:
+            db.session.execute(update(Event), [result.pop('values') for result in update_results])
+            refresh_series_end([result['id'] for result in update_results])
+        if deletes:
+            db.session.execute(delete(Event).where(Event.id.in_(deletes)))
+        tombstone_events(removed)
+        mark_stale(*[f'event:{id}' for id in deletes + [result['id'] for result in update_results]]) #bulk statements skip the ORM listeners
+        notify_calendars(event_changes('created', [(event.id, event.calendar_id) for event in new_events] if creates else []) +
+                         event_changes('updated', updated) +
+                         event_changes('deleted', removed))
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return (jsonify(message='No changes have been made, check the calendar_id/creator_id of each event', results=results), 400)
+    
+    if creates:
+        for result, event in zip(create_results, new_events):
+            result['event'] = event.serialize()
+    if updates:
+        updated = {event.id: event for event in Event.query.filter(Event.id.in_([result['id'] for result in update_results]))}
+        for result in update_results:
+            result['event'] = updated[result['id']].serialize()
+    
+    return (jsonify(results=results))
+
+
+def check_batch_conflicts(results, existing):
+    '''Mark the valid creates/updates that would overlap other events in a calendar that rejects conflicts (or with ?check_conflicts=true)
+    | each check is an index lookup, plus a check against the batch's earlier items (PendingEvents) so they can't overlap each other
+    | the calendars must already be locked (bump_calendar_version) so a concurrent write can't pass the same checks'''
+    
+    valid = [result for result in results if 'error' not in result]
+    calendar_id = lambda result: result['values'].get('calendar_id') or existing[result['values']['id']].calendar_id
+    
+    if request.args.get('check_conflicts') == 'true':
+        checked_ids = {calendar_id(result) for result in valid}
+    else:
+        checked_ids = set(db.session.scalars(db.select(Calendar.id).where(
+            Calendar.id.in_({calendar_id(result) for result in valid}), Calendar.reject_conflicts)))
+    
+    pending = {id: PendingEvents() for id in checked_ids}
+    for result in valid:
+        if calendar_id(result) not in checked_ids:
+            continue
+        
+        values = result['values']
+        current = existing.get(values.get('id'))
+        start_time = values.get('start_time', current.start_time if current else None)
+        end_time = values.get('end_time', current.end_time if current else None)
+        rrule = values['rrule'] if 'rrule' in values else current.rrule if current else None
+        
+        conflicts = find_conflicts(calendar_id(result), start_time, end_time, exclude_id=values.get('id'))
+        if conflicts:
+            result.update(status=409, error='Event overlaps other events in this calendar', conflicts=[event.id for event in conflicts])
+        elif pending[calendar_id(result)].overlaps(start_time, end_time):
+            result.update(status=409, error='Event overlaps an earlier event in this batch')
+        else:
+            pending[calendar_id(result)].add(start_time, end_time, rrule)
+
+
+def is_id(value):
+    '''True for a value that can be compared to an integer id column (not a bool, fits in 4 bytes)'''
+    
+    return isinstance(value, int) and not isinstance(value, bool) and 0 < value < 2**31
+
+
+def field_error(field, value):
+    '''Why a batch value doesn't fit its events column (the bulk statements would fail with a DataError) | None if it does
+    | start_time/end_time are parsed separately'''
+    
+    column = Event.__table__.c[field]
+    if value is None:
+        return None if column.nullable else f'{field} is required'
+    if isinstance(column.type, db.Integer):
+        return None if is_id(value) else f'{field} must be an integer id'
+    if isinstance(column.type, db.Boolean):
+        return None if isinstance(value, bool) else f'{field} must be true or false'
+    if isinstance(column.type, db.String):
+        if not isinstance(value, str):
+            return f'{field} must be a string'
+        if column.type.length and len(value) > column.type.length:
+            return f'{field} can be at most {column.type.length} characters'
+    return None
+
+
+def validate_batch_item(item, existing):
+    '''Check one batch create (existing is None) or update and build the values to write
+    | returns a result dict with either the values or an error'''
+    
+    if not isinstance(item, dict):
+        return {'status': 400, 'error': 'Each item must be an object'}
+    
+    values = {field: item[field] for field in EVENT_FIELDS if field in item}
+    
+    if existing is None:
+        result = {'status': 201}
+        missing = [field for field in REQUIRED_EVENT_FIELDS if field not in values]
+        if missing:
+            return {**result, 'error': f'Missing fields: {", ".join(missing)}'}
+        current = None
+    else:
+        result = {'id': item.get('id'), 'status': 200}
+        if not is_id(result['id']):
+            return {**result, 'status': 400, 'error': 'id must be an integer'}
+        current = existing.get(result['id'])
+        if current is None:
+            return {**result, 'status': 404, 'error': 'Event not found'}
+        values['id'] = current.id
+    
+    errors = [field_error(field, value) for field, value in values.items() if field not in ('id', 'start_time', 'end_time')]
+    errors = [error for error in errors if error]
+    if errors:
+        return {**result, 'status': 400, 'error': ', '.join(errors)}
+    
+    #the @validates on Event doesn't run for bulk statements, so check the times here
+    try:
+        for field in ['start_time', 'end_time']:
+            if field in values:
+                values[field] = datetime.fromisoformat(values[field])
+    except (TypeError, ValueError):
+        return {**result, 'status': 400, 'error': 'start_time/end_time must be ISO formatted'}
+    try:
+        for field in ['start_time', 'end_time']:
+            if field in values:
+                as_datetime(values[field])
+    except ValueError as error:
+        return {**result, 'status': 400, 'error': str(error)}
+    
+    start_time = values.get('start_time', current.start_time if current else None)
+    end_time = values.get('end_time', current.end_time if current else None)
+    if end_time < start_time:
+        return {**result, 'status': 400, 'error': 'End time must be after start time'}
+    
+    #same checks as Event.validate_rrule | new series need series_end too, updates get it from refresh_series_end
+    if 'rrule' in values:
+        values['rrule'] = values['rrule'] or None #empty means it doesn't repeat
+        try:
+            if values['rrule']:
+                check_rrule(values['rrule'], start_time)
+        except ValueError as error:
+            return {**result, 'status': 400, 'error': str(error)}
+    if 'rrule' in values and values['rrule'] is None:
+        values['series_end'] = None
+    elif existing is None and values.get('rrule'):
+        values['series_end'] = series_end(values['rrule'], start_time, end_time)
+    
+    return {**result, 'values': values}
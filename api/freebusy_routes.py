@@ -0,0 +1,94 @@
+from flask import request, jsonify, Blueprint
+from freebusy import busy_times, merge_intervals, free_slots, from_seconds
+from api.helpers import parse_range
+from datetime import timedelta
+
+api_freebusy = Blueprint('api_freebusy', __name__) #creating the API blueprint
+
+MAX_FREEBUSY_DAYS = 366 #longest range a free/busy query can cover
+
+
+#############################################
+#              FREE/BUSY ROUTES             #
+#############################################
+
+@api_freebusy.route('/api/freebusy')
+def get_freebusy():
+    '''Returns JSON for the merged busy times of every calendar owned by ?users=1,2,3 between ?start= and ?end='''
+    
+    try:
+        user_ids, start, end = parse_freebusy_args(request.args)
+    except ValueError as error:
+        return (jsonify(message=str(error)), 400)
+    
+    busy_starts, busy_ends = merge_intervals(*busy_times(user_ids, start, end))
+    busy_JSON = [format_interval(busy_start, busy_end) for busy_start, busy_end in zip(busy_starts, busy_ends)]
+    response_JSON = jsonify(busy=busy_JSON)
+    
+    return (response_JSON)
+
+
+@api_freebusy.route('/api/freebusy/slots')
+def get_free_slots():
+    '''Returns JSON for the times all ?users= are free for at least ?duration= minutes between ?start= and ?end=
+    | only inside working hours (?day_start=09:00&day_end=17:00) and on weekdays unless ?weekends=true'''
+    
+    try:
+        user_ids, start, end = parse_freebusy_args(request.args)
+        duration = request.args.get('duration', 30, type=int)
+        day_start = parse_time_of_day(request.args.get('day_start', '09:00'))
+        day_end = parse_time_of_day(request.args.get('day_end', '17:00'))
+    except ValueError as error:
+        return (jsonify(message=str(error)), 400)
+    
+    if duration <= 0 or day_end <= day_start:
+        return (jsonify(message='duration must be positive and day_end after day_start'), 400)
+    
+    weekends = request.args.get('weekends') == 'true'
+    limit = min(request.args.get('limit', 10, type=int), 100)
+    
+    busy_starts, busy_ends = merge_intervals(*busy_times(user_ids, start, end))
+    slots = free_slots(busy_starts, busy_ends, start, end, duration * 60, day_start, day_end, weekends=weekends, limit=limit)
+    
+    slots_JSON = [format_interval(slot_start, slot_end) for slot_start, slot_end in slots]
+    response_JSON = jsonify(slots=slots_JSON)
+    
+    return (response_JSON)
+
+
+def parse_freebusy_args(args):
+    '''Pull the user ids and the (required) start/end out of the query string
+    | start/end are naive like the event times free_slots compares them to, parse_range refuses a UTC offset'''
+    
+    try:
+        user_ids = [int(id) for id in args.get('users', '').split(',') if id]
+    except ValueError:
+        raise ValueError('users must be a comma separated list of user ids')
+    
+    start, end = parse_range(args)
+    
+    if not user_ids or start is None or end is None:
+        raise ValueError('users, start and end are required')
+    if end - start > timedelta(days=MAX_FREEBUSY_DAYS):
+        raise ValueError(f'start and end can be at most {MAX_FREEBUSY_DAYS} days apart')
+    
+    return (user_ids, start, end)
+
+
+def parse_time_of_day(time):
+    '''HH:MM -> timedelta from midnight'''
+    
+    try:
+        hours, minutes = time.split(':')
+        return timedelta(hours=int(hours), minutes=int(minutes))
+    except ValueError:
+        raise ValueError('day_start/day_end must be HH:MM')
+
+
+def format_interval(start, end):
+    '''Seconds -> the same time format as the event JSON'''
+    
+    return {
+        'start': from_seconds(start).strftime('%Y-%m-%dT%H:%M'),
+        'end': from_seconds(end).strftime('%Y-%m-%dT%H:%M'),
+    }
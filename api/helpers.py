@@ -0,0 +1,149 @@
+from flask import Response, current_app, jsonify, request, stream_with_context
+from models import Event
+from encoding import wants_msgpack, msgpack_dumps, MSGPACK_MIMETYPE
+from datetime import datetime
+
+MAX_PAGE_SIZE = 1000 #biggest page a client can ask for with ?limit=
+DEFAULT_PAGE_SIZE = 20 #page size when there's no ?limit=
+STREAM_BATCH_SIZE = 500 #rows pulled from the server-side cursor at a time when streaming
+
+
+def uses_current_user(view):
+    '''Mark an API route that needs g.user | add_user_to_g skips the user lookup for every other API route'''
+
+    view.uses_current_user = True
+    return view
+
+
+def after_id_filter(query, id_column, args):
+    '''Only keep rows after the ?after_id= cursor, ordered by id'''
+
+    after_id = args.get('after_id', type=int)
+
+    if after_id is not None:
+        query = query.filter(id_column > after_id)
+    return query.order_by(id_column)
+
+
+def keyset_page(query, id_column, args, default_limit=DEFAULT_PAGE_SIZE):
+    '''Apply keyset pagination (?after_id=&limit=) to a query | returns (rows, next_after_id)
+    | every list is paged, without ?limit= it's default_limit rows | ?format=ndjson streams the whole list instead'''
+
+    query = after_id_filter(query, id_column, args)
+    limit = min(max(args.get('limit', default_limit, type=int), 1), MAX_PAGE_SIZE)
+    rows = query.limit(limit + 1).all() #grab one extra row to know if there is another page
+
+    if len(rows) > limit:
+        return (rows[:limit], rows[limit - 1].id)
+    return (rows, None)
+
+
+def offset_page(query, args, default_limit=DEFAULT_PAGE_SIZE):
+    '''Apply ?offset=&limit= pagination to a query that is already ordered | returns (rows, next_offset)
+    | for results ordered by something other than id (like search rank), where keyset_page can't be used'''
+
+    offset = max(args.get('offset', 0, type=int), 0)
+    limit = min(max(args.get('limit', default_limit, type=int), 1), MAX_PAGE_SIZE)
+    rows = query.offset(offset).limit(limit + 1).all() #grab one extra row to know if there is another page
+
+    if len(rows) > limit:
+        return (rows[:limit], offset + limit)
+    return (rows, None)
+
+
+def event_feed_query(args, series=False):
+    '''Event.feed_query() (or series_query() for recurring events) for the ?format=fullcalendar and ?fields=id,title,... query params
+    | raises a ValueError for unknown fields'''
+
+    fields = args.get('fields')
+    fields = fields.split(',') if fields else None
+
+    if series:
+        return Event.series_query(args.get('format'), fields)
+    return Event.feed_query(args.get('format'), fields)
+
+
+def wants_ndjson(args):
+    '''Check if the client asked for newline delimited JSON (?format=ndjson)'''
+
+    return args.get('format') == 'ndjson'
+
+
+def stream_ndjson(query, serialize=lambda row: row.serialize()):
+    '''Stream a query as newline delimited JSON, one serialized row per line
+    | rows come from a server-side cursor in batches so the whole table is never held in memory'''
+
+    def generate():
+        lines = []
+        for row in query.yield_per(STREAM_BATCH_SIZE):
+            lines.append(current_app.json.dumps(serialize(row)))
+
+            if len(lines) == STREAM_BATCH_SIZE:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def feed_response(**data):
+    '''jsonify() for the event feeds | MessagePack instead for clients that ask for it (Accept: application/msgpack)'''
+
+    if wants_msgpack():
+        response = Response(msgpack_dumps(data), mimetype=MSGPACK_MIMETYPE)
+    else:
+        response = jsonify(**data)
+    response.vary.add('Accept')
+    return response
+
+
+def feed_etag(etag):
+    '''The ETag of a feed response, one per representation (JSON or MessagePack)'''
+
+    return etag + '-msgpack' if wants_msgpack() else etag
+
+
+def calendar_etag(calendar):
+    '''ETag for anything built from a calendar and its events | changes whenever the calendar version is bumped'''
+
+    return f'calendar-{calendar.id}-v{calendar.version}'
+
+
+def not_modified(etag):
+    '''Returns a 304 response if the client already has this version (If-None-Match), otherwise None'''
+
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        return with_etag(response, etag)
+    return None
+
+
+def with_etag(response, etag):
+    '''Tag a response with an ETag | no-cache makes browsers revalidate every time instead of guessing'''
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def parse_range(args):
+    '''Pull the optional start/end datetimes (ISO format, what FullCalendar sends) out of the query string'''
+
+    start = args.get('start')
+    end = args.get('end')
+
+    try:
+        start = datetime.fromisoformat(start) if start else None
+        end = datetime.fromisoformat(end) if end else None
+    except ValueError:
+        raise ValueError('start/end must be ISO formatted dates (YYYY-MM-DD or YYYY-MM-DDTHH:MM)')
+
+    #event times are stored without a time zone, a Z/+02:00 can't be compared to them
+    if any(time is not None and time.tzinfo is not None for time in (start, end)):
+        raise ValueError('start/end must not have a UTC offset (Z, +02:00), use the calendar\'s local time')
+
+    if start and end and end < start:
+        raise ValueError('end must be after start')
+
+    return (start, end)
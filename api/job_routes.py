@@ -0,0 +1,64 @@
+from flask import request, jsonify, Blueprint
+from models import db, Job
+from api.helpers import offset_page
+from sqlalchemy import func
+
+api_jobs = Blueprint('api_jobs', __name__) #creating the API blueprint
+
+JOB_STATUSES = ['queued', 'running', 'done', 'failed']
+
+
+##########################################
+#               JOB ROUTES               #
+##########################################
+
+@api_jobs.route('/api/jobs')
+def list_jobs():
+    '''Returns JSON for the most recent jobs, newest first | ?status= and ?kind= filter them, paged with ?offset=&limit='''
+
+    query = Job.query.order_by(Job.id.desc())
+
+    status = request.args.get('status')
+    if status is not None:
+        if status not in JOB_STATUSES:
+            return (jsonify(message=f"status must be one of {', '.join(JOB_STATUSES)}"), 400)
+        query = query.filter(Job.status == status)
+    if request.args.get('kind'):
+        query = query.filter(Job.kind == request.args['kind'])
+
+    jobs, next_offset = offset_page(query, request.args)
+    jobs_JSON = [job.serialize() for job in jobs]
+    response_JSON = jsonify(jobs=jobs_JSON, next_offset=next_offset)
+
+    return (response_JSON)
+
+
+@api_jobs.route('/api/jobs/<int:id>')
+def get_job(id):
+    '''Returns JSON for a specific job | clients poll this after a 202 until the status is done or failed'''
+
+    job = Job.query.get_or_404(id)
+    job_JSON = job.serialize()
+    response_JSON = jsonify(job=job_JSON)
+
+    return (response_JSON)
+
+
+@api_jobs.route('/api/jobs/<int:id>/retry', methods=['POST'])
+def retry_job(id):
+    '''Queues a failed job again with a fresh set of attempts and returns JSON for it'''
+
+    job = Job.query.get_or_404(id)
+
+    if job.status != 'failed':
+        return (jsonify(message='Only failed jobs can be retried'), 409)
+
+    job.status = 'queued'
+    job.attempts = 0
+    job.run_at = func.now()
+    job.finished_at = None
+    db.session.commit()
+
+    response_JSON = jsonify(job=job.serialize())
+
+    return (response_JSON, 202)
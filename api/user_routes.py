@@ -1,16 +1,10 @@
-from flask import Flask, request, jsonify, Blueprint
-from models import connect_db, db, User
-import os
+from flask import request, jsonify, Blueprint, Response, g, stream_with_context
+from models import db, User, remove_user
+from export import ndjson_chunks, csv_zip_chunks
+from api.helpers import uses_current_user, after_id_filter, keyset_page, stream_ndjson, wants_ndjson
 
-app = Flask(__name__)
 api_users= Blueprint('api_users', __name__) #creating the API blueprint
 
-app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "oh-so-secret")
-app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("SUPABASE_URL", "postgresql:///calendar")
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-
-# app.app_context().push()
-connect_db(app)
 
 @api_users.route('/api')
 def index():
@@ -23,11 +17,15 @@ def index():
 
 @api_users.route('/api/users')
 def list_users():
-    '''Returns JSON for all users'''
+    '''Returns JSON for all users | paginate with ?after_id=&limit= or stream with ?format=ndjson'''
+    
+    query = User.query
+    if wants_ndjson(request.args):
+        return stream_ndjson(after_id_filter(query, User.id, request.args))
     
-    users = User.query.all()
+    users, next_after_id = keyset_page(query, User.id, request.args)
     users_JSON = [user.serialize() for user in users]
-    response_JSON = jsonify(users=users_JSON)
+    response_JSON = jsonify(users=users_JSON, next_after_id=next_after_id)
     
     return (response_JSON)
 
@@ -43,6 +41,32 @@ def get_user(id):
     return (response_JSON)
 
 
+@api_users.route('/api/users/<int:id>/export')
+@uses_current_user
+def export_user(id):
+    '''Streams the logged in user's whole account (user, calendars, events) as a download
+    | ?format=ndjson (default, one JSON object per line with a "type") or ?format=csv (a zip of one CSV per table)
+    | rows come from server-side cursors and go out as they are read, so big accounts are never held in memory'''
+    
+    if g.user is None:
+        return (jsonify(message='Log in to export your account'), 401)
+    if g.user.id != id:
+        return (jsonify(message='You can only export your own account'), 403)
+    
+    format = request.args.get('format', 'ndjson')
+    if format == 'ndjson':
+        chunks, mimetype, filename = ndjson_chunks(g.user), 'application/x-ndjson', f'account-{id}.ndjson'
+    elif format == 'csv':
+        chunks, mimetype, filename = csv_zip_chunks(g.user), 'application/zip', f'account-{id}.zip'
+    else:
+        return (jsonify(message='format must be ndjson or csv'), 400)
+    
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    
+    return (response)
+
+
 @api_users.route('/api/users', methods=['POST'])
 def create_user():
     '''Creates a new user and return JSON'''
@@ -86,9 +110,9 @@ def update_user(id):
 def delete_user(id):
     '''Deletes a specific user and returns deletion confirmation'''
     
-    user = User.query.get_or_404(id)
+    User.query.get_or_404(id)
     
-    db.session.delete(user)
+    remove_user(id) #their calendars and events go through ON DELETE CASCADE
     db.session.commit()
     
     response_JSON = jsonify(message='User has been deleted')
@@ -1,43 +1,111 @@
-from flask import Flask, render_template, redirect, request, session, g, flash
-from flask_debugtoolbar import DebugToolbarExtension
-from models import connect_db, db, User, Event, Calendar, create_user, add_to_db
+from flask import Flask, Blueprint, render_template, redirect, request, session, g, flash, current_app
+from models import connect_db, db, User, Event, Calendar, create_user, add_to_db, bump_calendar_version, find_conflicts, remove_user, remove_calendar
 from forms import RegisterForm, LoginForm, EventForm, CalendarForm, EditUserForm
 from datetime import datetime
 from api.user_routes import api_users
 from api.event_routes import api_events
 from api.calendar_routes import api_calendars
+from api.freebusy_routes import api_freebusy
+from api.job_routes import api_jobs
+from user_cache import get_user
+from query_stats import init_query_stats
+from response_cache import init_response_cache
+from event_stream import init_event_stream
+from invalidation import init_invalidation
+from encoding import init_encoding
+from jobs import worker_command
+from ics import remove_snapshots
+from passwords import HashingBusy, hashing_busy
+from flask_migrate import Migrate, stamp
 from dotenv import load_dotenv
+import click
 import os
 
-load_dotenv()
-SECRET_KEY = os.environ.get('SECRET_KEY')
-SUPABASE_URL = os.environ.get("SUPABASE_URL", 'postgresql:///calendar') # to check if the URL is being loaded
-
-app = Flask(__name__)
-app.register_blueprint(api_users) #registering the API blueprint
-app.register_blueprint(api_events)
-app.register_blueprint(api_calendars)
-
-app.config['SQLALCHEMY_DATABASE_URI'] = SUPABASE_URL
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-# app.config["SQLALCHEMY_ECHO"] = True
-app.config["SECRET_KEY"] = SECRET_KEY
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-
 CURR_USER_KEY = "curr_user"
 
-# app.app_context().push() | NOTE: updated the connect_db() method which allowed us to connect to Supabase
-connect_db(app)
-
-toolbar = DebugToolbarExtension(app)
-
-
-@app.before_request
+pages = Blueprint('pages', __name__) #all the HTML page routes | registered on the app in create_app()
+migrate = Migrate()
+
+
+def create_app(config=None):
+    '''Application factory | builds the app, registers the blueprints and sets up the DB once
+    | no tables are created here (run `flask init-db`) and dev-only extensions are only loaded in debug mode
+    | config is an optional dict that overrides the defaults (tests, benchmarks)'''
+
+    load_dotenv()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("SUPABASE_URL", 'postgresql:///calendar')
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # app.config["SQLALCHEMY_ECHO"] = True
+    app.config["SECRET_KEY"] = os.environ.get('SECRET_KEY')
+    app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12)) #password hashing cost | old hashes get upgraded on login
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 0)) #most hashes running at once, 0 hashes in the request thread uncapped
+    app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE', 64)) #hashes that can wait for a slot, more get a 503
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    app.config['QUERY_BUDGET'] = int(os.environ.get('QUERY_BUDGET', 20)) #requests running more SQL statements than this get logged
+    app.config['RESPONSE_CACHE'] = os.environ.get('RESPONSE_CACHE', 'memory') #memory (per worker), postgres (shared) or none
+    app.config['RESPONSE_CACHE_SIZE'] = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+    app.config['RESPONSE_CACHE_TTL'] = int(os.environ.get('RESPONSE_CACHE_TTL', 300)) #seconds
+    app.config['JOB_TIMEOUT'] = int(os.environ.get('JOB_TIMEOUT', 600)) #seconds a job can run before another worker takes it over
+    app.config['IMPORT_DIR'] = os.environ.get('IMPORT_DIR') #where ?background=true imports wait for a worker (same machine) | None is the system temp dir
+    app.config['FEED_DIR'] = os.environ.get('FEED_DIR', os.path.join(app.instance_path, 'feeds')) #.ics feed snapshots, one file per calendar version
+    app.config['FEED_DOMAIN'] = os.environ.get('FEED_DOMAIN', 'calendar.local') #domain in feed UIDs/PRODID, never the request's Host (snapshots are shared) | changing it changes every UID
+    app.config['FEED_MAX_AGE'] = int(os.environ.get('FEED_MAX_AGE', 900)) #seconds subscribers/proxies may reuse a feed before asking again
+    app.config['EVENT_STREAM_BUFFER'] = int(os.environ.get('EVENT_STREAM_BUFFER', 100)) #messages a live stream can fall behind before it is sent a reset
+    app.config['EVENT_STREAM_HEARTBEAT'] = int(os.environ.get('EVENT_STREAM_HEARTBEAT', 15)) #seconds between keep-alives on a quiet live stream
+    app.config['COMPRESSION'] = os.environ.get('COMPRESSION', 'br,gzip') #response encodings offered, best first (br needs brotli) | '' when a proxy compresses
+    app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024)) #bytes, smaller responses go out uncompressed
+    app.config.update(config or {})
+
+    connect_db(app)
+    migrate.init_app(app, db) #flask db upgrade | migrations/ holds the versioned schema changes
+    init_encoding(app) #orjson for app.json, gzip/brotli responses
+    init_query_stats(app) #Server-Timing header + query budget log
+    init_response_cache(app) #GET calendar/events responses, dropped by tag when a write commits
+    init_invalidation(app) #the tags a write commits are dropped from every worker's caches through LISTEN/NOTIFY
+    init_event_stream(app) #live event streams, fed by LISTEN/NOTIFY so writes in any worker reach them
+
+    app.register_error_handler(HashingBusy, hashing_busy) #503 when every password hashing slot is taken
+    app.register_blueprint(pages)
+    app.register_blueprint(api_users) #registering the API blueprints
+    app.register_blueprint(api_events)
+    app.register_blueprint(api_calendars)
+    app.register_blueprint(api_freebusy)
+    app.register_blueprint(api_jobs)
+
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(worker_command) #flask worker | runs the jobs queued by the 202 routes
+
+    if app.debug and app.config.get('DEBUG_TB_ENABLED', True):
+        from flask_debugtoolbar import DebugToolbarExtension #dev only, so production workers never import it
+        DebugToolbarExtension(app)
+
+    return app
+
+
+@click.command('init-db')
+@click.option('--drop', is_flag=True, help='Drop all the tables first')
+def init_db_command(drop):
+    '''Create the database tables for a new database and mark it as migrated | existing databases use `flask db upgrade`'''
+
+    if drop:
+        db.drop_all()
+    db.create_all()
+    stamp() #the tables already match the latest migration
+    click.echo('Database tables created')
+
+
+@pages.before_app_request
 def add_user_to_g():
-    '''If we're logged in, add current user to Flask global (g)'''
+    '''If we're logged in, add current user to Flask global (g)
+    | static files and API routes (unless marked with @uses_current_user) skip the lookup, everything else gets the cached user'''
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    view = current_app.view_functions.get(request.endpoint)
+    if view is None or request.endpoint == 'static' or (request.blueprint not in (None, 'pages') and not getattr(view, 'uses_current_user', False)):
+        g.user = None
+    elif CURR_USER_KEY in session:
+        g.user = get_user(session[CURR_USER_KEY])
     else:
         g.user = None
 
@@ -54,7 +122,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/')
+@pages.route('/')
 def index():
     return redirect('/login')
 
@@ -62,7 +130,7 @@ def index():
 #       REGISTER/LOGIN/LOGOUT ROUTES       #
 ############################################
 
-@app.route('/register', methods=['GET', 'POST'])
+@pages.route('/register', methods=['GET', 'POST'])
 def register_user():
     '''Form for creating a new User'''
     
@@ -84,7 +152,7 @@ def register_user():
     return render_template('register.html', form=form)
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@pages.route('/login', methods=['GET', 'POST'])
 def login_user():
     '''Login form for User login'''
     
@@ -107,7 +175,7 @@ def login_user():
     return render_template('login.html', form=form)
 
 
-@app.route('/logout', methods=['POST']) #best practice is to make this a POST request due to 'pre-fetching' | some browsers pre fetch all get requests
+@pages.route('/logout', methods=['POST']) #best practice is to make this a POST request due to 'pre-fetching' | some browsers pre fetch all get requests
 def logout_user():
     '''Logs out User from session'''
     
@@ -120,7 +188,7 @@ def logout_user():
 #            USER ROUTES            #
 #####################################
 
-@app.route('/user/<int:user_id>')
+@pages.route('/user/<int:user_id>')
 def user_home(user_id):
     '''Shows homepage for User'''
     
@@ -135,12 +203,12 @@ def user_home(user_id):
           .order_by(Event.start_time)
           .limit(5)
           .all())
-    calendars = Calendar.query.filter(Calendar.owner_id == user_id).all()
+    calendars = user.calendars #already loaded with g.user, no second calendars query
     
     return render_template ('user/user_home.html', user=user, events=events, calendars=calendars)
         
 
-@app.route('/user/<int:user_id>/edit', methods=["GET", "POST"])
+@pages.route('/user/<int:user_id>/edit', methods=["GET", "POST"])
 def user_edit(user_id):
     
     if g.user is None or g.user.id != user_id:
@@ -167,7 +235,7 @@ def user_edit(user_id):
     
     return render_template('user/user_edit.html', form=form, user=user)
 
-@app.route('/user/<int:user_id>/delete', methods=["GET", "POST"])
+@pages.route('/user/<int:user_id>/delete', methods=["GET", "POST"])
 def user_delete(user_id):
     '''Delete a user'''
     
@@ -178,7 +246,7 @@ def user_delete(user_id):
             return redirect(f'/user/{user.id}')
     
     else:
-        db.session.delete(user)
+        remove_user(user.id) #their calendars and events go through ON DELETE CASCADE
         db.session.commit()
         do_logout() #remove user from session to avoid them being stuck there
         flash('User has been deleted', 'danger')
@@ -189,7 +257,17 @@ def user_delete(user_id):
 #            EVENT ROUTES            #
 ######################################
 
-@app.route('/event/create', methods=["GET", "POST"])
+def conflict_errors(calendar_id, start_time, end_time, exclude_id=None):
+    '''Error messages for the event form if the calendar rejects overlapping events and this one overlaps | empty list if it's fine'''
+    
+    calendar = db.session.get(Calendar, calendar_id, populate_existing=True) #not the cached copy from g.user.calendars
+    if calendar is None or not calendar.reject_conflicts:
+        return []
+    
+    conflicts = find_conflicts(calendar_id, start_time, end_time, exclude_id=exclude_id)
+    return [f'Overlaps "{event.title}" ({event.start_time:%Y-%m-%d %H:%M} - {event.end_time:%H:%M})' for event in conflicts]
+
+@pages.route('/event/create', methods=["GET", "POST"])
 def event_new():
     '''Create a new Event'''
     
@@ -206,14 +284,20 @@ def event_new():
         end_time = form.end_time.data
         all_day = form.all_day.data
         location = form.location.data
+        rrule = form.rrule.data
     
         calendar_id = form.calendar_id.data
         creator_id = g.user.id
     
         new_event = Event(title=title, description=description, start_time=start_time, end_time=end_time, all_day=all_day, location=location,
-                          calendar_id=calendar_id, creator_id=creator_id)
+                          rrule=rrule, calendar_id=calendar_id, creator_id=creator_id)
         
-        if new_event:
+        bump_calendar_version(calendar_id) #locks the calendar, an overlapping create at the same time waits for this one
+        conflicts = conflict_errors(calendar_id, start_time, end_time)
+        if conflicts:
+            db.session.rollback()
+            form.start_time.errors.extend(conflicts)
+        elif new_event:
             add_to_db(new_event)
             flash('New Event created!', 'success')
             return redirect(f'/user/{g.user.id}')
@@ -222,7 +306,7 @@ def event_new():
             
     return render_template ('event/event_new.html', form=form)
 
-@app.route('/event/<int:event_id>/edit', methods=["GET", "POST"])
+@pages.route('/event/<int:event_id>/edit', methods=["GET", "POST"])
 def event_edit(event_id):
     '''Edit a specific Calendar'''
     
@@ -234,12 +318,20 @@ def event_edit(event_id):
             return redirect(f'/user/{g.user.id}')
     
     if form.validate_on_submit():
+        bump_calendar_version(event.calendar_id) #locks the calendar before the conflict check and the update
+        conflicts = conflict_errors(event.calendar_id, form.start_time.data, form.end_time.data, exclude_id=event.id)
+        if conflicts:
+            db.session.rollback()
+            form.start_time.errors.extend(conflicts)
+            return render_template("event/event_edit.html", form=form, event=event)
+        
         event.title = form.title.data
         event.description = form.description.data
         event.start_time = form.start_time.data
         event.end_time = form.end_time.data
         event.all_day = form.all_day.data
         event.location = form.location.data
+        event.rrule = form.rrule.data
 
         db.session.commit()
 
@@ -247,7 +339,7 @@ def event_edit(event_id):
 
     return render_template("event/event_edit.html", form=form, event=event)
 
-@app.route('/event/<int:event_id>/delete', methods=["GET", "POST"])
+@pages.route('/event/<int:event_id>/delete', methods=["GET", "POST"])
 def event_delete(event_id):
     '''Delete an event'''
     
@@ -258,6 +350,7 @@ def event_delete(event_id):
             return redirect(f'/user/{g.user.id}')
     
     else:
+        bump_calendar_version(event.calendar_id)
         db.session.delete(event)
         db.session.commit()
         flash('Event has been deleted', 'danger')
@@ -269,7 +362,7 @@ def event_delete(event_id):
 #            CALENDAR ROUTES            #
 #########################################
 
-@app.route('/user/<int:user_id>/calendar/new', methods=["GET", "POST"])
+@pages.route('/user/<int:user_id>/calendar/new', methods=["GET", "POST"])
 def calendar_new(user_id):
     '''Create a new Calendar'''
     
@@ -279,9 +372,10 @@ def calendar_new(user_id):
         name = form.name.data
         description = form.description.data
         is_public = form.is_public.data
+        reject_conflicts = form.reject_conflicts.data
         owner_id = user_id
     
-        new_calendar = Calendar(name=name, description=description, is_public=is_public, owner_id=owner_id)
+        new_calendar = Calendar(name=name, description=description, is_public=is_public, reject_conflicts=reject_conflicts, owner_id=owner_id)
         
         if new_calendar:
             add_to_db(new_calendar)
@@ -293,7 +387,7 @@ def calendar_new(user_id):
     return render_template ('calendar/calendar_new.html', form=form)
 
 
-@app.route('/user/<int:user_id>/calendar/<int:cal_id>/edit', methods=["GET", "POST"])
+@pages.route('/user/<int:user_id>/calendar/<int:cal_id>/edit', methods=["GET", "POST"])
 def calendar_edit(user_id, cal_id):
     '''Edit a specific Calendar'''
     
@@ -308,6 +402,8 @@ def calendar_edit(user_id, cal_id):
         calendar.name = form.name.data
         calendar.description = form.description.data
         calendar.is_public = form.is_public.data
+        calendar.reject_conflicts = form.reject_conflicts.data
+        bump_calendar_version(calendar.id)
 
         db.session.commit()
 
@@ -316,7 +412,7 @@ def calendar_edit(user_id, cal_id):
     return render_template("calendar/calendar_edit.html", form=form, calendar=calendar)
 
 
-@app.route('/user/<int:user_id>/calendar/<int:cal_id>', methods=["GET", "POST"])
+@pages.route('/user/<int:user_id>/calendar/<int:cal_id>', methods=["GET", "POST"])
 def calendar_show(user_id, cal_id):
     '''Show user Calendar and Events'''
     
@@ -337,14 +433,20 @@ def calendar_show(user_id, cal_id):
         bg_color = form.bg_color.data
         txt_color = form.txt_color.data
         all_day = form.all_day.data
+        rrule = form.rrule.data
     
         calendar_id = cal_id
         creator_id = user_id
     
         new_event = Event(title=title, description=description, start_time=start_time, end_time=end_time, location=location, bg_color=bg_color, txt_color=txt_color,
-                        all_day=all_day, calendar_id=calendar_id, creator_id=creator_id)
+                        all_day=all_day, rrule=rrule, calendar_id=calendar_id, creator_id=creator_id)
         
-        if new_event:
+        bump_calendar_version(calendar_id) #locks the calendar, an overlapping create at the same time waits for this one
+        conflicts = conflict_errors(calendar_id, start_time, end_time)
+        if conflicts:
+            db.session.rollback()
+            form.start_time.errors.extend(conflicts)
+        elif new_event:
             add_to_db(new_event)
             return redirect(f'/user/{user_id}/calendar/{cal_id}')
         else:
@@ -352,7 +454,7 @@ def calendar_show(user_id, cal_id):
     
     return render_template('calendar/calendar_show.html', calendar=calendar, form=form)
 
-@app.route('/calendar/<int:cal_id>/delete', methods=["GET", "POST"])
+@pages.route('/calendar/<int:cal_id>/delete', methods=["GET", "POST"])
 def calendar_delete(cal_id):
     '''Delete a calendar'''
     
@@ -363,8 +465,12 @@ def calendar_delete(cal_id):
             return redirect(f'/user/{g.user.id}')
     
     else:
-        db.session.delete(calendar)
+        remove_calendar(calendar.id) #its events go through ON DELETE CASCADE
         db.session.commit()
+        remove_snapshots(current_app.config['FEED_DIR'], cal_id)
         flash('Calendar has been deleted', 'danger')
         
         return redirect(f"/user/{g.user.id}")
+
+
+app = create_app() #for `flask run`, gunicorn app:app and the tests
@@ -0,0 +1,74 @@
+# python -m benchmarks.bench_export
+#
+# Streams a power user's account export (200k events over 20 calendars) as NDJSON and as zipped CSV
+# and reports the time, the size and the peak Python memory (tracemalloc, on a second run as tracing slows it down).
+# The peak should stay about the same whatever EVENTS is, the rows are never all in memory.
+# Runs against BENCH_DATABASE_URL (default postgresql:///calendar-bench) | ALL TABLES IN IT GET DROPPED
+
+import os
+import time
+import tracemalloc
+
+os.environ['SUPABASE_URL'] = os.environ.get('BENCH_DATABASE_URL', 'postgresql:///calendar-bench')
+
+from sqlalchemy import text
+from app import app, CURR_USER_KEY
+from models import db
+
+EVENTS = 200_000
+CALENDARS = 20
+
+
+def seed():
+    '''One user with CALENDARS calendars and EVENTS events spread over them'''
+    db.session.execute(text("INSERT INTO users (email, password, f_name, l_name) VALUES ('power@email.com', 'bench', 'Power', 'User')"))
+    db.session.execute(text('''
+        INSERT INTO calendars (name, owner_id, created_at) SELECT 'Calendar ' || n, 1, now() FROM generate_series(1, :calendars) AS n
+    '''), {'calendars': CALENDARS})
+    db.session.execute(text('''
+        INSERT INTO events (title, description, start_time, end_time, location, calendar_id, creator_id, created_at)
+        SELECT 'Meeting ' || n, 'Agenda item ' || n, timestamp '2024-01-01' + n * interval '7 minutes',
+               timestamp '2024-01-01' + n * interval '7 minutes' + interval '1 hour', 'Room ' || (n % 40), n % :calendars + 1, 1, now()
+        FROM generate_series(1, :events) AS n
+    '''), {'calendars': CALENDARS, 'events': EVENTS})
+    db.session.commit()
+
+
+def export(client, format):
+    '''Stream the export, counting bytes as they arrive | returns (seconds, bytes)'''
+    start = time.perf_counter()
+    resp = client.get('/api/users/1/export', query_string={'format': format}, buffered=False)
+    size = sum(len(chunk) for chunk in resp.response)
+    return (time.perf_counter() - start, size)
+
+
+def export_peak(client, format):
+    '''Peak traced memory while streaming the export'''
+    tracemalloc.start()
+    export(client, format)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+if __name__ == '__main__':
+    app.config['SECRET_KEY'] = 'bench'
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        print(f'seeding {EVENTS} events...')
+        seed()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = 1
+
+            print(f"{'format':>8} {'s':>7} {'MB':>7} {'peak MB':>8}")
+            for format in ('ndjson', 'csv'):
+                seconds, size = export(client, format)
+                peak = export_peak(client, format)
+                print(f'{format:>8} {seconds:>7.2f} {size / 1e6:>7.1f} {peak / 1e6:>8.1f}')
+
+        db.session.remove()
+        db.drop_all()
@@ -0,0 +1,58 @@
+# python -m benchmarks.bench_freebusy
+#
+# Times /api/freebusy/slots for 50 users over a month, each with a year of
+# busy history (~8 events per working day).
+# Runs against BENCH_DATABASE_URL (default postgresql:///calendar-bench) | ALL TABLES IN IT GET DROPPED
+
+import os
+import time
+
+os.environ['SUPABASE_URL'] = os.environ.get('BENCH_DATABASE_URL', 'postgresql:///calendar-bench')
+
+from sqlalchemy import text
+from app import app
+from models import db
+
+USERS = 50
+RUNS = 5 #best of
+
+
+def seed():
+    '''USERS users with one calendar each and 8 half hour+ events a day for 2024'''
+    db.session.execute(text('''
+        INSERT INTO users (email, password, f_name, l_name)
+        SELECT 'user' || n || '@email.com', 'password', 'User', 'Number ' || n FROM generate_series(1, :users) AS n
+    '''), {'users': USERS})
+    db.session.execute(text('INSERT INTO calendars (name, owner_id) SELECT \'Work\', id FROM users'))
+    db.session.execute(text('''
+        INSERT INTO events (title, start_time, end_time, calendar_id, creator_id)
+        SELECT 'Meeting', day + (8 + slot) * interval '1 hour' + (calendars.id % 4) * interval '15 minutes',
+               day + (8 + slot) * interval '1 hour' + (calendars.id % 4 + 2) * interval '15 minutes', calendars.id, calendars.owner_id
+        FROM calendars, generate_series(timestamp '2024-01-01', timestamp '2024-12-31', interval '1 day') AS day, generate_series(0, 7) AS slot
+        WHERE (slot + calendars.id) % 3 <> 0
+    '''))
+    db.session.commit()
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed()
+
+        users = ','.join(str(id) for id in range(1, USERS + 1))
+        query = {'users': users, 'start': '2024-06-01', 'end': '2024-07-01', 'duration': 30, 'limit': 100}
+
+        with app.test_client() as client:
+            for url in ['/api/freebusy', '/api/freebusy/slots']:
+                times = []
+                for _ in range(RUNS):
+                    start = time.perf_counter()
+                    resp = client.get(url, query_string=query)
+                    times.append(time.perf_counter() - start)
+                    assert resp.status_code == 200, resp.json
+
+                print(f'{url:<22} {USERS} users, 1 month: {min(times) * 1000:.1f} ms ({len(resp.get_data())} bytes)')
+
+        db.session.remove()
+        db.drop_all()
@@ -0,0 +1,76 @@
+# python -m benchmarks.bench_import
+#
+# Times POST /api/calendars/<id>/import of a 20k event .ics export (the size onboarding users bring),
+# then the same import again (every UID already there), against one Event added and committed per row.
+# Runs against BENCH_DATABASE_URL (default postgresql:///calendar-bench) | ALL TABLES IN IT GET DROPPED
+
+import os
+import time
+from io import BytesIO
+from datetime import datetime, timedelta, timezone
+
+os.environ['SUPABASE_URL'] = os.environ.get('BENCH_DATABASE_URL', 'postgresql:///calendar-bench')
+
+from app import app
+from models import db, User, Calendar, Event, add_to_db
+from ics import iter_vevents, event_values
+
+EVENTS = 20_000
+ROW_AT_A_TIME = 2_000 #the per-row baseline is timed on this many and scaled up, the full run takes minutes
+
+
+def make_ics(events):
+    '''An export like other calendar tools make | every 10th event repeats weekly, all have a VALARM'''
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Bench//EN']
+    start = datetime(2024, 1, 1, 9)
+    for n in range(events):
+        event_start = start + timedelta(minutes=37 * n)
+        lines += ['BEGIN:VEVENT', f'UID:bench-{n}@other.tool', f'SUMMARY:Meeting {n}',
+                  f'DESCRIPTION:Agenda item {n}\\, notes to follow\\nRoom {n % 40}', f'LOCATION:Room {n % 40}',
+                  f'DTSTART:{event_start:%Y%m%dT%H%M%S}Z', f'DTEND:{event_start + timedelta(minutes=30):%Y%m%dT%H%M%S}Z',
+                  *(['RRULE:FREQ=WEEKLY;COUNT=10'] if n % 10 == 0 else []),
+                  'BEGIN:VALARM', 'TRIGGER:-PT10M', 'ACTION:DISPLAY', 'END:VALARM', 'END:VEVENT']
+    lines.append('END:VCALENDAR')
+    return ('\r\n'.join(lines) + '\r\n').encode()
+
+
+def row_at_a_time(ics, calendar_id, user_id, limit):
+    '''The old way: one Event through add_to_db (a commit) per VEVENT | returns seconds for limit events'''
+    start = time.perf_counter()
+    for n, vevent in enumerate(iter_vevents(BytesIO(ics))):
+        if n == limit:
+            break
+        values = event_values(vevent, timezone.utc)
+        values.pop('uid')
+        add_to_db(Event(**values, calendar_id=calendar_id, creator_id=user_id))
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        user = User(email='bench@email.com', password='bench', f_name='Bench', l_name='User')
+        db.session.add(user)
+        db.session.commit()
+        calendars = [Calendar(name=name, owner_id=user.id) for name in ('Imported', 'Row at a time')]
+        db.session.add_all(calendars)
+        db.session.commit()
+        calendar_ids = [calendar.id for calendar in calendars]
+        user_id = user.id
+
+        ics = make_ics(EVENTS)
+        print(f'{EVENTS} events, {len(ics) / 1024 / 1024:.1f} MB')
+
+        with app.test_client() as client:
+            for label in ('import', 're-import'):
+                start = time.perf_counter()
+                resp = client.post(f'/api/calendars/{calendar_ids[0]}/import', data=ics, content_type='text/calendar')
+                print(f'{label:>14}: {time.perf_counter() - start:6.2f} s  {resp.json}')
+
+        seconds = row_at_a_time(ics, calendar_ids[1], user_id, ROW_AT_A_TIME)
+        print(f'{"row at a time":>14}: {seconds * EVENTS / ROW_AT_A_TIME:6.2f} s  (estimated from {ROW_AT_A_TIME} rows)')
+
+        db.session.remove()
+        db.drop_all()
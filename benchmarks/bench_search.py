@@ -0,0 +1,73 @@
+# python -m benchmarks.bench_search
+#
+# Times /api/events/search against 1M events spread over 100 users' calendars.
+# Runs against BENCH_DATABASE_URL (default postgresql:///calendar-bench) | ALL TABLES IN IT GET DROPPED
+
+import os
+import time
+
+os.environ['SUPABASE_URL'] = os.environ.get('BENCH_DATABASE_URL', 'postgresql:///calendar-bench')
+
+from sqlalchemy import text
+from app import app, CURR_USER_KEY
+from models import db
+
+EVENTS = 1_000_000
+USERS = 100
+RUNS = 5 #best of
+QUERIES = ['dentist', 'team standup', '"quarterly review"', 'room 12 -lunch', 'zebra']
+
+
+def seed():
+    '''USERS users with one calendar each, EVENTS events with titles/descriptions/locations from small word lists
+    | list lengths don't divide USERS, so every calendar gets a bit of everything'''
+    db.session.execute(text('''
+        INSERT INTO users (email, password, f_name, l_name)
+        SELECT 'bench' || n || '@email.com', 'bench', 'Bench', 'User ' || n FROM generate_series(1, :users) AS n
+    '''), {'users': USERS})
+    db.session.execute(text('''
+        INSERT INTO calendars (name, owner_id) SELECT 'Calendar ' || id, id FROM users
+    '''))
+    db.session.execute(text('''
+        INSERT INTO events (title, description, start_time, end_time, location, calendar_id, creator_id)
+        SELECT (ARRAY['Dentist', 'Team standup', 'Lunch', 'Quarterly review', 'Gym', 'Flight', 'Doctor'])[n % 7 + 1] || ' ' || n,
+               (ARRAY['Teeth cleaning', 'Daily sync with the team', 'Numbers for the quarter'])[n % 3 + 1],
+               timestamp '2024-01-01' + n * interval '7 minutes', timestamp '2024-01-01' + n * interval '7 minutes' + interval '1 hour',
+               'Room ' || (n % 301), n % :users + 1, n % :users + 1
+        FROM generate_series(1, :events) AS n
+    '''), {'users': USERS, 'events': EVENTS})
+    db.session.commit()
+    db.session.execute(text('ANALYZE events'))
+    db.session.commit()
+
+
+def best_time(client, q):
+    '''Fastest of RUNS searches for q | returns (seconds, number of results on the first page)'''
+    times = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        resp = client.get('/api/events/search', query_string={'q': q})
+        times.append(time.perf_counter() - start)
+    return (min(times), len(resp.json['events']))
+
+
+if __name__ == '__main__':
+    app.config['SECRET_KEY'] = 'bench'
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        print(f'seeding {EVENTS} events...')
+        seed()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = 1
+
+            print(f"{'query':>20} {'ms':>8} {'results':>8}")
+            for q in QUERIES:
+                seconds, count = best_time(client, q)
+                print(f'{q:>20} {seconds * 1000:>8.1f} {count:>8}')
+
+        db.session.remove()
+        db.drop_all()
@@ -0,0 +1,52 @@
+# python -m benchmarks.bench_startup
+#
+# Cold start of a worker: imports the app in a fresh interpreter RUNS times and reports
+# the import time, the SQL statements and DB connections made while importing, and the first request.
+# Importing the app should make no SQL at all (schema is created with `flask init-db`, not at import).
+# Runs against BENCH_DATABASE_URL (default postgresql:///calendar-bench)
+
+import os
+import statistics
+import subprocess
+import sys
+
+RUNS = 7
+
+CHILD = '''
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+statements, connections = [], []
+event.listen(Engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+event.listen(Pool, 'connect', lambda *args: connections.append(1))
+
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+with app.app.test_client() as client:
+    client.get('/login')
+first_request = time.perf_counter()
+
+print(imported - start, first_request - imported, len(statements), len(connections))
+'''
+
+
+def cold_start():
+    '''Import the app in a new interpreter | returns (import seconds, first request seconds, statements, connections)'''
+    env = {**os.environ, 'SUPABASE_URL': os.environ.get('BENCH_DATABASE_URL', 'postgresql:///calendar-bench')}
+    output = subprocess.run([sys.executable, '-c', CHILD], env=env, check=True, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+    imported, first_request, statements, connections = output.split()
+    return (float(imported), float(first_request), int(statements), int(connections))
+
+
+if __name__ == '__main__':
+    runs = [cold_start() for _ in range(RUNS)]
+
+    print(f"{'import (ms)':>12} {'1st request (ms)':>17} {'statements':>11} {'connections':>12}")
+    print(f'{statistics.median(run[0] for run in runs) * 1000:>12.1f} {statistics.median(run[1] for run in runs) * 1000:>17.1f} '
+          f'{max(run[2] for run in runs):>11} {max(run[3] for run in runs):>12}')
+
+    assert max(run[2] for run in runs) == 0, 'importing the app ran SQL'
@@ -3,10 +3,16 @@ CREATE TABLE calendars (
     name character varying(100) NOT NULL,
     description text,
     is_public boolean,
+    reject_conflicts boolean DEFAULT false NOT NULL,
     created_at timestamp without time zone,
+    version integer DEFAULT 0 NOT NULL,
     owner_id integer NOT NULL
 );
 
+CREATE INDEX ix_calendars_owner_id ON calendars (owner_id);
+
+CREATE SEQUENCE event_change_seq;
+
 CREATE TABLE events (
     id integer NOT NULL,
     title character varying(50) NOT NULL,
@@ -17,11 +23,35 @@ CREATE TABLE events (
     bg_color character varying(7),
     txt_color character varying(7),
     all_day boolean,
+    rrule text,
+    series_end timestamp without time zone,
+    uid character varying(255),
+    search_vector tsvector GENERATED ALWAYS AS (setweight(to_tsvector('english', coalesce(title, '')), 'A') || setweight(to_tsvector('english', coalesce(description, '')), 'B') || setweight(to_tsvector('english', coalesce(location, '')), 'C')) STORED,
     created_at timestamp without time zone,
+    change_seq bigint DEFAULT nextval('event_change_seq') NOT NULL,
     calendar_id integer NOT NULL,
     creator_id integer NOT NULL
 );
 
+CREATE INDEX ix_events_calendar_time ON events (calendar_id, start_time, end_time);
+CREATE INDEX ix_events_creator_start ON events (creator_id, start_time);
+CREATE INDEX ix_events_calendar_change_seq ON events (calendar_id, change_seq);
+CREATE INDEX ix_events_search ON events USING gin (search_vector);
+CREATE UNIQUE INDEX ux_events_calendar_uid ON events (calendar_id, uid) WHERE uid IS NOT NULL;
+CREATE INDEX ix_events_calendar_series ON events (calendar_id, start_time) WHERE rrule IS NOT NULL;
+-- conflict checks: calendar_id as a one value range so it fits in the same GiST index as the time range (no btree_gist needed)
+CREATE INDEX ix_events_calendar_period ON events USING gist (int4range(calendar_id, calendar_id, '[]'), tsrange(start_time, end_time, '[)')) WHERE rrule IS NULL;
+
+CREATE TABLE event_tombstones (
+    id integer NOT NULL,
+    event_id integer NOT NULL,
+    change_seq bigint DEFAULT nextval('event_change_seq') NOT NULL,
+    deleted_at timestamp without time zone,
+    calendar_id integer NOT NULL REFERENCES calendars (id) ON DELETE CASCADE
+);
+
+CREATE INDEX ix_event_tombstones_calendar_change_seq ON event_tombstones (calendar_id, change_seq);
+
 CREATE TABLE users (
     id integer NOT NULL,
     email character varying(50) NOT NULL,
@@ -30,3 +60,37 @@ CREATE TABLE users (
     l_name character varying(40) NOT NULL,
     created_at timestamp without time zone
 );
+
+-- shared response cache (RESPONSE_CACHE=postgres) | UNLOGGED, it's only a cache so it skips the WAL
+CREATE UNLOGGED TABLE response_cache (
+    key text PRIMARY KEY,
+    body bytea NOT NULL,
+    headers jsonb NOT NULL,
+    tags text[] NOT NULL,
+    expires_at timestamp without time zone NOT NULL
+);
+
+CREATE INDEX ix_response_cache_tags ON response_cache USING gin (tags);
+CREATE INDEX ix_response_cache_expires_at ON response_cache (expires_at);
+
+-- deleting a user or calendar is a single DELETE, the database removes the rows under it
+ALTER TABLE calendars ADD CONSTRAINT calendars_owner_id_fkey FOREIGN KEY (owner_id) REFERENCES users (id) ON DELETE CASCADE;
+ALTER TABLE events ADD CONSTRAINT events_calendar_id_fkey FOREIGN KEY (calendar_id) REFERENCES calendars (id) ON DELETE CASCADE;
+ALTER TABLE events ADD CONSTRAINT events_creator_id_fkey FOREIGN KEY (creator_id) REFERENCES users (id) ON DELETE CASCADE;
+
+-- background jobs (jobs.py, `flask worker`) | run_at is when a queued job is due, or when a running job's lease runs out
+CREATE TABLE jobs (
+    id integer NOT NULL,
+    kind character varying(50) NOT NULL,
+    args jsonb DEFAULT '{}' NOT NULL,
+    status character varying(10) DEFAULT 'queued' NOT NULL,
+    attempts integer DEFAULT 0 NOT NULL,
+    max_attempts integer DEFAULT 5 NOT NULL,
+    run_at timestamp without time zone DEFAULT now() NOT NULL,
+    result jsonb,
+    error text,
+    created_at timestamp without time zone,
+    finished_at timestamp without time zone
+);
+
+CREATE INDEX ix_jobs_due ON jobs (run_at) WHERE status IN ('queued', 'running');
@@ -0,0 +1,155 @@
+from datetime import date
+import gzip
+import zlib
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson #optional | pip install orjson, the stdlib json module is used without it
+except ImportError:
+    orjson = None
+
+try:
+    import brotli #in requirements.txt | an install without it only gzips responses
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack #in requirements.txt | an install without it serves the feeds as JSON only
+except ImportError:
+    msgpack = None
+
+DEFAULT_COMPRESSION = 'br,gzip' #encodings offered, best first | COMPRESSION in the config, '' leaves it to the proxy
+DEFAULT_COMPRESS_MIN_SIZE = 1024 #bytes, smaller bodies aren't worth the CPU | COMPRESS_MIN_SIZE in the config
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5 #most of what 11 saves on JSON, at a speed fit for every request
+COMPRESSIBLE_TYPES = {'application/json', 'application/x-ndjson', 'application/msgpack', 'text/html', 'text/css',
+                      'text/javascript', 'text/calendar', 'text/csv', 'text/plain'} #live streams (text/event-stream) and zips are never compressed
+MSGPACK_MIMETYPE = 'application/msgpack'
+MSGPACK_MIMETYPES = [MSGPACK_MIMETYPE, 'application/x-msgpack'] #what clients send in Accept
+ORJSON_OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS if orjson is not None else 0 #same output as the stdlib with sort_keys
+
+
+def iso_default(value):
+    '''Dates/datetimes as ISO 8601, like the event feeds | everything else the way Flask does it'''
+
+    if isinstance(value, date):
+        return value.isoformat()
+    return DefaultJSONProvider.default(value)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    '''app.json through orjson when it's installed, the stdlib json module otherwise | datetimes come out as ISO 8601
+    either way (orjson writes them natively), so User/Calendar/Job created_at look the same whatever is installed
+    | compact with sorted keys and raw UTF-8 either way, so ETagged and cached bodies don't change with the encoder'''
+
+    default = staticmethod(iso_default)
+    ensure_ascii = False #orjson never escapes non-ASCII, the stdlib fallback mustn't either
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs: #indent= and the other stdlib json options
+            return super().dumps(obj, **{'separators': (',', ':'), **kwargs})
+        return orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None or (self.compact is None and self._app.debug) or self.compact is False: #indented, for reading in the browser
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE) #bytes, never a str in between
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def wants_msgpack():
+    '''True if the client asked for MessagePack (Accept: application/msgpack) over JSON and msgpack is installed
+    | */* and no Accept header get JSON'''
+
+    if msgpack is None:
+        return False
+    return request.accept_mimetypes.best_match(['application/json'] + MSGPACK_MIMETYPES) in MSGPACK_MIMETYPES
+
+
+def msgpack_dumps(data):
+    '''MessagePack bytes, with datetimes as ISO 8601 strings like the JSON'''
+
+    return msgpack.packb(data, default=iso_default)
+
+
+def offered_encodings(config):
+    '''The COMPRESSION encodings this process can actually make | br needs brotli'''
+
+    encodings = [encoding.strip() for encoding in config.get('COMPRESSION', DEFAULT_COMPRESSION).split(',')]
+    return [encoding for encoding in encodings if encoding == 'gzip' or (encoding == 'br' and brotli is not None)]
+
+
+def compress_body(body, encoding):
+    '''A whole body compressed with encoding'''
+
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, GZIP_LEVEL, mtime=0) #no timestamp, the same body always compresses to the same bytes
+
+
+def compress_stream(original, chunks, encoding):
+    '''Generator compressing the bytes chunks of a streamed body | each chunk is flushed, so the client gets the rows
+    as they are made rather than when the stream ends | closing it closes the original stream (cursors, app context)'''
+
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS) #16+ writes the gzip header/trailer
+        compress, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+    try:
+        for chunk in chunks:
+            if chunk:
+                yield compress(chunk) + flush()
+        yield finish()
+    finally:
+        if hasattr(original, 'close'):
+            original.close()
+
+
+def compress_response(response, encodings, min_size):
+    '''Compress a response with the best of encodings the client accepts (Accept-Encoding) | bodies under min_size,
+    files (send_file), non-text types and responses that already have an encoding are left alone
+    | a strong ETag turns weak, the compressed bytes differ but it's still the same version'''
+
+    if (response.status_code != 200 or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, response.iter_encoded(), encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < min_size:
+            return response
+        response.set_data(compress_body(body, encoding))
+
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_encoding(app):
+    '''orjson for app.json (jsonify, the NDJSON streams and exports) and gzip/brotli for the responses'''
+
+    app.json = FastJSONProvider(app)
+
+    encodings = offered_encodings(app.config)
+    min_size = app.config.get('COMPRESS_MIN_SIZE', DEFAULT_COMPRESS_MIN_SIZE)
+    if encodings:
+        app.after_request(lambda response: compress_response(response, encodings, min_size))
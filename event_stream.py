@@ -0,0 +1,143 @@
+from collections import deque
+import json
+import threading
+from models import Event, EVENT_CHANGES_CHANNEL
+from listener import get_listener
+
+DEFAULT_BUFFER_SIZE = 100 #messages a stream can fall behind before they are swapped for one reset | EVENT_STREAM_BUFFER in the config
+DEFAULT_HEARTBEAT = 15 #seconds between keep-alive comments on a quiet stream | EVENT_STREAM_HEARTBEAT in the config
+RETRY_MS = 3000 #how long browsers wait before reconnecting a dropped stream
+
+
+def sse_message(kind, data):
+    '''One Server-Sent Events message | the browser's EventSource fires it as an event named kind'''
+
+    return f'event: {kind}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+
+RESET = sse_message('reset', {}) #the stream may have missed changes, refetch everything
+
+
+class Subscriber:
+    '''One open stream | a bounded buffer the hub fills and the response drains'''
+
+    def __init__(self, calendar_id, size=DEFAULT_BUFFER_SIZE):
+        self.calendar_id = calendar_id
+        self.size = size
+        self.messages = deque()
+        self.ready = threading.Condition()
+
+    def put(self, message):
+        '''Queue a message | a stream that is size messages behind (a slow client) gets one reset instead of all of them'''
+        with self.ready:
+            if len(self.messages) >= self.size:
+                self.messages.clear()
+                message = RESET
+            self.messages.append(message)
+            self.ready.notify()
+
+    def take(self, timeout):
+        '''Everything queued, waiting up to timeout seconds for something to arrive | [] if nothing did'''
+        with self.ready:
+            if not self.messages:
+                self.ready.wait(timeout)
+            messages = list(self.messages)
+            self.messages.clear()
+        return messages
+
+
+class ChangeHub:
+    '''Fans the NOTIFYs models.notify_calendars() sends out to the streams open in this process
+    | NOTIFYs come through the process's Listener, which the first stream starts
+    | every gunicorn worker has its own hub and Postgres delivers each NOTIFY to all of them, so a write in one
+    worker reaches the streams in every other | each stream holds a thread, run gunicorn with -k gthread --threads N'''
+
+    def __init__(self, listener, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.listener = listener
+        self.buffer_size = buffer_size
+        self.subscribers = {} #calendar_id -> set of Subscriber
+        self.lock = threading.Lock()
+        listener.on(EVENT_CHANGES_CHANNEL, self.dispatch, on_reconnect=self.reset_all)
+
+    def subscribe(self, calendar_id):
+        '''A Subscriber for the calendar | starts the listener if it isn't running'''
+        subscriber = Subscriber(calendar_id, self.buffer_size)
+        with self.lock:
+            self.subscribers.setdefault(calendar_id, set()).add(subscriber)
+        self.listener.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            subscribers = self.subscribers.get(subscriber.calendar_id, set())
+            subscribers.discard(subscriber)
+            if not subscribers:
+                self.subscribers.pop(subscriber.calendar_id, None)
+
+    def publish(self, calendar_id, message):
+        with self.lock:
+            subscribers = list(self.subscribers.get(calendar_id, ()))
+        for subscriber in subscribers:
+            subscriber.put(message)
+
+    def reset_all(self):
+        '''The listener reconnected, every stream may have missed changes'''
+        with self.lock:
+            calendar_ids = list(self.subscribers)
+        for calendar_id in calendar_ids:
+            self.publish(calendar_id, RESET)
+
+    def dispatch(self, payload):
+        '''Turn a change into a message for the calendar's streams | created/updated events are loaded once per process,
+        in the fullcalendar format, however many streams are open'''
+        change = json.loads(payload)
+        calendar_id = change['calendar_id']
+        with self.lock:
+            if calendar_id not in self.subscribers:
+                return
+
+        action = change['action']
+        if action in ('created', 'updated'):
+            try:
+                events = self.load_events(calendar_id, change['ids'])
+            except Exception:
+                self.listener.app.logger.exception('Event stream hub could not load events %s', change['ids'])
+                self.publish(calendar_id, RESET)
+                return
+            if events:
+                self.publish(calendar_id, sse_message(action, {'events': events}))
+        elif action == 'deleted':
+            self.publish(calendar_id, sse_message(action, {'ids': change['ids']}))
+        else:
+            self.publish(calendar_id, sse_message(action, {}))
+
+    def load_events(self, calendar_id, ids):
+        '''Feed rows ready for FullCalendar | recurring ones are flagged, the client refetches to expand them'''
+        rows = (Event.feed_query('fullcalendar')
+                .add_columns(Event.rrule.isnot(None).label('recurring'))
+                .filter(Event.calendar_id == calendar_id, Event.id.in_(ids))
+                .all())
+        return [row._asdict() for row in rows]
+
+
+def init_event_stream(app):
+    '''The hub for this app's live event streams | nothing connects until the first stream opens'''
+
+    app.extensions['event_stream'] = ChangeHub(get_listener(app), app.config.get('EVENT_STREAM_BUFFER', DEFAULT_BUFFER_SIZE))
+
+
+def event_stream(hub, calendar_id, heartbeat=DEFAULT_HEARTBEAT):
+    '''Generator of a calendar's Server-Sent Events: created, updated (the events), deleted (their ids),
+    reset (refetch everything) and calendar_deleted (the stream ends) | a comment goes out on a quiet stream
+    every heartbeat seconds, so proxies keep it open and a closed tab is noticed'''
+
+    subscriber = hub.subscribe(calendar_id)
+    try:
+        yield f'retry: {RETRY_MS}\n\n'
+        while True:
+            messages = subscriber.take(heartbeat)
+            yield ''.join(messages) if messages else ': keep-alive\n\n'
+            if any(message.startswith('event: calendar_deleted') for message in messages):
+                return
+    finally:
+        hub.unsubscribe(subscriber)
@@ -0,0 +1,91 @@
+import csv
+import io
+import zipfile
+from datetime import datetime
+from flask import current_app
+from models import db, Calendar, Event
+
+EXPORT_BATCH_SIZE = 1000 #rows pulled from each server-side cursor at a time, and rows per chunk sent
+
+
+def account_sections(user):
+    '''(name, query, serialize) for each part of a user's export, in the order they are written
+    | events are the ones in their calendars plus the ones they made in other people's calendars'''
+
+    own_calendars = db.select(Calendar.id).where(Calendar.owner_id == user.id)
+    return [
+        ('user', [user], lambda row: row.serialize()),
+        ('calendars', Calendar.query.filter(Calendar.owner_id == user.id).order_by(Calendar.id), lambda row: row.serialize()),
+        ('events', Event.query.filter(db.or_(Event.calendar_id.in_(own_calendars), Event.creator_id == user.id)).order_by(Event.id),
+         lambda row: row.serialize()),
+    ]
+
+
+def section_rows(query):
+    '''Rows of a section | queries come from a server-side cursor EXPORT_BATCH_SIZE at a time, never all at once'''
+
+    return query if isinstance(query, list) else query.yield_per(EXPORT_BATCH_SIZE)
+
+
+def ndjson_chunks(user):
+    '''Generator of a user's export as newline delimited JSON, EXPORT_BATCH_SIZE lines per chunk
+    | every line has a "type" (user, calendar or event) followed by the same keys as the API returns'''
+
+    for name, query, serialize in account_sections(user):
+        kind = name.rstrip('s')
+        lines = []
+        for row in section_rows(query):
+            lines.append(current_app.json.dumps({'type': kind, **serialize(row)}))
+            if len(lines) == EXPORT_BATCH_SIZE:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+
+class ZipOutput(io.RawIOBase):
+    '''Write-only file for zipfile that hands back what has been written so far with take()
+    | not seekable, so zipfile writes sizes after each file's data instead of going back to fill them in'''
+
+    def __init__(self):
+        self.written = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.written.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self.written)
+        self.written.clear()
+        return data
+
+
+def csv_cell(value):
+    '''Datetimes as ISO 8601, everything else as csv writes it'''
+
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def csv_zip_chunks(user):
+    '''Generator of a user's export as a zip of user.csv, calendars.csv and events.csv, built as it is sent
+    | a chunk goes out every EXPORT_BATCH_SIZE rows, so only one batch of rows (and its compressed bytes) is ever held'''
+
+    output = ZipOutput()
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED) as bundle:
+        for name, query, serialize in account_sections(user):
+            with io.TextIOWrapper(bundle.open(f'{name}.csv', 'w', force_zip64=True), encoding='utf-8', newline='') as file:
+                writer = None
+                for count, row in enumerate(section_rows(query), 1):
+                    values = {key: csv_cell(value) for key, value in serialize(row).items()}
+                    if writer is None:
+                        writer = csv.DictWriter(file, fieldnames=list(values))
+                        writer.writeheader()
+                    writer.writerow(values)
+                    if count % EXPORT_BATCH_SIZE == 0:
+                        file.flush()
+                        yield output.take()
+            yield output.take()
+    yield output.take()
@@ -20,6 +20,14 @@ TXT_COLORS =[
     ('#808080', 'Gray'),
     ('#000000', 'Black'),
 ]
+REPEATS = [
+    ('', 'Does not repeat'),
+    ('FREQ=DAILY', 'Daily'),
+    ('FREQ=WEEKLY', 'Weekly'),
+    ('FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR', 'Every weekday'),
+    ('FREQ=MONTHLY', 'Monthly'),
+    ('FREQ=YEARLY', 'Yearly'),
+]
 
 class RegisterForm(FlaskForm):
     '''Form for registering a user'''
@@ -46,6 +54,7 @@ class EventForm(FlaskForm):
     bg_color = SelectField('Background Color', choices = BG_COLORS, default='#e1e1e1')
     txt_color = SelectField('Text Color', choices = TXT_COLORS, default='#000000')
     all_day = BooleanField('All Day')
+    rrule = SelectField('Recurring', choices = REPEATS, default='')
         
 class CalendarForm(FlaskForm):
     '''Form for creating calendars'''
@@ -53,6 +62,7 @@ class CalendarForm(FlaskForm):
     name = StringField('Name', validators=[InputRequired()])
     description = StringField('Description', validators=[InputRequired()])
     is_public = BooleanField('Public?')
+    reject_conflicts = BooleanField('No overlapping events?')
 
 class EditUserForm(FlaskForm):
     '''Form for editing a user'''
@@ -0,0 +1,92 @@
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from models import db, Event, Calendar
+from recurrence import expand_window
+
+EPOCH = datetime(1970, 1, 1) #event times are naive, so they are turned into seconds from this instead of .timestamp()
+
+
+def to_seconds(time):
+    '''Naive datetime -> seconds since EPOCH'''
+
+    return (time - EPOCH).total_seconds()
+
+
+def from_seconds(seconds):
+    '''Seconds since EPOCH -> naive datetime'''
+
+    return EPOCH + timedelta(seconds=seconds)
+
+
+def busy_times(user_ids, start, end):
+    '''Sorted arrays (starts, ends) in seconds of every event in a calendar owned by one of the users that overlaps start-end
+    | recurring series are expanded inside the window'''
+
+    epoch = lambda column: db.cast(db.extract('epoch', column), db.Float)
+    owned = Event.calendar_id.in_(db.select(Calendar.id).where(Calendar.owner_id.in_(user_ids)))
+
+    rows = db.session.execute(
+        db.select(epoch(Event.start_time), epoch(Event.end_time))
+        .where(owned, Event.rrule.is_(None), Event.start_time < end, Event.end_time > start)
+        .order_by(Event.start_time)
+    ).all()
+    series = db.session.execute(
+        db.select(Event.rrule, Event.start_time, Event.end_time)
+        .where(owned, Event.rrule.isnot(None), Event.start_time < end, db.or_(Event.series_end.is_(None), Event.series_end > start))
+    ).all()
+
+    if series:
+        occurrences = [(to_seconds(occurrence_start), to_seconds(occurrence_end))
+                       for rrule, start_time, end_time in series
+                       for occurrence_start, occurrence_end in expand_window(rrule, start_time, end_time, start, end)]
+        rows = sorted([tuple(row) for row in rows] + occurrences)
+
+    return (array('d', [row[0] for row in rows]), array('d', [row[1] for row in rows]))
+
+
+def merge_intervals(starts, ends):
+    '''Sweep over intervals sorted by start and merge the ones that overlap or touch
+    | returns (starts, ends) arrays of disjoint intervals, still sorted'''
+
+    merged_starts, merged_ends = array('d'), array('d')
+
+    for start, end in zip(starts, ends):
+        if merged_ends and start <= merged_ends[-1]:
+            if end > merged_ends[-1]:
+                merged_ends[-1] = end
+        else:
+            merged_starts.append(start)
+            merged_ends.append(end)
+
+    return (merged_starts, merged_ends)
+
+
+def free_slots(busy_starts, busy_ends, start, end, duration, day_start, day_end, weekends=False, limit=10):
+    '''Gaps of at least duration seconds between merged busy intervals, only within working hours
+    | start/end are datetimes, day_start/day_end are timedeltas from midnight | returns a list of (start, end) in seconds'''
+
+    slots = []
+    day = datetime.combine(start.date(), datetime.min.time())
+
+    while day < end and len(slots) < limit:
+        if weekends or day.weekday() < 5:
+            window_start = to_seconds(max(day + day_start, start))
+            window_end = to_seconds(min(day + day_end, end))
+
+            #skip the busy intervals that are over before the working day starts
+            i = bisect_right(busy_ends, window_start)
+            cursor = window_start
+
+            while i < len(busy_starts) and busy_starts[i] < window_end and len(slots) < limit:
+                if busy_starts[i] - cursor >= duration:
+                    slots.append((cursor, busy_starts[i]))
+                cursor = max(cursor, busy_ends[i])
+                i += 1
+
+            if window_end - cursor >= duration and len(slots) < limit:
+                slots.append((cursor, window_end))
+
+        day += timedelta(days=1)
+
+    return slots
@@ -0,0 +1,370 @@
+import glob
+import os
+import re
+import tempfile
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from sqlalchemy.dialects.postgresql import insert
+from models import db, Event, Calendar, PendingEvents, bump_calendar_version, find_conflicts, notify_calendars
+from recurrence import check_rrule, series_end
+
+IMPORT_BATCH_SIZE = 2000 #events sent to Postgres at a time
+READ_SIZE = 64 * 1024 #bytes read from the upload at a time
+MAX_LINE_LENGTH = 1024 * 1024 #longest unfolded line accepted (bytes) | a bigger one means the file is broken (or hostile)
+NO_TITLE = '(No title)'
+EXPORT_BATCH_SIZE = 1000 #events pulled from the server-side cursor at a time when writing a feed
+WRITE_SIZE = 64 * 1024 #feed bytes gathered before they are sent/written
+MAX_OCTETS = 75 #longest line in an ICS file, longer ones are folded
+
+DURATION = re.compile(r'^([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+UNTIL = re.compile(r'UNTIL=(\d{8}T\d{6})Z', re.IGNORECASE)
+SNAPSHOT_VERSION = re.compile(r'-v(\d+)\.ics$') #calendar-5-v12.ics -> 12
+
+
+class ICSError(ValueError):
+    '''The upload isn't an iCalendar file we can read'''
+
+
+def read_lines(stream):
+    '''Generator of the physical lines of a binary stream, read READ_SIZE bytes at a time
+    | iterating a request stream directly reads it a byte at a time'''
+
+    rest = b''
+    while chunk := stream.read(READ_SIZE):
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        if len(rest) > MAX_LINE_LENGTH:
+            raise ICSError('Line too long')
+        yield from lines
+    if rest:
+        yield rest
+
+
+def unfold_lines(stream):
+    '''Generator of the logical lines of an ICS file read from a binary stream
+    | lines starting with a space/tab continue the one before (RFC 5545 folding), they are joined before decoding
+    so a multi-byte character split across the fold survives'''
+
+    current = None
+    for raw in read_lines(stream):
+        raw = raw.rstrip(b'\r')
+        if raw[:1] in (b' ', b'\t') and current is not None:
+            current += raw[1:]
+            if len(current) > MAX_LINE_LENGTH:
+                raise ICSError('Line too long')
+            continue
+        if current is not None:
+            yield current.decode('utf-8', errors='replace')
+        current = raw
+    if current:
+        yield current.decode('utf-8', errors='replace')
+
+
+def parse_line(line):
+    '''DTSTART;TZID="America/New_York":20241023T120000 -> ('DTSTART', {'TZID': 'America/New_York'}, '20241023T120000')
+    | the value starts at the first colon outside a quoted parameter'''
+
+    index = line.find(':')
+    if '"' in line[:index]: #a quoted parameter can have colons in it, find the first one outside quotes
+        in_quotes = False
+        for index, char in enumerate(line):
+            if char == '"':
+                in_quotes = not in_quotes
+            elif char == ':' and not in_quotes:
+                break
+        else:
+            index = -1
+    if index == -1:
+        raise ICSError(f'Not a content line: {line[:40]}')
+
+    name, *params = line[:index].split(';')
+    params = dict(param.split('=', 1) if '=' in param else (param, '') for param in params)
+    return (name.upper(), {key.upper(): value.strip('"') for key, value in params.items()}, line[index + 1:])
+
+
+def iter_vevents(stream):
+    '''Generator of the VEVENTs in an ICS stream, each a dict of property name -> (params, value) (first one wins)
+    | only one event is held in memory at a time | components nested inside a VEVENT (VALARM) are skipped'''
+
+    vevent = None
+    nested = 0
+    started = False
+    for line in unfold_lines(stream):
+        line = line.lstrip('\ufeff') if not started else line
+        if not line.strip():
+            continue
+        name, params, value = parse_line(line)
+        if not started:
+            if (name, value.upper()) != ('BEGIN', 'VCALENDAR'):
+                raise ICSError('Not an iCalendar file (it should start with BEGIN:VCALENDAR)')
+            started = True
+
+        if name == 'BEGIN':
+            if value.upper() == 'VEVENT' and vevent is None:
+                vevent = {}
+            elif vevent is not None:
+                nested += 1
+        elif name == 'END' and vevent is not None:
+            if nested:
+                nested -= 1
+            elif value.upper() == 'VEVENT':
+                yield vevent
+                vevent = None
+        elif vevent is not None and not nested:
+            vevent.setdefault(name, (params, value))
+
+
+def unescape_text(value):
+    '''TEXT values escape \\, ; , and newlines with a backslash'''
+
+    return re.sub(r'\\([\\;,nN])', lambda match: '\n' if match.group(1) in 'nN' else match.group(1), value)
+
+
+def parse_ics_time(params, value, tz):
+    '''DATE or DATE-TIME property -> (naive datetime in tz, all_day)
+    | UTC (Z) and TZID times are converted to tz, floating times (no zone, or a TZID Python doesn't know) are kept as they are'''
+
+    value = value.strip()
+    if params.get('VALUE', '').upper() == 'DATE' or len(value) == 8:
+        return (datetime(int(value[0:4]), int(value[4:6]), int(value[6:8])), True)
+
+    if len(value) < 15 or value[8] not in 'Tt':
+        raise ValueError(f'Invalid date-time: {value}')
+    time = datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]), int(value[9:11]), int(value[11:13]), int(value[13:15]))
+    if value[-1:] in 'Zz':
+        time = time.replace(tzinfo=timezone.utc)
+    elif 'TZID' in params:
+        try:
+            time = time.replace(tzinfo=ZoneInfo(params['TZID']))
+        except (ZoneInfoNotFoundError, ValueError):
+            pass
+    if time.tzinfo is not None:
+        time = time.astimezone(tz).replace(tzinfo=None)
+    return (time, False)
+
+
+def parse_duration(value):
+    '''ISO 8601 duration (P1D, PT1H30M, -P1W) -> timedelta'''
+
+    match = DURATION.match(value.strip())
+    if not match:
+        raise ValueError(f'Invalid duration: {value}')
+    sign, weeks, days, hours, minutes, seconds = match.groups()
+    duration = timedelta(weeks=int(weeks or 0), days=int(days or 0), hours=int(hours or 0), minutes=int(minutes or 0), seconds=int(seconds or 0))
+    return -duration if sign == '-' else duration
+
+
+def import_rrule(value, start_time, tz):
+    '''RRULE as stored on Event | None if dateutil can't read it or it's past the limits of check_rrule (the event is imported once)
+    | the series repeats at the same wall clock time in tz, so a UTC UNTIL becomes the end of its day in tz
+    (the exact instant would drop the last occurrence when a DST change falls inside the series)'''
+
+    rrule = UNTIL.sub(lambda match: 'UNTIL=' + datetime.strptime(match.group(1), '%Y%m%dT%H%M%S')
+                      .replace(tzinfo=timezone.utc).astimezone(tz).strftime('%Y%m%dT235959'), value.strip())
+    try:
+        check_rrule(rrule, start_time)
+    except ValueError:
+        return None
+    return rrule
+
+
+def event_values(vevent, tz):
+    '''Column values (plus uid) for an Event from a parsed VEVENT
+    | raises ValueError for VEVENTs that can't be imported (no start, cancelled, changes to one occurrence of a series)'''
+
+    if 'DTSTART' not in vevent:
+        raise ValueError('No DTSTART')
+    if vevent.get('STATUS', ({}, ''))[1].upper() == 'CANCELLED':
+        raise ValueError('Cancelled')
+    if 'RECURRENCE-ID' in vevent:
+        raise ValueError('Changes to one occurrence of a series are not supported')
+
+    start_time, all_day = parse_ics_time(*vevent['DTSTART'], tz)
+    if 'DTEND' in vevent:
+        end_time = parse_ics_time(*vevent['DTEND'], tz)[0]
+    elif 'DURATION' in vevent:
+        end_time = start_time + parse_duration(vevent['DURATION'][1])
+    else:
+        end_time = start_time + timedelta(days=1) if all_day else start_time
+    end_time = max(end_time, start_time)
+
+    rrule = import_rrule(vevent['RRULE'][1], start_time, tz) if 'RRULE' in vevent else None
+    text = lambda name: unescape_text(vevent[name][1]).strip() if name in vevent else None
+
+    return {
+        'uid': (text('UID') or '')[:255] or None,
+        'title': (text('SUMMARY') or NO_TITLE)[:50],
+        'description': text('DESCRIPTION') or None,
+        'location': (text('LOCATION') or '')[:100] or None,
+        'start_time': start_time,
+        'end_time': end_time,
+        'all_day': all_day,
+        'rrule': rrule,
+        'series_end': series_end(rrule, start_time, end_time) if rrule else None,
+    }
+
+
+def import_events(stream, calendar_id, creator_id, tz=timezone.utc):
+    '''Stream an ICS file into a calendar, IMPORT_BATCH_SIZE events per INSERT | returns counts for the response
+    | events whose UID is already in the calendar (an earlier import, or twice in the file) are skipped
+    | in a calendar that rejects conflicts, events overlapping one already there (or earlier in the file) are skipped too
+    | doesn't commit, so the caller decides whether a half read file keeps what was imported
+    | Core executemany, not the ORM: SQLAlchemy sends each batch as multi-row INSERTs from one cached statement'''
+
+    calendar = db.session.get(Calendar, calendar_id)
+    bump_calendar_version(calendar_id) #before the conflict checks and before the inserts take their change_seq
+    counts = {'imported': 0, 'duplicates': 0, 'conflicts': 0, 'skipped': 0}
+    pending = PendingEvents() #what find_conflicts can't see yet, so the file's own events can't overlap each other
+    batch = []
+    imported_ids = []
+    statement = (insert(Event.__table__)
+                 .on_conflict_do_nothing(index_elements=['calendar_id', 'uid'], index_where=Event.uid.isnot(None))
+                 .returning(Event.__table__.c.id))
+
+    def flush():
+        inserted = db.session.scalars(statement, batch).all()
+        imported_ids.extend(inserted)
+        counts['imported'] += len(inserted)
+        counts['duplicates'] += len(batch) - len(inserted)
+        batch.clear()
+
+    for vevent in iter_vevents(stream):
+        try:
+            values = event_values(vevent, tz)
+        except ValueError:
+            counts['skipped'] += 1
+            continue
+        if calendar.reject_conflicts:
+            if pending.overlaps(values['start_time'], values['end_time']) or find_conflicts(calendar_id, values['start_time'], values['end_time']):
+                counts['conflicts'] += 1
+                continue
+            pending.add(values['start_time'], values['end_time'], values['rrule'])
+
+        batch.append({**values, 'calendar_id': calendar_id, 'creator_id': creator_id, 'created_at': datetime.now(timezone.utc)})
+        if len(batch) == IMPORT_BATCH_SIZE:
+            flush()
+    if batch:
+        flush()
+
+    if counts['imported']:
+        notify_calendars([(calendar_id, 'created', imported_ids)]) #a big import is a reset, the streams refetch
+    return counts
+
+
+############################################
+#                  EXPORT                  #
+############################################
+
+def escape_text(value):
+    '''Backslash escape a TEXT value (the reverse of unescape_text)'''
+
+    return value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def fold(line):
+    '''Encode a content line, folded into CRLF + space continued lines of at most MAX_OCTETS bytes
+    | never splits a multi-byte character'''
+
+    encoded = line.encode('utf-8')
+    if len(encoded) <= MAX_OCTETS:
+        return encoded + b'\r\n'
+
+    parts = []
+    limit = MAX_OCTETS
+    while len(encoded) > limit:
+        cut = limit
+        while encoded[cut] & 0xC0 == 0x80: #continuation byte, back up to the start of the character
+            cut -= 1
+        parts.append(encoded[:cut])
+        encoded = encoded[cut:]
+        limit = MAX_OCTETS - 1 #the leading space counts
+    parts.append(encoded)
+    return b'\r\n '.join(parts) + b'\r\n'
+
+
+def format_ics_time(time, all_day=False):
+    '''Naive datetime -> floating DATE-TIME (or DATE for all day events) | event times have no zone, so neither does the feed'''
+
+    return time.strftime('%Y%m%d') if all_day else time.strftime('%Y%m%dT%H%M%S')
+
+
+def vevent_lines(event, domain):
+    '''Content lines of one VEVENT for an event row | events made here get a UID from their id, imported ones keep theirs'''
+
+    date = ';VALUE=DATE' if event.all_day else ''
+    lines = ['BEGIN:VEVENT',
+             f'UID:{event.uid or f"event-{event.id}@{domain}"}',
+             f'DTSTAMP:{event.created_at.strftime("%Y%m%dT%H%M%SZ")}',
+             f'DTSTART{date}:{format_ics_time(event.start_time, event.all_day)}',
+             f'DTEND{date}:{format_ics_time(event.end_time, event.all_day)}',
+             f'SUMMARY:{escape_text(event.title)}']
+    if event.description:
+        lines.append(f'DESCRIPTION:{escape_text(event.description)}')
+    if event.location:
+        lines.append(f'LOCATION:{escape_text(event.location)}')
+    if event.rrule:
+        lines.append(f'RRULE:{event.rrule}')
+    lines.append('END:VEVENT')
+    return lines
+
+
+def feed_chunks(calendar, domain):
+    '''Generator of the ICS document for a calendar in WRITE_SIZE chunks
+    | events come from a server-side cursor EXPORT_BATCH_SIZE at a time, so the whole calendar is never in memory'''
+
+    header = ['BEGIN:VCALENDAR', 'VERSION:2.0', f'PRODID:-//{domain}//Calendar//EN', 'CALSCALE:GREGORIAN', 'METHOD:PUBLISH',
+              f'X-WR-CALNAME:{escape_text(calendar.name)}']
+    if calendar.description:
+        header.append(f'X-WR-CALDESC:{escape_text(calendar.description)}')
+    chunk = b''.join(fold(line) for line in header)
+
+    events = (db.select(Event.id, Event.uid, Event.title, Event.description, Event.location, Event.start_time, Event.end_time,
+                        Event.all_day, Event.rrule, Event.created_at)
+              .where(Event.calendar_id == calendar.id)
+              .order_by(Event.id)
+              .execution_options(yield_per=EXPORT_BATCH_SIZE))
+    for event in db.session.execute(events):
+        chunk += b''.join(fold(line) for line in vevent_lines(event, domain))
+        if len(chunk) >= WRITE_SIZE:
+            yield chunk
+            chunk = b''
+    yield chunk + fold('END:VCALENDAR')
+
+
+def snapshot_path(feed_dir, calendar):
+    '''Where the feed of this version of a calendar is kept | a new version (any change to it or its events) is a new file'''
+
+    return os.path.join(feed_dir, f'calendar-{calendar.id}-v{calendar.version}.ics')
+
+
+def write_snapshot(feed_dir, calendar, domain):
+    '''Generator that streams the feed while saving it as the snapshot for this version
+    | written to a temp file that only takes the snapshot's name once complete, so readers never see half a feed
+    | older versions of the calendar's snapshot are removed then, never newer ones (a faster request may already have
+    saved the next version while this one was still streaming) | a client leaving halfway leaves no file behind'''
+
+    os.makedirs(feed_dir, exist_ok=True)
+    path = snapshot_path(feed_dir, calendar)
+    temp = tempfile.NamedTemporaryFile('wb', dir=feed_dir, prefix=f'calendar-{calendar.id}-', suffix='.tmp', delete=False)
+    try:
+        with temp:
+            for chunk in feed_chunks(calendar, domain):
+                temp.write(chunk)
+                yield chunk
+        os.replace(temp.name, path)
+    except BaseException:
+        os.remove(temp.name)
+        raise
+    remove_snapshots(feed_dir, calendar.id, older_than=calendar.version)
+
+
+def remove_snapshots(feed_dir, calendar_id, older_than=None):
+    '''Remove the saved feeds of a calendar, only those of versions before older_than if it's given'''
+
+    for path in glob.glob(os.path.join(feed_dir, f'calendar-{calendar_id}-v*.ics')):
+        version = SNAPSHOT_VERSION.search(path)
+        if older_than is None or (version and int(version.group(1)) < older_than):
+            try:
+                os.remove(path)
+            except FileNotFoundError: #another worker got to it first
+                pass
@@ -0,0 +1,71 @@
+import json
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session
+from models import INVALIDATION_CHANNEL, process_origin
+from listener import get_listener
+
+INVALIDATORS = {} #tag kind ('user', 'calendar', 'event') -> functions that drop what they cache for tags of that kind
+
+
+def invalidates(*kinds):
+    '''Register a function(tags, remote) that drops whatever it caches for stale tags of these kinds
+    | remote is True for tags that came from another worker's commit | tags is None after the bus lost its
+    connection for a while, the invalidations sent meanwhile are gone so everything should go'''
+
+    def decorator(function):
+        for kind in kinds:
+            INVALIDATORS.setdefault(kind, []).append(function)
+        return function
+    return decorator
+
+
+def evict(tags, remote=False):
+    '''Hand the tags to the invalidators of their kinds, each one called once'''
+
+    by_invalidator = {}
+    for tag in tags:
+        for invalidator in INVALIDATORS.get(tag.partition(':')[0], ()):
+            by_invalidator.setdefault(invalidator, []).append(tag)
+    for invalidator, invalidator_tags in by_invalidator.items():
+        invalidator(invalidator_tags, remote)
+
+
+def evict_all():
+    '''Empty every in-process cache | the bus reconnected and may have missed invalidations'''
+
+    for invalidator in {invalidator for invalidators in INVALIDATORS.values() for invalidator in invalidators}:
+        invalidator(None, True)
+
+
+def receive_invalidation(payload):
+    '''Stale tags another worker (or node) committed | this worker's own commits were evicted already (evict_committed)'''
+
+    message = json.loads(payload)
+    if message['origin'] != process_origin():
+        evict(message['tags'], remote=True)
+
+
+@listens_for(Session, 'after_commit')
+def evict_committed(session):
+    '''Drop everything the transaction changed (models.mark_stale) from this worker's caches | after the commit, so a
+    request running at the same time can't put the old data back in between | the other workers get the NOTIFY
+    models.send_notifications sent with the commit'''
+
+    tags = session.info.pop('stale_tags', None)
+    if tags:
+        evict(tags)
+
+
+@listens_for(Session, 'after_rollback')
+def forget_rolled_back(session):
+    '''Nothing changed, nothing to drop'''
+
+    session.info.pop('stale_tags', None)
+
+
+def init_invalidation(app):
+    '''Every worker evicts the stale tags the others commit | it starts listening before the first request it handles'''
+
+    listener = get_listener(app)
+    listener.on(INVALIDATION_CHANNEL, receive_invalidation, on_reconnect=evict_all)
+    app.before_request(listener.start)
@@ -0,0 +1,139 @@
+import signal
+import time
+from datetime import timedelta
+import click
+from flask import current_app, jsonify, url_for
+from flask.cli import with_appcontext
+from sqlalchemy import delete, func, select, update
+from models import db, Job
+
+POLL_INTERVAL = 1.0 #seconds an idle worker waits before looking for jobs again | JOB_POLL_INTERVAL in the config
+JOB_TIMEOUT = 600 #seconds a job can run before another worker assumes its worker died and takes it over | JOB_TIMEOUT in the config
+RETRY_DELAY = 30 #seconds before the first retry, doubled for each one after that
+KEEP_FINISHED = timedelta(days=7) #done/failed jobs are kept this long so clients can still read their status
+
+JOBS = {} #kind -> function, filled in by @job()
+
+
+class JobFailed(Exception):
+    '''Raise from a job to fail it right away | for errors another attempt won't fix (a broken upload)'''
+
+
+def job(kind):
+    '''Register a function as a job kind | it gets the job's args as keyword arguments and can return something JSON-able as the result
+    | it may commit along the way (batches), a failure rolls back whatever wasn't committed and the whole function runs again'''
+
+    def decorator(fn):
+        JOBS[kind] = fn
+        return fn
+    return decorator
+
+
+def enqueue(kind, **args):
+    '''Add a job to the current transaction | it only exists (and a worker only sees it) once the caller commits'''
+
+    if kind not in JOBS:
+        raise ValueError(f'Unknown job kind: {kind}')
+
+    queued = Job(kind=kind, args=args)
+    db.session.add(queued)
+    return queued
+
+
+def accepted(queued):
+    '''202 response for a queued (and committed) job | Location points at its status'''
+
+    response_JSON = jsonify(job=queued.serialize())
+
+    return (response_JSON, 202, {'Location': url_for('api_jobs.get_job', id=queued.id)})
+
+
+def claim_job():
+    '''Take the next due job and commit it as running | None if there is nothing to do
+    | SKIP LOCKED: workers polling at the same time each get a different job instead of waiting on each other'''
+
+    timeout = current_app.config.get('JOB_TIMEOUT', JOB_TIMEOUT)
+    due = (select(Job.id)
+           .where(Job.status.in_(['queued', 'running']), Job.run_at <= func.now())
+           .order_by(Job.run_at, Job.id)
+           .limit(1)
+           .with_for_update(skip_locked=True))
+    claimed = db.session.scalars(update(Job)
+                                 .where(Job.id == due.scalar_subquery())
+                                 .values(status='running', attempts=Job.attempts + 1, run_at=func.now() + timedelta(seconds=timeout))
+                                 .returning(Job)).first()
+    db.session.commit()
+    return claimed
+
+
+def run_job(claimed):
+    '''Run a claimed job and record how it went | failures are retried with a growing delay until max_attempts'''
+
+    if claimed.attempts > claimed.max_attempts: #its last worker died while running it
+        return finish_job(claimed, 'failed', error=claimed.error or 'Worker stopped while running it')
+
+    try:
+        result = JOBS[claimed.kind](**claimed.args)
+    except Exception as error:
+        db.session.rollback()
+        current_app.logger.exception('Job %s (%s) failed, attempt %d of %d', claimed.id, claimed.kind, claimed.attempts, claimed.max_attempts)
+        if isinstance(error, JobFailed) or claimed.attempts >= claimed.max_attempts:
+            return finish_job(claimed, 'failed', error=repr(error))
+        delay = timedelta(seconds=RETRY_DELAY * 2 ** (claimed.attempts - 1))
+        db.session.execute(update(Job).where(Job.id == claimed.id).values(status='queued', run_at=func.now() + delay, error=repr(error)))
+        db.session.commit()
+        return
+
+    finish_job(claimed, 'done', result=result)
+
+
+def finish_job(claimed, status, result=None, error=None):
+    '''Record a job as done or failed for good'''
+
+    db.session.execute(update(Job).where(Job.id == claimed.id).values(status=status, result=result, error=error, finished_at=func.now()))
+    db.session.commit()
+
+
+def prune_jobs():
+    '''Drop finished jobs older than KEEP_FINISHED'''
+
+    db.session.execute(delete(Job).where(Job.status.in_(['done', 'failed']), Job.finished_at < func.now() - KEEP_FINISHED))
+    db.session.commit()
+
+
+def work(burst=False):
+    '''Run jobs until stopped (SIGINT/SIGTERM finish the current job first) | burst: stop once nothing is due (tests, cron)
+    | returns how many jobs ran'''
+
+    stopping = []
+    if not burst:
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stopping.append(True))
+
+    ran = 0
+    pruned_at = 0
+    while not stopping:
+        claimed = claim_job()
+        if claimed is not None:
+            run_job(claimed)
+            db.session.expunge_all() #nothing from the last job stays in the session
+            ran += 1
+            continue
+        if burst:
+            break
+        if time.monotonic() - pruned_at > 3600:
+            prune_jobs()
+            pruned_at = time.monotonic()
+        time.sleep(current_app.config.get('JOB_POLL_INTERVAL', POLL_INTERVAL))
+    return ran
+
+
+@click.command('worker')
+@click.option('--burst', is_flag=True, help='Exit once no jobs are due')
+@with_appcontext
+def worker_command(burst):
+    '''Run queued jobs (imports, exports, big deletes) | start as many as you like, they share the jobs table'''
+
+    click.echo(f'Worker started, job kinds: {", ".join(sorted(JOBS))}')
+    ran = work(burst=burst)
+    click.echo(f'Worker stopped after {ran} jobs')
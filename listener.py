@@ -0,0 +1,99 @@
+import select
+import threading
+import time
+from models import db
+
+LISTEN_TIMEOUT = 5 #seconds start() waits for the first LISTEN to go through
+KEEPALIVE = 15 #seconds between checks that a quiet connection is still alive
+MAX_RECONNECT_DELAY = 30 #seconds, it backs off (1, 2, 4...) while it can't reach the DB
+
+
+class Listener:
+    '''One LISTEN connection per process (detached from the pool, it never goes back) and a thread handing each NOTIFY
+    to its channel's handler in an app context | shared by the cache invalidation bus and the live event streams
+    | started on first use, so every gunicorn worker (forked after the app is built) starts its own'''
+
+    def __init__(self, app):
+        self.app = app
+        self.handlers = {} #channel -> function(payload)
+        self.reconnect_handlers = [] #functions called once listening again after a lost connection, the NOTIFYs sent meanwhile are gone
+        self.lock = threading.Lock()
+        self.listening = threading.Event()
+        self.thread = None
+
+    def on(self, channel, handler, on_reconnect=None):
+        '''Call handler with the payload of every NOTIFY on channel | add channels before the first start()'''
+        self.handlers[channel] = handler
+        if on_reconnect is not None:
+            self.reconnect_handlers.append(on_reconnect)
+
+    def start(self):
+        '''Start listening if this process isn't yet | waits (up to LISTEN_TIMEOUT) until it is, so nothing sent after start() is missed'''
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive(): #never started, or started before this process was forked
+                self.listening = threading.Event()
+                self.thread = threading.Thread(target=self.run, args=(self.listening,), name='pg-listener', daemon=True)
+                self.thread.start()
+        self.listening.wait(LISTEN_TIMEOUT)
+
+    def run(self, listening):
+        '''LISTEN and dispatch until the process exits, reconnecting whenever the connection drops'''
+        delay = 1
+        while True:
+            connection = None
+            try:
+                connection = self.connect()
+                if listening.is_set():
+                    for handler in self.reconnect_handlers:
+                        self.call(handler)
+                listening.set()
+                delay = 1
+                self.receive(connection)
+            except Exception:
+                self.app.logger.exception('Listener lost its connection, listening again in %s s', delay)
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+    def connect(self):
+        '''A DB-API connection of its own LISTENing on every channel'''
+        with self.app.app_context():
+            connection = db.engine.raw_connection()
+        connection.detach()
+        connection = connection.dbapi_connection
+        connection.autocommit = True
+        cursor = connection.cursor()
+        for channel in self.handlers:
+            cursor.execute(f'LISTEN {channel}')
+        return connection
+
+    def receive(self, connection):
+        '''Dispatch NOTIFYs as they arrive | a quiet connection is checked every KEEPALIVE seconds, so a dead one is noticed'''
+        while True:
+            if select.select([connection], [], [], KEEPALIVE)[0]:
+                connection.poll()
+            else:
+                connection.cursor().execute('SELECT 1')
+            while connection.notifies:
+                notify = connection.notifies.pop(0)
+                self.call(self.handlers[notify.channel], notify.payload)
+
+    def call(self, handler, *args):
+        '''Run a handler in an app context | a failing handler is logged, it doesn't stop the others'''
+        try:
+            with self.app.app_context():
+                handler(*args)
+        except Exception:
+            self.app.logger.exception('Listener handler %s failed', handler.__qualname__)
+
+
+def get_listener(app):
+    '''The app's Listener, made on first use'''
+
+    if 'listener' not in app.extensions:
+        app.extensions['listener'] = Listener(app)
+    return app.extensions['listener']
@@ -0,0 +1,30 @@
+"""Index builds the revisions share
+
+Indexes on tables that already hold data are built CONCURRENTLY so writes aren't blocked while
+they build | CONCURRENTLY can't run inside a transaction, hence the autocommit blocks (whatever the
+revision did before is committed first) | a concurrent build that fails leaves an INVALID index
+behind, so running the revision again drops that and builds it over, a valid one is kept
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+def create_index_concurrently(name, table, columns, **kw):
+    '''op.create_index() with CONCURRENTLY in an autocommit block | skipped if a valid index of that name exists,
+    an invalid one (a failed build) is dropped and built again'''
+
+    with op.get_context().autocommit_block():
+        valid = op.get_bind().scalar(sa.text('SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)'), {'name': name})
+        if valid:
+            return
+        if valid is not None:
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
+        op.create_index(name, table, columns, unique=False, postgresql_concurrently=True, **kw)
+
+
+def drop_index_concurrently(name, table):
+    '''op.drop_index() with CONCURRENTLY in an autocommit block | fine if it's already gone'''
+
+    with op.get_context().autocommit_block():
+        op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
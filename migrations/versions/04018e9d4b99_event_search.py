@@ -0,0 +1,39 @@
+"""event search
+
+events.search_vector, generated from title/description/location, and the ix_events_search GIN index
+
+Revision ID: 04018e9d4b99
+Revises: 69219653da5c
+Create Date: 2026-10-18 11:01:29.012467
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from migrations.helpers import create_index_concurrently, drop_index_concurrently
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '04018e9d4b99'
+down_revision = '69219653da5c'
+branch_labels = None
+depends_on = None
+
+SEARCH_VECTOR = ("setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+                 "setweight(to_tsvector('english', coalesce(description, '')), 'B') || "
+                 "setweight(to_tsvector('english', coalesce(location, '')), 'C')") #models.EVENT_SEARCH_VECTOR when this was written
+
+
+def upgrade():
+    #a stored generated column is computed for every row, this rewrites events under an exclusive lock
+    with op.batch_alter_table('events', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('search_vector', postgresql.TSVECTOR(), sa.Computed(SEARCH_VECTOR, persisted=True), nullable=True))
+
+    create_index_concurrently('ix_events_search', 'events', ['search_vector'], postgresql_using='gin')
+
+
+def downgrade():
+    drop_index_concurrently('ix_events_search', 'events')
+
+    with op.batch_alter_table('events', schema=None) as batch_op:
+        batch_op.drop_column('search_vector')
@@ -0,0 +1,27 @@
+"""event window index
+
+ix_events_calendar_time for the ?start=&end= window on a calendar's events feed
+
+Revision ID: 45f9b86a311b
+Revises: 00e50870b325
+Create Date: 2026-10-18 11:01:20.104722
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from migrations.helpers import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = '45f9b86a311b'
+down_revision = '00e50870b325'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    create_index_concurrently('ix_events_calendar_time', 'events', ['calendar_id', 'start_time', 'end_time'])
+
+
+def downgrade():
+    drop_index_concurrently('ix_events_calendar_time', 'events')
@@ -0,0 +1,36 @@
+"""conflict detection
+
+calendars.reject_conflicts and ix_events_calendar_period, the GiST index find_conflicts uses
+
+Revision ID: 69219653da5c
+Revises: a76b498f4577
+Create Date: 2026-10-18 11:01:27.855231
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from migrations.helpers import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = '69219653da5c'
+down_revision = 'a76b498f4577'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('calendars', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('reject_conflicts', sa.Boolean(), server_default='false', nullable=False))
+
+    #calendar_id as a one value range, so no btree_gist extension is needed
+    create_index_concurrently('ix_events_calendar_period', 'events',
+                              [sa.text("int4range(calendar_id, calendar_id, '[]')"), sa.text("tsrange(start_time, end_time, '[)')")],
+                              postgresql_using='gist', postgresql_where=sa.text('rrule IS NULL'))
+
+
+def downgrade():
+    drop_index_concurrently('ix_events_calendar_period', 'events')
+
+    with op.batch_alter_table('calendars', schema=None) as batch_op:
+        batch_op.drop_column('reject_conflicts')
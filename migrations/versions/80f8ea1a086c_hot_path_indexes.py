@@ -0,0 +1,29 @@
+"""hot path indexes
+
+user_home (events by creator_id + start_time) and user_home/event_new (calendars by owner_id)
+
+Revision ID: 80f8ea1a086c
+Revises: 04018e9d4b99
+Create Date: 2026-10-18 11:01:30.247488
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from migrations.helpers import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = '80f8ea1a086c'
+down_revision = '04018e9d4b99'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    create_index_concurrently('ix_calendars_owner_id', 'calendars', ['owner_id'])
+    create_index_concurrently('ix_events_creator_start', 'events', ['creator_id', 'start_time'])
+
+
+def downgrade():
+    drop_index_concurrently('ix_events_creator_start', 'events')
+    drop_index_concurrently('ix_calendars_owner_id', 'calendars')
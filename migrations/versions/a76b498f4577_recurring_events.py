@@ -0,0 +1,35 @@
+"""recurring events
+
+events.rrule and events.series_end, with ix_events_calendar_series over the recurring series only
+
+Revision ID: a76b498f4577
+Revises: c89616ef2852
+Create Date: 2026-10-18 11:01:26.380514
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from migrations.helpers import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = 'a76b498f4577'
+down_revision = 'c89616ef2852'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('events', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('rrule', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('series_end', sa.DateTime(), nullable=True))
+
+    create_index_concurrently('ix_events_calendar_series', 'events', ['calendar_id', 'start_time'], postgresql_where=sa.text('rrule IS NOT NULL'))
+
+
+def downgrade():
+    drop_index_concurrently('ix_events_calendar_series', 'events')
+
+    with op.batch_alter_table('events', schema=None) as batch_op:
+        batch_op.drop_column('series_end')
+        batch_op.drop_column('rrule')
@@ -0,0 +1,42 @@
+"""cascade deletes
+
+events.calendar_id, events.creator_id and calendars.owner_id get ON DELETE CASCADE
+
+Revision ID: c3a91d7e4f20
+Revises: 5b6efa5be161
+Create Date: 2026-10-18 12:20:41.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3a91d7e4f20'
+down_revision = '5b6efa5be161'
+branch_labels = None
+depends_on = None
+
+FOREIGN_KEYS = [
+    ('calendars_owner_id_fkey', 'calendars', 'users', 'owner_id'),
+    ('events_calendar_id_fkey', 'events', 'calendars', 'calendar_id'),
+    ('events_creator_id_fkey', 'events', 'users', 'creator_id'),
+]
+
+
+def replace_foreign_keys(ondelete):
+    for name, source, referent, column in FOREIGN_KEYS:
+        op.drop_constraint(name, source, type_='foreignkey')
+        #NOT VALID: no scan of events while the DROP/ADD hold it ACCESS EXCLUSIVE
+        op.create_foreign_key(name, source, referent, [column], ['id'], ondelete=ondelete, postgresql_not_valid=True)
+    with op.get_context().autocommit_block(): #commits the swap first | VALIDATE only takes SHARE UPDATE EXCLUSIVE, reads and writes carry on
+        for name, source, referent, column in FOREIGN_KEYS:
+            op.execute(f'ALTER TABLE {source} VALIDATE CONSTRAINT {name}')
+
+
+def upgrade():
+    replace_foreign_keys('CASCADE')
+
+
+def downgrade():
+    replace_foreign_keys(None)
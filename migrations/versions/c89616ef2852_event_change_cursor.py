@@ -0,0 +1,50 @@
+"""event change cursor
+
+events.change_seq and event_tombstones for the delta sync endpoint, each with a (calendar_id, change_seq) index
+
+Revision ID: c89616ef2852
+Revises: 94c0eb5f9839
+Create Date: 2026-10-18 11:01:24.917365
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from migrations.helpers import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = 'c89616ef2852'
+down_revision = '94c0eb5f9839'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    #a volatile default (nextval) in ADD COLUMN would rewrite events under an exclusive lock, so it's added empty and numbered after
+    op.execute(sa.schema.CreateSequence(sa.Sequence('event_change_seq')))
+    op.add_column('events', sa.Column('change_seq', sa.BigInteger(), nullable=True))
+    op.alter_column('events', 'change_seq', server_default=sa.text("nextval('event_change_seq')"))
+    op.execute("UPDATE events SET change_seq = nextval('event_change_seq') WHERE change_seq IS NULL")
+    op.alter_column('events', 'change_seq', nullable=False)
+
+    op.create_table('event_tombstones',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('event_id', sa.Integer(), nullable=False),
+    sa.Column('change_seq', sa.BigInteger(), server_default=sa.text("nextval('event_change_seq')"), nullable=False),
+    sa.Column('deleted_at', sa.DateTime(), nullable=True),
+    sa.Column('calendar_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['calendar_id'], ['calendars.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_event_tombstones_calendar_change_seq', 'event_tombstones', ['calendar_id', 'change_seq'], unique=False)
+
+    create_index_concurrently('ix_events_calendar_change_seq', 'events', ['calendar_id', 'change_seq'])
+
+
+def downgrade():
+    drop_index_concurrently('ix_events_calendar_change_seq', 'events')
+
+    op.drop_index('ix_event_tombstones_calendar_change_seq', table_name='event_tombstones')
+    op.drop_table('event_tombstones')
+    op.drop_column('events', 'change_seq')
+    op.execute(sa.schema.DropSequence(sa.Sequence('event_change_seq')))
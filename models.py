@@ -1,19 +1,44 @@
+from bisect import bisect_right
 from datetime import datetime, timezone
-from flask_bcrypt import Bcrypt
+import json
+import os
+import socket
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import update, insert, delete
+from sqlalchemy.dialects.postgresql import TSVECTOR, ARRAY, JSONB
+from sqlalchemy.event import listens_for
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import validates
+from sqlalchemy.orm import validates, object_session, Session
 from werkzeug.security import generate_password_hash, check_password_hash
+from recurrence import check_rrule, series_end, expand_window
+from passwords import bcrypt, hash_password, check_password, needs_rehash
 
 db = SQLAlchemy()
-bcrypt = Bcrypt()
+
+EVENT_TIME_FORMAT = 'YYYY-MM-DD"T"HH24:MI' #Postgres to_char() version of the strftime format in Event.serialize
+EVENT_DATE_FORMAT = 'YYYY-MM-DD' #all day events only show the date on FullCalendar
+
+EVENT_SEARCH_CONFIG = 'english' #text search config for Event.search_vector and search queries
+EVENT_SEARCH_VECTOR = (f"setweight(to_tsvector('{EVENT_SEARCH_CONFIG}', coalesce(title, '')), 'A') || "
+                       f"setweight(to_tsvector('{EVENT_SEARCH_CONFIG}', coalesce(description, '')), 'B') || "
+                       f"setweight(to_tsvector('{EVENT_SEARCH_CONFIG}', coalesce(location, '')), 'C')")
+
+#every event insert/update/delete takes the next number from this sequence | delta sync clients keep the last one they saw as their cursor
+#writers lock the calendar first (bump_calendar_version), so within a calendar the numbers commit in order
+EVENT_CHANGE_SEQ = db.Sequence('event_change_seq')
+
+EVENT_CHANGES_CHANNEL = 'event_changes' #LISTEN/NOTIFY channel event_stream.py fans out to the open SSE streams
+INVALIDATION_CHANNEL = 'cache_invalidation' #LISTEN/NOTIFY channel for the stale tags of every commit, invalidation.py evicts them in every worker
+MAX_NOTIFY_IDS = 500 #more events than this changed in one calendar sends a reset (refetch) instead | NOTIFY payloads max out at 8000 bytes
+MAX_PAYLOAD_TAGS = 300 #stale tags per invalidation NOTIFY, a commit with more sends several
+STALE_TAG_KINDS = ('user', 'calendar', 'event') #'user:3' (user_cache), 'calendar:5' and 'event:12' (response_cache)
+HOSTNAME = socket.gethostname()
 
 def connect_db(app):
-    '''Connect to database.'''
-    with app.app_context():
-        db.app = app
-        db.init_app(app)
-        db.create_all()
+    '''Connect to database | lazy, nothing touches the DB until the first query
+    | tables aren't created here, run `flask init-db` once (or db.create_all() in tests)'''
+    db.init_app(app)
+    bcrypt.init_app(app)
     
     
 def add_to_db(object):
@@ -26,6 +51,187 @@ def add_to_db(object):
         db.session.rollback()
         return None
 
+def mark_stale(*tags, session=None):
+    '''Remember the typed cache tags ('user:3', 'calendar:5', 'event:12') the current transaction changes
+    | once it commits invalidation.py drops them here, and the other workers drop them when the NOTIFY reaches them'''
+    unknown = [tag for tag in tags if tag.partition(':')[0] not in STALE_TAG_KINDS]
+    if unknown:
+        raise ValueError(f'Unknown cache tags: {", ".join(unknown)}')
+    
+    session = session or db.session
+    session.info.setdefault('stale_tags', set()).update(tags)
+
+def notify(channel, *payloads, session=None):
+    '''Queue NOTIFYs for the current transaction | send_notifications sends them all in one statement as it commits'''
+    session = session or db.session
+    session.info.setdefault('notifications', []).extend((channel, payload) for payload in payloads)
+
+def notify_calendars(changes, session=None):
+    '''NOTIFY the live event streams (event_stream.py) of changes, a list of (calendar_id, action, event_ids)
+    | actions are created, updated, deleted, reset and calendar_deleted'''
+    payloads = []
+    for calendar_id, action, event_ids in changes:
+        event_ids = list(event_ids)
+        if len(event_ids) > MAX_NOTIFY_IDS:
+            action, event_ids = 'reset', []
+        payloads.append(json.dumps({'calendar_id': calendar_id, 'action': action, 'ids': event_ids}, separators=(',', ':')))
+    notify(EVENT_CHANGES_CHANNEL, *payloads, session=session)
+
+def process_origin():
+    '''Names this process in invalidation NOTIFYs, so it can skip its own (it already evicted them on commit)'''
+    return f'{HOSTNAME}:{os.getpid()}'
+
+@listens_for(Session, 'before_commit')
+def send_notifications(session):
+    '''Send the transaction's queued NOTIFYs, and its stale tags for the other workers, in one statement
+    | flushes first, ORM listeners queue theirs while flushing | Postgres only delivers them if the commit goes through,
+    and only once the changes are visible, so another worker can't reload the old data after evicting it'''
+    session.flush()
+    
+    tags = sorted(session.info.get('stale_tags', ()))
+    for start in range(0, len(tags), MAX_PAYLOAD_TAGS):
+        notify(INVALIDATION_CHANNEL, json.dumps({'origin': process_origin(), 'tags': tags[start:start + MAX_PAYLOAD_TAGS]}), session=session)
+    
+    notifications = session.info.pop('notifications', None)
+    if notifications:
+        channels, payloads = zip(*notifications)
+        queued = (db.func.unnest(db.literal(list(channels), ARRAY(db.Text)), db.literal(list(payloads), ARRAY(db.Text)))
+                  .table_valued('channel', 'payload').render_derived())
+        session.execute(db.select(db.func.pg_notify(queued.c.channel, queued.c.payload)))
+
+@listens_for(Session, 'after_rollback')
+def forget_notifications(session):
+    '''Nothing changed, nothing to tell anyone'''
+    session.info.pop('notifications', None)
+
+def event_changes(action, changed):
+    '''notify_calendars() changes for events written with bulk statements (the ORM listeners below cover the rest)
+    | changed is a list of (event_id, calendar_id) pairs, like tombstone_events(), one change per calendar'''
+    by_calendar = {}
+    for event_id, calendar_id in changed:
+        by_calendar.setdefault(calendar_id, []).append(event_id)
+    return [(calendar_id, action, event_ids) for calendar_id, event_ids in by_calendar.items()]
+
+def bump_calendar_version(*calendar_ids):
+    '''Increment the version of the given calendars | every Event write calls this so cached feeds (ETags) go stale
+    | call it before the write: the calendar rows stay locked until commit, so the writes to a calendar take their change_seq
+    one transaction at a time and a delta sync cursor never gets past a number that hasn't committed yet
+    | rows are locked in id order (two writes to the same calendars can't deadlock) and pending changes aren't flushed first
+    | runs in the current transaction, so it is committed (or rolled back) along with the write'''
+    ids = {id for id in calendar_ids if id is not None}
+    
+    if ids:
+        locked = db.select(Calendar.id).where(Calendar.id.in_(ids)).order_by(Calendar.id).with_for_update()
+        with db.session.no_autoflush:
+            db.session.execute(update(Calendar).where(Calendar.id.in_(locked.scalar_subquery())).values(version=Calendar.version + 1))
+        mark_stale(*[f'calendar:{id}' for id in ids])
+
+def tombstone_events(removed):
+    '''Leave tombstones for events removed with bulk statements (the ORM listeners below don't see those)
+    | removed is a list of (event_id, calendar_id) pairs'''
+    if removed:
+        db.session.execute(insert(EventTombstone.__table__), [{'event_id': event_id, 'calendar_id': calendar_id} for event_id, calendar_id in removed])
+
+def remove_calendar(calendar_id):
+    '''Delete a calendar in one statement | ON DELETE CASCADE takes its events and tombstones with it
+    | no tombstones are left, delta sync clients get a 404 for the calendar itself'''
+    owner_id = db.session.execute(delete(Calendar).where(Calendar.id == calendar_id).returning(Calendar.owner_id)).scalar()
+    mark_stale(f'calendar:{calendar_id}', *([f'user:{owner_id}'] if owner_id is not None else [])) #their cached calendar list
+    notify_calendars([(calendar_id, 'calendar_deleted', [])])
+
+def remove_calendar_events(calendar_id, batch_size):
+    '''Delete up to batch_size of a calendar's events | returns how many went, for background deletes done in small transactions'''
+    batch = db.select(Event.id).where(Event.calendar_id == calendar_id).limit(batch_size)
+    deleted = db.session.execute(delete(Event).where(Event.id.in_(batch))).rowcount
+    bump_calendar_version(calendar_id)
+    return deleted
+
+def remove_user(user_id):
+    '''Delete a user in a fixed number of statements, however many calendars/events they have
+    | ON DELETE CASCADE takes their calendars, the events in them and their events in other users' calendars
+    | those other calendars get tombstones (INSERT ... SELECT) and a version bump, like any other event delete'''
+    own_calendars = db.select(Calendar.id).where(Calendar.owner_id == user_id)
+    elsewhere = db.select(Event.id, Event.calendar_id).where(Event.creator_id == user_id, Event.calendar_id.not_in(own_calendars))
+    
+    own_calendar_ids = db.session.scalars(own_calendars).all()
+    bump_calendar_version(*db.session.scalars(db.select(elsewhere.subquery().c.calendar_id).distinct())) #before the tombstones take a change_seq
+    
+    tombstones = EventTombstone.__table__.c
+    removed = db.session.execute(insert(EventTombstone.__table__).from_select(['event_id', 'calendar_id'], elsewhere)
+                                 .returning(tombstones.event_id, tombstones.calendar_id)).all()
+    db.session.execute(delete(User).where(User.id == user_id))
+    mark_stale(f'user:{user_id}', *[f'calendar:{id}' for id in own_calendar_ids])
+    notify_calendars([(calendar_id, 'calendar_deleted', []) for calendar_id in own_calendar_ids] + event_changes('deleted', removed))
+
+def as_datetime(time):
+    '''Event times can still be the ISO strings they were created with (API/tests) until they are flushed
+    | raises a ValueError for a time with a UTC offset, event times are stored without a time zone'''
+    time = datetime.fromisoformat(time) if isinstance(time, str) else time
+    if isinstance(time, datetime) and time.tzinfo is not None:
+        raise ValueError('Event times must not have a UTC offset (Z, +02:00), use the calendar\'s local time')
+    return time
+
+def find_conflicts(calendar_id, start_time, end_time, exclude_id=None):
+    '''Events in the calendar that overlap start-end (back to back is fine) | exclude_id skips the event being edited
+    | single events are found through the ix_events_calendar_period GiST index, recurring series are expanded around the time
+    | raises a ValueError for times with a UTC offset, tsrange() can't take them
+    | lock the calendar first (bump_calendar_version) when the answer decides a write, or two writes can both pass'''
+    start_time, end_time = as_datetime(start_time), as_datetime(end_time)
+    not_excluded = Event.id != exclude_id if exclude_id is not None else db.true()
+    
+    conflicts = (Event.query
+                 .filter(db.func.int4range(Event.calendar_id, Event.calendar_id, db.literal_column("'[]'")).op('@>')(calendar_id),
+                         db.func.tsrange(Event.start_time, Event.end_time, db.literal_column("'[)'")).op('&&')(db.func.tsrange(start_time, end_time, db.literal_column("'[)'"))),
+                         Event.rrule.is_(None), not_excluded)
+                 .order_by(Event.start_time)
+                 .all())
+    
+    series = Event.query.filter(Event.calendar_id == calendar_id, Event.rrule.isnot(None), not_excluded,
+                                Event.start_time < end_time, db.or_(Event.series_end.is_(None), Event.series_end > start_time))
+    for event in series:
+        if series_overlaps(event.rrule, event.start_time, event.end_time, start_time, end_time):
+            conflicts.append(event)
+    
+    return conflicts
+
+def series_overlaps(rrule, series_start, series_end_time, start_time, end_time):
+    '''Check if any occurrence of a series overlaps start-end (back to back is fine)'''
+    occurrences = expand_window(rrule, series_start, series_end_time, start_time, end_time)
+    return any(occurrence_end > start_time and occurrence_start < end_time for occurrence_start, occurrence_end in occurrences)
+
+
+class PendingEvents:
+    '''Times of the events a batch or an import is about to write to a calendar that rejects conflicts, which find_conflicts
+    can't see yet | checking each new event against them too keeps the new events from overlapping each other
+    | the single events added never overlap (an overlapping one isn't added), so sorted by start they are sorted by end too
+    and a check is one bisect, the series are expanded around the time like in find_conflicts'''
+    
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.series = [] #(rrule, start_time, end_time)
+    
+    def overlaps(self, start_time, end_time):
+        '''Check if start-end overlaps an event added so far (back to back is fine)'''
+        position = bisect_right(self.ends, start_time) #first single event still going at start_time
+        if position < len(self.starts) and self.starts[position] < end_time:
+            return True
+        return any(series_overlaps(*series, start_time, end_time) for series in self.series)
+    
+    def add(self, start_time, end_time, rrule=None):
+        '''Remember an event that passed overlaps()'''
+        if rrule:
+            self.series.append((rrule, start_time, end_time))
+        elif start_time < end_time: #an empty range overlaps nothing
+            position = bisect_right(self.ends, start_time)
+            self.starts.insert(position, start_time)
+            self.ends.insert(position, end_time)
+
+def refresh_series_end(event_ids):
+    '''Recompute series_end for recurring events changed with bulk statements (set_series_end only sees ORM flushes)'''
+    for event in Event.query.filter(Event.id.in_(event_ids), Event.rrule.isnot(None)):
+        event.series_end = series_end(event.rrule, event.start_time, event.end_time)
+
 def create_user(form):
     '''Create a new user from the registration form data'''
     email = form.email.data
@@ -46,12 +252,18 @@ def create_event(form, user, calendar):
     bg_color = form.bg_color.data
     txt_color = form.txt_color.data
     all_day = form.all_day.data
+    rrule = form.rrule.data
     
     calendar_id = calendar[0]
     creator_id = user.id
     
     new_event = Event(title=title, description=description, start_time=start_time, end_time=end_time, location=location, bg_color=bg_color, txt_color=txt_color, 
-                        all_day=all_day, creator_id=creator_id, calendar_id=calendar_id)
+                        all_day=all_day, rrule=rrule, creator_id=creator_id, calendar_id=calendar_id)
+    bump_calendar_version(calendar_id) #locks the calendar, an overlapping create at the same time waits for this one
+    calendar = db.session.get(Calendar, calendar_id)
+    if calendar and calendar.reject_conflicts and find_conflicts(calendar_id, start_time, end_time):
+        db.session.rollback()
+        return None
     
     return add_to_db(new_event)
 
@@ -67,26 +279,30 @@ class User(db.Model):
     l_name = db.Column(db.String(40), nullable=False)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     
-    calendars = db.relationship('Calendar', backref='owner', cascade='all, delete-orphan') #NOTE: might add multiple canlendar function later
-    events = db.relationship('Event', backref='creator', cascade='all, delete-orphan')
+    #passive_deletes: the ON DELETE CASCADE foreign keys remove the children, they are never loaded just to be deleted
+    calendars = db.relationship('Calendar', backref='owner', cascade='all, delete-orphan', passive_deletes=True) #NOTE: might add multiple canlendar function later
+    events = db.relationship('Event', backref='creator', cascade='all, delete-orphan', passive_deletes=True)
     
     
     @classmethod #genereates a new instance of User
     def register(cls, email, password, f_name, l_name):
         '''Register user w/hashed password & return user'''
 
-        hashed = bcrypt.generate_password_hash(password) #turns user input password into hash+salt
-        hashed_utf8 = hashed.decode("utf8") #turn bytestring into normal (unicode utf8) string
+        hashed_utf8 = hash_password(password) #turns user input password into hash+salt | BCRYPT_LOG_ROUNDS sets the cost
 
         return cls(email=email, password=hashed_utf8, f_name=f_name, l_name=l_name)
         #return instance of user w/username and hashed pwd | cls (.self) same as User here in a classmethod
 
     @classmethod
     def authenticate(cls, email, password):
-        '''Validate that user exists & password is correct | Return user if valid; else return False'''
+        '''Validate that user exists & password is correct | Return user if valid; else return False
+        | if the hash was made with an old BCRYPT_LOG_ROUNDS it gets rehashed with the current one while we have the password'''
         user = User.query.filter_by(email=email).first()
 
-        if user and bcrypt.check_password_hash(user.password, password): #user.password is from db | password is from the user input form
+        if user and check_password(user.password, password): #user.password is from db | password is from the user input form
+            if needs_rehash(user.password):
+                user.password = hash_password(password)
+                db.session.commit()
             
             return user #return user instance
         else:
@@ -110,9 +326,24 @@ class User(db.Model):
         return (f'{first} {last}')
 
 
+@listens_for(User, 'after_update')
+@listens_for(User, 'after_delete')
+def mark_user_stale(mapper, connection, target):
+    '''The cached user (user_cache) goes stale when they change or go away'''
+    mark_stale(f'user:{target.id}', session=object_session(target))
+
+
 class Event(db.Model):
     '''Events within the calendar'''
     __tablename__ = 'events'
+    __table_args__ = (
+        db.Index('ix_events_calendar_time', 'calendar_id', 'start_time', 'end_time'), #for the visible-range feed queries
+        db.Index('ix_events_calendar_change_seq', 'calendar_id', 'change_seq'), #for the delta sync queries
+        db.Index('ix_events_calendar_series', 'calendar_id', 'start_time', postgresql_where=db.text('rrule IS NOT NULL')), #recurring series only
+        db.Index('ix_events_search', 'search_vector', postgresql_using='gin'), #inverted index for /api/events/search
+        db.Index('ix_events_creator_start', 'creator_id', 'start_time'), #upcoming events on user_home
+        db.Index('ux_events_calendar_uid', 'calendar_id', 'uid', unique=True, postgresql_where=db.text('uid IS NOT NULL')), #ICS import dedupe
+    )
     
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     title = db.Column(db.String(50), nullable=False)
@@ -123,11 +354,18 @@ class Event(db.Model):
     bg_color = db.Column(db.String(7), default="#e1e1e1")
     txt_color = db.Column(db.String(7), default="#000000")
     all_day = db.Column(db.Boolean, default=False)
+    rrule = db.Column(db.Text) #RRULE for recurring events (FREQ=WEEKLY;BYDAY=MO) | the row is the first occurrence
+    series_end = db.Column(db.DateTime) #end of the last occurrence, None if it repeats forever | kept up to date by set_series_end
+    uid = db.Column(db.String(255)) #iCalendar UID of imported events, unique per calendar | None for events made here
+    
+    #generated by Postgres on every write | title matches rank above description, description above location
+    search_vector = db.Column(TSVECTOR, db.Computed(EVENT_SEARCH_VECTOR, persisted=True))
     
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    change_seq = db.Column(db.BigInteger, EVENT_CHANGE_SEQ, server_default=EVENT_CHANGE_SEQ.next_value(), onupdate=EVENT_CHANGE_SEQ.next_value(), nullable=False)
     
-    calendar_id = db.Column(db.Integer, db.ForeignKey('calendars.id'), nullable=False)
-    creator_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    calendar_id = db.Column(db.Integer, db.ForeignKey('calendars.id', ondelete='CASCADE'), nullable=False)
+    creator_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     
     @validates('end_time')
     def validate_end_time(self, key, end_time):
@@ -136,6 +374,14 @@ class Event(db.Model):
             raise ValueError("End time must be after start time")
         return end_time
     
+    @validates('rrule')
+    def validate_rrule(self, key, rrule):
+        """Ensure the recurrence rule can be parsed and stays within the expansion limits | empty means it doesn't repeat"""
+        if not rrule:
+            return None
+        check_rrule(rrule, as_datetime(self.start_time) if self.start_time is not None else None)
+        return rrule
+    
     def serialize(self):
         '''Returns a dictionary representation which we can turn into JSON'''
         return {
@@ -148,10 +394,149 @@ class Event(db.Model):
             'bg_color': self.bg_color,
             'txt_color': self.txt_color,
             'all_day': self.all_day,
+            'rrule': self.rrule,
             'created_at': self.created_at.strftime('%Y-%m-%dT%H:%M'),
             'calendar_id': self.calendar_id,
             'creator_id': self.creator_id,
         }
+    
+    @classmethod
+    def feed_columns(cls, format=None):
+        '''Column expressions for each key of a feed row, by format
+        | default: the same keys/values as serialize()
+        | fullcalendar: exactly what FullCalendar renders (all day events get a * title and date only start/end)'''
+        if format == 'fullcalendar':
+            return {
+                'id': cls.id,
+                'title': db.case((cls.all_day, '* ' + cls.title), else_=cls.title),
+                'start': db.case((cls.all_day, db.func.to_char(cls.start_time, EVENT_DATE_FORMAT)), else_=db.func.to_char(cls.start_time, EVENT_TIME_FORMAT)),
+                'end': db.case((cls.all_day, db.func.to_char(cls.end_time, EVENT_DATE_FORMAT)), else_=db.func.to_char(cls.end_time, EVENT_TIME_FORMAT)),
+                'allDay': cls.all_day,
+                'backgroundColor': cls.bg_color,
+                'textColor': cls.txt_color,
+            }
+        
+        return {
+            'id': cls.id,
+            'title': cls.title,
+            'description': cls.description,
+            'start_time': db.func.to_char(cls.start_time, EVENT_TIME_FORMAT),
+            'end_time': db.func.to_char(cls.end_time, EVENT_TIME_FORMAT),
+            'location': cls.location,
+            'bg_color': cls.bg_color,
+            'txt_color': cls.txt_color,
+            'all_day': cls.all_day,
+            'rrule': cls.rrule,
+            'created_at': db.func.to_char(cls.created_at, EVENT_TIME_FORMAT),
+            'calendar_id': cls.calendar_id,
+            'creator_id': cls.creator_id,
+        }
+    
+    @classmethod
+    def feed_query(cls, format=None, fields=None):
+        '''Query for plain rows in the given feed format | row._asdict() gives the dict
+        | Postgres formats the timestamps for the whole result, and no ORM objects are built
+        | fields is an optional list of keys to keep (id is always kept), unknown keys raise a ValueError'''
+        columns = cls.feed_columns(format)
+        
+        if fields:
+            unknown = [field for field in fields if field not in columns]
+            if unknown:
+                raise ValueError(f'Unknown fields: {", ".join(unknown)}')
+            columns = {name: column for name, column in columns.items() if name == 'id' or name in fields}
+        
+        return db.session.query(*[column.label(name) for name, column in columns.items()])
+    
+    @classmethod
+    def search_terms(cls, q):
+        '''tsquery for what a user typed in the search box | websearch syntax: "exact phrase", -excluded, or'''
+        return db.func.websearch_to_tsquery(db.literal_column(f"'{EVENT_SEARCH_CONFIG}'"), q)
+    
+    @classmethod
+    def series_query(cls, format=None, fields=None):
+        '''feed_query() for recurring events only, plus the raw columns recurrence.expand_rows() needs'''
+        return (cls.feed_query(format, fields)
+                .add_columns(cls.rrule.label('series_rrule'), cls.start_time.label('series_start'),
+                             cls.end_time.label('series_end_time'), cls.all_day.label('series_all_day'))
+                .filter(cls.rrule.isnot(None)))
+
+
+@listens_for(Event, 'before_insert')
+@listens_for(Event, 'before_update')
+def set_series_end(mapper, connection, target):
+    '''Keep series_end in step with the rule and times so window queries can skip finished series'''
+    if target.rrule is None:
+        target.series_end = None
+        return
+    
+    target.series_end = series_end(target.rrule, as_datetime(target.start_time), as_datetime(target.end_time))
+
+
+#GiST index for conflict detection | a range on calendar_id (instead of the plain column) means no btree_gist extension is needed
+db.Index('ix_events_calendar_period',
+         db.func.int4range(Event.calendar_id, Event.calendar_id, db.literal_column("'[]'")),
+         db.func.tsrange(Event.start_time, Event.end_time, db.literal_column("'[)'")),
+         postgresql_using='gist',
+         postgresql_where=Event.rrule.is_(None))
+
+
+class EventTombstone(db.Model):
+    '''Marker left behind when an event is deleted (or moved to another calendar) so delta sync clients can remove it'''
+    __tablename__ = 'event_tombstones'
+    __table_args__ = (
+        db.Index('ix_event_tombstones_calendar_change_seq', 'calendar_id', 'change_seq'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    event_id = db.Column(db.Integer, nullable=False) #no foreign key, the event is gone
+    change_seq = db.Column(db.BigInteger, EVENT_CHANGE_SEQ, server_default=EVENT_CHANGE_SEQ.next_value(), nullable=False)
+    deleted_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    
+    calendar_id = db.Column(db.Integer, db.ForeignKey('calendars.id', ondelete='CASCADE'), nullable=False) #no need to keep them once the calendar is gone
+
+
+@listens_for(Event, 'after_insert')
+@listens_for(Event, 'after_update')
+@listens_for(Event, 'after_delete')
+def mark_event_stale(mapper, connection, target):
+    '''Cached responses for the event and its calendars (old and new if it moved) go stale with any ORM write'''
+    calendar_ids = [target.calendar_id, *db.inspect(target).attrs.calendar_id.history.deleted]
+    mark_stale(f'event:{target.id}', *[f'calendar:{id}' for id in calendar_ids], session=object_session(target))
+
+
+@listens_for(Event, 'after_insert')
+def notify_created_event(mapper, connection, target):
+    '''Live streams of the calendar show the new event'''
+    notify_calendars([(target.calendar_id, 'created', [target.id])], session=object_session(target))
+
+
+@listens_for(Event, 'after_update')
+def notify_updated_event(mapper, connection, target):
+    '''An event moved to another calendar is deleted from the old calendar's streams and updated in the new one's'''
+    old_calendar_ids = db.inspect(target).attrs.calendar_id.history.deleted
+    moved = [(old_calendar_ids[0], 'deleted', [target.id])] if old_calendar_ids and old_calendar_ids[0] != target.calendar_id else []
+    notify_calendars(moved + [(target.calendar_id, 'updated', [target.id])], session=object_session(target))
+
+
+@listens_for(Event, 'after_delete')
+def notify_deleted_event(mapper, connection, target):
+    '''Live streams of the calendar drop the event'''
+    notify_calendars([(target.calendar_id, 'deleted', [target.id])], session=object_session(target))
+
+
+@listens_for(Event, 'after_delete')
+def tombstone_deleted_event(mapper, connection, target):
+    '''Leave a tombstone for every event deleted through the ORM | covers the delete routes and cascades from User/Calendar'''
+    connection.execute(insert(EventTombstone.__table__).values(event_id=target.id, calendar_id=target.calendar_id))
+
+
+@listens_for(Event, 'after_update')
+def tombstone_moved_event(mapper, connection, target):
+    '''An event moved to another calendar is gone as far as the old calendar is concerned'''
+    old_calendar_ids = db.inspect(target).attrs.calendar_id.history.deleted
+    
+    if old_calendar_ids and old_calendar_ids[0] != target.calendar_id:
+        connection.execute(insert(EventTombstone.__table__).values(event_id=target.id, calendar_id=old_calendar_ids[0]))
 
 
 class Calendar(db.Model):
@@ -163,10 +548,12 @@ class Calendar(db.Model):
     description = db.Column(db.Text)
     is_public = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0') #bumped on every change to the calendar or its events | used for ETags
+    reject_conflicts = db.Column(db.Boolean, nullable=False, default=False, server_default='false') #resource calendars (rooms) can't double book
     
-    owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    owner_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True) #user_home/event_new list a user's calendars
     
-    events = db.relationship('Event', backref='calendar', cascade='all, delete-orphan')
+    events = db.relationship('Event', backref='calendar', cascade='all, delete-orphan', passive_deletes=True)
     
     def serialize(self):
         '''Returns a dictionary representation which we can turn into JSON'''
@@ -175,6 +562,69 @@ class Calendar(db.Model):
             'name': self.name,
             'description': self.description,
             'is_public': self.is_public,
+            'reject_conflicts': self.reject_conflicts,
             'created_at': self.created_at,
             'owner_id': self.owner_id,
         }
+
+
+@listens_for(Calendar, 'after_insert')
+@listens_for(Calendar, 'after_update')
+@listens_for(Calendar, 'after_delete')
+def mark_calendar_stale(mapper, connection, target):
+    '''Cached responses for the calendar (and its events feed) go stale when it changes or goes away,
+    and so does its owner's cached calendar list (both owners' if it changed hands)'''
+    owner_ids = {target.owner_id, *db.inspect(target).attrs.owner_id.history.deleted}
+    mark_stale(f'calendar:{target.id}', *[f'user:{id}' for id in owner_ids if id is not None], session=object_session(target))
+
+
+class CachedResponse(db.Model):
+    '''Shared response cache entries (response_cache.PostgresBackend) | UNLOGGED, it's only a cache so it skips the WAL'''
+    __tablename__ = 'response_cache'
+    __table_args__ = (
+        db.Index('ix_response_cache_tags', 'tags', postgresql_using='gin'), #invalidation by tag
+        db.Index('ix_response_cache_expires_at', 'expires_at'), #eviction
+        {'prefixes': ['UNLOGGED']},
+    )
+    
+    key = db.Column(db.Text, primary_key=True) #path + sorted query string
+    body = db.Column(db.LargeBinary, nullable=False)
+    headers = db.Column(JSONB, nullable=False)
+    tags = db.Column(ARRAY(db.Text), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+
+class Job(db.Model):
+    '''Queued background work (jobs.py) | workers claim them with SELECT ... FOR UPDATE SKIP LOCKED, so any number of them can share the table'''
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_due', 'run_at', postgresql_where=db.text("status IN ('queued', 'running')")), #what the workers poll
+    )
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    kind = db.Column(db.String(50), nullable=False) #name the function was registered under with @jobs.job()
+    args = db.Column(JSONB, nullable=False, default=dict, server_default='{}')
+    status = db.Column(db.String(10), nullable=False, default='queued', server_default='queued') #queued, running, done or failed
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    max_attempts = db.Column(db.Integer, nullable=False, default=5, server_default='5')
+    #queued: when it can next run (retries back off) | running: when the worker's lease runs out and another one may take it over
+    run_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+    result = db.Column(JSONB)
+    error = db.Column(db.Text) #last failure
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    finished_at = db.Column(db.DateTime)
+    
+    def serialize(self):
+        '''Returns a dictionary representation which we can turn into JSON'''
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'args': self.args,
+            'status': self.status,
+            'attempts': self.attempts,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+        }
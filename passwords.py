@@ -0,0 +1,78 @@
+from threading import BoundedSemaphore, Lock
+from flask import current_app, jsonify
+from flask_bcrypt import Bcrypt
+
+DEFAULT_LOG_ROUNDS = 12 #bcrypt work factor when BCRYPT_LOG_ROUNDS isn't set | each +1 doubles the time a hash takes
+
+bcrypt = Bcrypt()
+
+_slots = None #((workers, queue), admitted, running) | only built when PASSWORD_HASH_WORKERS > 0
+_slots_lock = Lock()
+
+
+class HashingBusy(Exception):
+    '''Every hashing slot is taken (PASSWORD_HASH_WORKERS hashing, PASSWORD_HASH_QUEUE waiting) | answered with a 503'''
+
+
+def hashing_busy(error):
+    '''Error handler for HashingBusy | the client can retry in a moment, the spike is usually over by then'''
+
+    return (jsonify(message='Too many logins at once, try again in a moment'), 503, {'Retry-After': '1'})
+
+
+def log_rounds():
+    '''The configured bcrypt work factor (BCRYPT_LOG_ROUNDS)'''
+
+    return current_app.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS)
+
+
+def hash_rounds(hashed):
+    '''Work factor a stored hash was made with | $2b$12$... -> 12'''
+
+    return int(hashed.split('$')[2])
+
+
+def _run(fn, *args):
+    '''Run a hash function in the calling thread, at most PASSWORD_HASH_WORKERS at once (uncapped if it's 0)
+    | only a concurrency cap with load shedding: the request worker is still busy for its whole bcrypt run
+    (a thread pool wouldn't change that, the request would just wait on it), but a login spike can't take
+    every CPU from the other requests | at most PASSWORD_HASH_QUEUE more wait for a slot, past that the request
+    is shed (HashingBusy, a 503) rather than queued behind them'''
+
+    global _slots
+    workers = current_app.config.get('PASSWORD_HASH_WORKERS', 0)
+    if not workers:
+        return fn(*args)
+
+    with _slots_lock:
+        limits = (workers, current_app.config.get('PASSWORD_HASH_QUEUE', 64))
+        if _slots is None or _slots[0] != limits:
+            _slots = (limits, BoundedSemaphore(sum(limits)), BoundedSemaphore(workers)) #hashes in flight keep the ones they took
+        admitted, running = _slots[1], _slots[2]
+
+    if not admitted.acquire(blocking=False):
+        raise HashingBusy()
+    try:
+        with running:
+            return fn(*args)
+    finally:
+        admitted.release()
+
+
+def hash_password(password):
+    '''bcrypt hash (as a utf8 string) of a password with the configured work factor'''
+
+    hashed = _run(bcrypt.generate_password_hash, password, log_rounds())
+    return hashed.decode("utf8") #turn bytestring into normal (unicode utf8) string
+
+
+def check_password(hashed, password):
+    '''Check a password against a stored hash'''
+
+    return _run(bcrypt.check_password_hash, hashed, password)
+
+
+def needs_rehash(hashed):
+    '''Check if a stored hash was made with a different work factor than the configured one'''
+
+    return hash_rounds(hashed) != log_rounds()
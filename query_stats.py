@@ -0,0 +1,113 @@
+from collections import Counter
+from contextlib import contextmanager
+import threading
+import time
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_QUERY_BUDGET = 20 #statements a request can run before it gets logged | QUERY_BUDGET in the config
+REPEATED_QUERY_THRESHOLD = 3 #the same statement this many times in one request is flagged as a possible N+1
+
+
+class QueryStats:
+    '''Statements run (and time spent in the DB) while it is being collected'''
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0 #seconds
+        self.statements = Counter() #SQL text -> times it ran
+
+    def add(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements[statement] += 1
+
+    def repeated(self, threshold=REPEATED_QUERY_THRESHOLD):
+        '''Statements that ran at least threshold times | the usual sign of a lazy load inside a loop (N+1)'''
+        return [(statement, count) for statement, count in self.statements.most_common() if count >= threshold]
+
+
+_local = threading.local() #collectors: QueryStats from this thread's assert_max_queries() blocks
+
+
+def _collectors():
+    '''This thread's collectors | statements from other threads (the listener's keepalive and the event stream hub
+    loading rows) never count against a test running here'''
+    if not hasattr(_local, 'collectors'):
+        _local.collectors = []
+    return _local.collectors
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    '''Add the statement to the current request's stats (and any assert_max_queries block)'''
+    duration = time.perf_counter() - conn.info['query_started'].pop()
+
+    stats = g.get('query_stats') if has_app_context() else None
+    if stats is not None:
+        stats.add(statement, duration)
+    for collector in _collectors():
+        collector.add(statement, duration)
+
+
+@event.listens_for(Engine, 'handle_error')
+def drop_query_timer(context):
+    '''A failed statement never gets to after_cursor_execute'''
+    if context.connection is not None and context.connection.info.get('query_started'):
+        context.connection.info['query_started'].pop()
+
+
+def init_query_stats(app):
+    '''Count and time the SQL of every request | sent back in a Server-Timing header, requests over QUERY_BUDGET get logged'''
+
+    app.before_request(start_request_stats)
+    app.after_request(report_request_stats)
+    app.teardown_request(lambda error: g.pop('query_stats', None))
+
+
+def start_request_stats():
+    g.query_stats = QueryStats()
+
+
+def report_request_stats(response):
+    '''Server-Timing header for the browser dev tools, and a warning log for requests over budget
+    | streamed responses only count the statements run before the body starts'''
+
+    stats = g.get('query_stats')
+    if stats is None:
+        return response
+
+    response.headers.add('Server-Timing', f'db;dur={stats.duration * 1000:.1f};desc="{stats.count} queries"')
+
+    budget = current_app.config.get('QUERY_BUDGET', DEFAULT_QUERY_BUDGET)
+    if stats.count > budget:
+        repeated = '; '.join(f'{count}x {statement[:120]}' for statement, count in stats.repeated())
+        current_app.logger.warning('%s %s ran %d queries (budget %d) in %.1f ms | repeated: %s',
+                                   request.method, request.path, stats.count, budget, stats.duration * 1000, repeated or 'none')
+    return response
+
+
+@contextmanager
+def assert_max_queries(count):
+    '''Fail (AssertionError) if the block runs more than count statements | for tests, to catch N+1 regressions
+    | only statements run by this thread count (the test client runs requests in the calling thread)
+    | with app.test_client() as client:
+    |     with assert_max_queries(2):
+    |         client.get('/user/1')'''
+
+    stats = QueryStats()
+    _collectors().append(stats)
+    try:
+        yield stats
+    finally:
+        _collectors().remove(stats)
+
+    if stats.count > count:
+        statements = '\n'.join(f'  {times}x {statement}' for statement, times in stats.statements.most_common())
+        raise AssertionError(f'{stats.count} queries ran, expected at most {count}:\n{statements}')
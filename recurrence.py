@@ -0,0 +1,117 @@
+from datetime import timedelta
+from functools import lru_cache
+from itertools import islice
+from dateutil.parser import isoparse
+from dateutil.rrule import rrulestr
+
+EXPANSION_CACHE_SIZE = 2048 #expanded (series, window) pairs kept in memory
+SUB_DAILY_PARTS = {'BYHOUR', 'BYMINUTE', 'BYSECOND'} #more than one occurrence a day | the time comes from the event's start
+SUB_DAILY_FREQS = {'HOURLY', 'MINUTELY', 'SECONDLY'}
+MAX_COUNT = 1000 #largest COUNT a rule can have
+MAX_SERIES_YEARS = 20 #latest UNTIL, from the start of the series
+MAX_SERIES_OCCURRENCES = MAX_SERIES_YEARS * 366 + 1 #a daily series up to the latest UNTIL | series_end never goes further
+MAX_WINDOW_OCCURRENCES = 1000 #most occurrences of one series expanded in a window (rules stored before the limits above)
+
+
+def parse_rrule(rrule, start_time):
+    '''Turn an RRULE string (FREQ=WEEKLY;BYDAY=MO,WE;COUNT=10) into a dateutil rule starting at start_time
+    | raises ValueError if the rule is invalid'''
+
+    return rrulestr(rrule, dtstart=start_time)
+
+
+def rule_parts(rrule):
+    '''The NAME=value parts of a rule, names upper cased'''
+
+    parts = (part.partition('=') for part in rrule.split(';'))
+    return {name.strip().upper(): value.strip() for name, _, value in parts}
+
+
+def check_rrule(rrule, start_time=None):
+    '''parse_rrule() for a rule about to be stored, plus the limits that keep expanding it cheap
+    | at most daily, a COUNT up to MAX_COUNT and an UNTIL up to MAX_SERIES_YEARS after start_time (not checked without one)
+    | raises ValueError with a message for the user'''
+
+    try:
+        parse_rrule(rrule, start_time)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid recurrence rule')
+
+    parts = rule_parts(rrule)
+    if parts.get('FREQ', '').upper() in SUB_DAILY_FREQS or SUB_DAILY_PARTS & parts.keys():
+        raise ValueError('Events can repeat at most once a day')
+    if 'COUNT' in parts and int(parts['COUNT']) > MAX_COUNT:
+        raise ValueError(f'A recurring event can have at most {MAX_COUNT} occurrences')
+    if 'UNTIL' in parts and start_time is not None and isoparse(parts['UNTIL']).replace(tzinfo=None) > start_time + timedelta(days=365 * MAX_SERIES_YEARS):
+        raise ValueError(f'A recurring event can repeat for at most {MAX_SERIES_YEARS} years')
+
+
+def is_bounded(rrule):
+    '''Check if a rule ends (has a COUNT or UNTIL) instead of repeating forever'''
+
+    return bool({'COUNT', 'UNTIL'} & rule_parts(rrule).keys())
+
+
+def series_end(rrule, start_time, end_time):
+    '''When the last occurrence of a series ends | None if the series repeats forever
+    | walks the occurrences without keeping them, at most MAX_SERIES_OCCURRENCES (a longer series counts as endless)'''
+
+    if not is_bounded(rrule):
+        return None
+
+    last_start = None
+    for count, last_start in enumerate(islice(parse_rrule(rrule, start_time), MAX_SERIES_OCCURRENCES + 1), 1):
+        pass
+    if last_start is None or count > MAX_SERIES_OCCURRENCES:
+        return None
+    return last_start + (end_time - start_time)
+
+
+def occurrences(rrule, start_time, end_time, window_start, window_end):
+    '''Generator of (start, end) for each occurrence of a series that overlaps the window
+    | occurrences are only computed up to the end of the window, so infinite series are fine
+    | stops after MAX_WINDOW_OCCURRENCES'''
+
+    duration = end_time - start_time
+    rule = parse_rrule(rrule, start_time)
+
+    #an occurrence that started up to one duration before the window is still going when the window starts
+    for occurrence_start in rule.xafter(window_start - duration, count=MAX_WINDOW_OCCURRENCES, inc=True):
+        if occurrence_start >= window_end:
+            return
+        yield (occurrence_start, occurrence_start + duration)
+
+
+@lru_cache(maxsize=EXPANSION_CACHE_SIZE)
+def expand_window(rrule, start_time, end_time, window_start, window_end):
+    '''Cached tuple of the occurrences of a series in a window
+    | keyed on the series' own rule and times, so editing a series can never return its old occurrences'''
+
+    return tuple(occurrences(rrule, start_time, end_time, window_start, window_end))
+
+
+def expand_rows(rows, window_start, window_end):
+    '''Expand feed rows of recurring events into one (start, dict) pair per occurrence in the window
+    | rows come from Event.series_query(), the feed columns plus the raw series_* columns | start is the raw
+    datetime to merge on, the dict may not have a time in it (?fields=id,title)'''
+
+    expanded = []
+
+    for row in rows:
+        event = row._asdict()
+        rrule = event.pop('series_rrule')
+        start_time = event.pop('series_start')
+        end_time = event.pop('series_end_time')
+        all_day = event.pop('series_all_day')
+
+        for occurrence_start, occurrence_end in expand_window(rrule, start_time, end_time, window_start, window_end):
+            occurrence = dict(event)
+            #same formats as the Event feed columns (default and fullcalendar)
+            time_format = '%Y-%m-%d' if all_day else '%Y-%m-%dT%H:%M'
+            for key, value, value_format in [('start_time', occurrence_start, '%Y-%m-%dT%H:%M'), ('end_time', occurrence_end, '%Y-%m-%dT%H:%M'),
+                                             ('start', occurrence_start, time_format), ('end', occurrence_end, time_format)]:
+                if key in occurrence:
+                    occurrence[key] = value.strftime(value_format)
+            expanded.append((occurrence_start, occurrence))
+
+    return expanded
@@ -0,0 +1,207 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+from threading import Lock
+import time
+from urllib.parse import urlencode
+from flask import Response, current_app, g, has_app_context, request
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert
+from models import db, CachedResponse
+from invalidation import invalidates
+from encoding import wants_msgpack
+
+DEFAULT_CACHE_SIZE = 1024 #most responses kept | RESPONSE_CACHE_SIZE in the config
+DEFAULT_CACHE_TTL = 300 #seconds a response is kept even if nothing invalidates it | RESPONSE_CACHE_TTL in the config
+CACHED_HEADERS = ['Content-Type', 'ETag', 'Cache-Control', 'Vary'] #headers a cached response is replayed with
+
+
+class MemoryBackend:
+    '''In-process LRU | each worker has its own copy, the invalidation bus drops other workers' changes from it'''
+
+    shared = False
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict() #key -> (expires_at, body, headers, tags) | least recently used first
+        self.keys_by_tag = {} #tag -> set of keys
+        self.invalidated_at = {} #tag -> when it was last invalidated, so a response built from older data isn't stored
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return (entry[1], entry[2])
+
+    def set(self, key, body, headers, tags, ttl, started):
+        '''Store a response | skipped if one of its tags was invalidated after the request started building it'''
+        with self.lock:
+            if any(self.invalidated_at.get(tag, started - 1) >= started for tag in tags):
+                return
+            self._remove(key)
+            self.entries[key] = (time.monotonic() + ttl, body, headers, tags)
+            for tag in tags:
+                self.keys_by_tag.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, tags):
+        with self.lock:
+            now = time.monotonic()
+            for tag in tags:
+                self.invalidated_at[tag] = now
+                for key in list(self.keys_by_tag.get(tag, ())):
+                    self._remove(key)
+            if len(self.invalidated_at) > 4 * self.max_size:
+                #only requests still running care about old invalidations
+                self.invalidated_at = {tag: at for tag, at in self.invalidated_at.items() if now - at < DEFAULT_CACHE_TTL}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_tag.clear()
+            self.invalidated_at.clear()
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[3]:
+            keys = self.keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_tag[tag]
+
+
+class PostgresBackend:
+    '''Shared by every worker through the UNLOGGED response_cache table | invalidations are seen by all of them right away
+    | runs on its own connections, never inside the request's transaction'''
+
+    shared = True
+
+    EVICT_EVERY = 100 #sets between eviction passes
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.sets = 0
+
+    def get(self, key):
+        with db.engine.connect() as connection:
+            row = connection.execute(select(CachedResponse.body, CachedResponse.headers)
+                                     .where(CachedResponse.key == key, CachedResponse.expires_at > func.now())).first()
+        return (row.body, row.headers) if row else None
+
+    def set(self, key, body, headers, tags, ttl, started):
+        '''Store (or replace) a response | started isn't checked here, a response racing an invalidation lives until its TTL'''
+        values = {'key': key, 'body': body, 'headers': headers, 'tags': list(tags), 'expires_at': datetime.now() + timedelta(seconds=ttl)}
+        statement = insert(CachedResponse).values(values)
+        statement = statement.on_conflict_do_update(index_elements=[CachedResponse.key], set_={name: statement.excluded[name] for name in values if name != 'key'})
+
+        with db.engine.begin() as connection:
+            connection.execute(statement)
+            self.sets += 1
+            if self.sets % self.EVICT_EVERY == 0:
+                self.evict(connection)
+
+    def evict(self, connection):
+        '''Drop expired entries, then the ones closest to expiring until there are at most max_size'''
+        connection.execute(delete(CachedResponse).where(CachedResponse.expires_at <= func.now()))
+        oldest = select(CachedResponse.key).order_by(CachedResponse.expires_at.desc()).offset(self.max_size)
+        connection.execute(delete(CachedResponse).where(CachedResponse.key.in_(oldest)))
+
+    def invalidate(self, tags):
+        with db.engine.begin() as connection:
+            connection.execute(delete(CachedResponse).where(CachedResponse.tags.overlap(list(tags))))
+
+    def clear(self):
+        with db.engine.begin() as connection:
+            connection.execute(delete(CachedResponse))
+
+
+BACKENDS = {'memory': MemoryBackend, 'postgres': PostgresBackend}
+
+
+def init_response_cache(app):
+    '''Pick the backend from RESPONSE_CACHE (memory, postgres or none)'''
+
+    backend = app.config.get('RESPONSE_CACHE', 'memory')
+    if backend == 'none':
+        app.extensions['response_cache'] = None
+        return
+    app.extensions['response_cache'] = BACKENDS[backend](app.config.get('RESPONSE_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+
+
+def get_cache():
+    '''The current app's cache backend | None if caching is off'''
+
+    return current_app.extensions.get('response_cache') if has_app_context() else None
+
+
+def cache_key():
+    '''Path plus the query string in a fixed order, so ?start=&end= and ?end=&start= share an entry
+    | MessagePack responses (Accept: application/msgpack) get entries of their own'''
+
+    key = request.path + '?' + urlencode(sorted(request.args.items(multi=True)))
+    return key + '#msgpack' if wants_msgpack() else key
+
+
+def cached_response(*tag_formats):
+    '''Cache the 200 responses of a GET route, tagged with tag_formats filled in from the URL ('calendar:{id}')
+    | hits are replayed with their ETag, so If-None-Match still gets a 304 | streamed responses are never cached
+    | writes drop the tags they touch once they commit, in every worker (see invalidation.py)'''
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            cache = get_cache()
+            if cache is None:
+                return view(**kwargs)
+
+            key = cache_key()
+            started = time.monotonic()
+            hit = cache.get(key)
+            if hit is not None:
+                body, headers = hit
+                response = Response(body, headers=headers)
+                response.headers['X-Cache'] = 'HIT'
+                return response.make_conditional(request)
+
+            g.cache_tags = []
+            response = current_app.make_response(view(**kwargs))
+            extra_tags = g.pop('cache_tags', [])
+            if response.status_code == 200 and not response.is_streamed:
+                headers = {name: response.headers[name] for name in CACHED_HEADERS if name in response.headers}
+                tags = [tag_format.format(**kwargs) for tag_format in tag_formats] + extra_tags
+                cache.set(key, response.get_data(), headers, tags, current_app.config.get('RESPONSE_CACHE_TTL', DEFAULT_CACHE_TTL), started)
+                response.headers['X-Cache'] = 'MISS'
+            return response
+
+        return wrapper
+    return decorator
+
+
+def add_cache_tags(*tags):
+    '''Extra tags for the response being cached, for what isn't in the URL (the calendar an event is in)'''
+
+    g.setdefault('cache_tags', []).extend(tags)
+
+
+@invalidates('calendar', 'event')
+def drop_stale_responses(tags, remote):
+    '''Drop the cached responses for stale tags (invalidation.py) | the Postgres backend is shared, the worker that
+    made the change already dropped them for everyone'''
+
+    cache = get_cache()
+    if cache is None or (remote and cache.shared):
+        return
+    if tags is None:
+        cache.clear()
+    else:
+        cache.invalidate(tags)
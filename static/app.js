@@ -130,6 +130,10 @@ $(document).ready(function () {
          day: 'Day',
       },
       events: [], //empty array to add the events to | events in here are displayed on the calendar
+      //viewRender runs on load and whenever the month/week/day changes | only fetch the events for the visible range
+      viewRender: function (view) {
+         fetchAndRenderEvents($('#calendar_id').val(), view);
+      },
       //eventClick is when a specific event is clicked | this brings up the edit event form
       eventClick: async function (event, jsEvent, view) {
          console.log('Clicked event >', event);
@@ -215,8 +219,8 @@ $(document).ready(function () {
                if (confirmDelete) {
                   try {
                      await axios.delete(`${BASE_URL}/events/${dbEvent.id}`);
-                     //re render the events on the page and hide the popup
-                     fetchAndRenderEvents($('#calendar_id').val());
+                     //take the event off the page and hide the popup | the live stream sends the same delete to other tabs
+                     $('#calendar').fullCalendar('removeEvents', dbEvent.id);
                      $($editEventFormPopup).css({ display: 'none' });
                   } catch (error) {
                      alert(
@@ -228,42 +232,71 @@ $(document).ready(function () {
       },
    });
 
-   async function fetchAndRenderEvents(calId) {
+   async function fetchAndRenderEvents(calId, view) {
       try {
+         //view.start/view.end are the first and last dates shown on the calendar
          const response = await axios.get(
-            `${BASE_URL}/calendars/${calId}/events`
+            `${BASE_URL}/calendars/${calId}/events`,
+            {
+               params: {
+                  start: view.start.format('YYYY-MM-DD'),
+                  end: view.end.format('YYYY-MM-DD'),
+                  format: 'fullcalendar', //server sends the events already in fullCalendar format
+               },
+            }
          );
          const events = response.data.events;
-         let eventsFormatted = [];
-
-         //loop the events and change them into fullCalendar format
-         events.forEach((event) => {
-            eventsFormatted.push({
-               id: event.id,
-               //if an all_day event, add a star to the title
-               title: event.all_day ? '* ' + event.title : event.title,
-               //if the all_day box is checked, remove the time from the start/end times
-               start: event.all_day
-                  ? event.start_time.split('T')[0]
-                  : event.start_time,
-               end: event.all_day
-                  ? event.end_time.split('T')[0]
-                  : event.end_time,
-               allDay: event.all_day,
-               backgroundColor: event.bg_color,
-               textColor: event.txt_color,
-            });
-         });
          console.log('Response >', response);
-         console.log('Events >', eventsFormatted);
+         console.log('Events >', events);
          $('#calendar').fullCalendar('removeEvents'); //clear any events
-         $('#calendar').fullCalendar('renderEvents', eventsFormatted, true); //add events from DB :)
+         $('#calendar').fullCalendar('renderEvents', events, true); //add events from DB :)
       } catch (error) {
          console.error('Error fetching events:', error);
       }
    }
-   const calendarID = $('#calendar_id').val();
-   fetchAndRenderEvents(calendarID);
+   //live updates | the server pushes every change to this calendar (made here, in another tab or by someone else) as a small message
+   //so the page never refetches the whole view after a create/edit/delete
+   function listenForChanges(calId) {
+      const source = new EventSource(`${BASE_URL}/calendars/${calId}/events/stream`);
+      let connected = false;
+
+      const refetch = function () {
+         fetchAndRenderEvents(calId, $('#calendar').fullCalendar('getView'));
+      };
+
+      //created/updated come with the events ready to render | recurring ones are refetched to get the occurrences in view
+      const renderChanged = function (e) {
+         const events = JSON.parse(e.data).events;
+         if (events.some((event) => event.recurring)) {
+            refetch();
+            return;
+         }
+         events.forEach(function (event) {
+            $('#calendar').fullCalendar('removeEvents', event.id);
+            $('#calendar').fullCalendar('renderEvent', event, true);
+         });
+      };
+
+      source.addEventListener('open', function () {
+         //the browser reconnected after the stream dropped | anything changed in between was missed
+         if (connected) {
+            refetch();
+         }
+         connected = true;
+      });
+      source.addEventListener('created', renderChanged);
+      source.addEventListener('updated', renderChanged);
+      source.addEventListener('deleted', function (e) {
+         JSON.parse(e.data).ids.forEach(function (id) {
+            $('#calendar').fullCalendar('removeEvents', id);
+         });
+      });
+      source.addEventListener('reset', refetch); //too many changes at once, or this tab fell behind
+      source.addEventListener('calendar_deleted', function () {
+         source.close();
+      });
+   }
+   listenForChanges($('#calendar_id').val());
 
    //change the calendar based on the select field
    $('#calendars').on('change', function () {
@@ -273,7 +306,5 @@ $(document).ready(function () {
       window.location.href = `/user/${$(
          '#creator_id'
       ).val()}/calendar/${selectedCalendar}`;
-
-      fetchAndRenderEvents(selectedCalendar);
    });
 });
@@ -2,7 +2,21 @@
 
 from unittest import TestCase
 from app import app
-from models import db, User, Calendar
+from models import db, User, Calendar, Event, Job, bump_calendar_version
+from datetime import datetime
+import os
+import tempfile
+from response_cache import MemoryBackend, PostgresBackend, get_cache
+from query_stats import assert_max_queries
+from jobs import work
+from ics import iter_vevents, snapshot_path, write_snapshot
+from io import BytesIO
+from event_stream import Subscriber, sse_message, RESET
+import json
+import gzip
+import threading
+import encoding
+import api.calendar_routes
 
 # Use test database and don't clutter tests with SQL
 app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///calendar-tests'
@@ -25,6 +39,60 @@ CAL_DATA = {
     'description':"Calendar for personal events",
     'owner_id':1
 }
+ICS_FILE = b"""\xef\xbb\xbfBEGIN:VCALENDAR\r
+VERSION:2.0\r
+PRODID:-//Other Tool//EN\r
+BEGIN:VTIMEZONE\r
+TZID:America/New_York\r
+BEGIN:STANDARD\r
+DTSTART:19701101T020000\r
+END:STANDARD\r
+END:VTIMEZONE\r
+BEGIN:VEVENT\r
+UID:dentist@other.tool\r
+SUMMARY:Dentist\r
+DESCRIPTION:Teeth cleaning\\, bring the form\\nRoom 2\r
+LOCATION:Family Dentist\r
+DTSTART;TZID="America/New_York":20241023T120000\r
+DTEND;TZID="America/New_York":20241023T130000\r
+BEGIN:VALARM\r
+TRIGGER:-PT15M\r
+DESCRIPTION:Reminder\r
+END:VALARM\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:holiday@other.tool\r
+SUMMARY:Holi\r
+ day\r
+DTSTART;VALUE=DATE:20241225\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:standup@other.tool\r
+SUMMARY:Standup\r
+DTSTART:20241021T140000Z\r
+DURATION:PT15M\r
+RRULE:FREQ=WEEKLY;BYDAY=MO;UNTIL=20241111T140000Z\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:standup@other.tool\r
+RECURRENCE-ID:20241028T140000Z\r
+SUMMARY:Standup (moved)\r
+DTSTART:20241028T150000Z\r
+DTEND:20241028T151500Z\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:cancelled@other.tool\r
+STATUS:CANCELLED\r
+SUMMARY:Cancelled\r
+DTSTART:20241024T140000Z\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:dentist@other.tool\r
+SUMMARY:Dentist again\r
+DTSTART:20241030T120000Z\r
+END:VEVENT\r
+END:VCALENDAR\r
+"""
 CAL_DATA2 = {
     'name':"Personal",
     'description':"Calendar for personal events",
@@ -34,6 +102,17 @@ CAL_DATA2 = {
 }
 
 
+def read_messages(stream, count):
+    '''The next count Server-Sent Events messages as (event, data) | skips keep-alive comments'''
+    messages = []
+    while len(messages) < count:
+        for message in next(stream).decode().split('\n\n'):
+            if message.startswith('event: '):
+                kind, data = message.split('\n')
+                messages.append((kind[len('event: '):], json.loads(data[len('data: '):])))
+    return messages
+
+
 class CalendarTestCase(TestCase):
     '''Tests for views of Calendar API'''
 
@@ -55,6 +134,8 @@ class CalendarTestCase(TestCase):
         '''Clean up unsuccessful tests'''
         
         db.session.rollback()
+        db.session.expunge_all() #ids start over in the next test
+        get_cache().clear()
         db.drop_all()
 
 
@@ -133,4 +214,521 @@ class CalendarTestCase(TestCase):
             
             deleted_calendar = Calendar.query.get(self.calendar.id)
             self.assertIsNone(deleted_calendar)
+
+
+    def test_calendar_events_range(self): ############ 06
+        '''Test only events overlapping the start/end window are returned'''
+        october = Event(title="Dentist", start_time='2024-10-23T12:00', end_time='2024-10-23T13:00', calendar_id=1, creator_id=1)
+        november = Event(title="Oil Change", start_time='2024-11-01T09:00', end_time='2024-11-01T10:00', calendar_id=1, creator_id=1)
+        overnight = Event(title="Trip", start_time='2024-10-31T20:00', end_time='2024-11-01T08:00', calendar_id=1, creator_id=1)
+        db.session.add_all([october, november, overnight])
+        db.session.commit()
+        
+        with app.test_client() as client:
+            url = f"/api/calendars/{self.calendar.id}/events"
+            
+            resp = client.get(url)
+            self.assertEqual(len(resp.json['events']), 3)
+            
+            resp = client.get(url, query_string={'start': '2024-11-01', 'end': '2024-12-01'})
+            self.assertEqual(resp.status_code, 200)
+            titles = [event['title'] for event in resp.json['events']]
+            self.assertEqual(titles, ['Trip', 'Oil Change'])
+            
+            resp = client.get(url, query_string={'start': 'not-a-date'})
+            self.assertEqual(resp.status_code, 400)
+            
+            for start, end in [('2024-11-01T00:00Z', '2024-12-01'), ('2024-11-01T00:00-04:00', '2024-12-01T00:00-04:00')]:
+                resp = client.get(url, query_string={'start': start, 'end': end})
+                self.assertEqual(resp.status_code, 400) #UTC offsets can't be compared to the stored local times
+            
+            
+    def test_calendar_events_etag(self): ############ 07
+        '''Test conditional GET on the events feed and that event writes change the ETag'''
+        with app.test_client() as client:
+            url = f"/api/calendars/{self.calendar.id}/events"
+            
+            resp = client.get(url)
+            etag = resp.headers['ETag']
+            self.assertEqual(resp.status_code, 200)
+            
+            resp = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers['ETag'], etag)
+            
+            event = {'title': "Dentist", 'description': "Teeth Cleaning", 'start_time': '2024-10-23T12:00', 'end_time': '2024-10-23T12:00',
+                     'location': 'Family Dentist', 'bg_color': '#e1e1e1', 'txt_color': '#000000', 'all_day': False, 'calendar_id': 1, 'creator_id': 1}
+            client.post("/api/events", json=event)
+            
+            resp = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+            self.assertEqual(len(resp.json['events']), 1)
+            
+            resp = client.get(f"/api/calendars/{self.calendar.id}", headers={'If-None-Match': resp.headers['ETag']})
+            self.assertEqual(resp.status_code, 304)
+            
+            
+    def test_calendar_event_changes(self): ############ 08
+        '''Test delta sync returns only changes and deletions since the cursor'''
+        kept = Event(title="Dentist", start_time='2024-10-23T12:00', end_time='2024-10-23T13:00', calendar_id=1, creator_id=1)
+        removed = Event(title="Oil Change", start_time='2024-11-01T09:00', end_time='2024-11-01T10:00', calendar_id=1, creator_id=1)
+        db.session.add_all([kept, removed])
+        db.session.commit()
+        kept_id, removed_id = kept.id, removed.id
+        
+        with app.test_client() as client:
+            url = f"/api/calendars/{self.calendar.id}/events/changes"
+            
+            resp = client.get(url)
+            self.assertEqual(len(resp.json['events']), 2)
+            cursor = resp.json['cursor']
+            
+            resp = client.get(url, query_string={'since': cursor})
+            self.assertEqual(resp.json, {'events': [], 'deleted': [], 'cursor': cursor})
+            
+            client.patch(f"/api/events/{kept_id}", json={"title": "Updated Title"})
+            client.delete(f"/api/events/{removed_id}")
+            
+            resp = client.get(url, query_string={'since': cursor})
+            self.assertEqual([event['title'] for event in resp.json['events']], ['Updated Title'])
+            self.assertEqual(resp.json['deleted'], [removed_id])
+            self.assertGreater(resp.json['cursor'], cursor)
+            
+            client.post("/api/events/batch", json={'delete': [kept_id]})
+            
+            resp = client.get(url, query_string={'since': resp.json['cursor']})
+            self.assertEqual(resp.json['events'], [])
+            self.assertEqual(resp.json['deleted'], [kept_id])
+            
+            
+    def test_calendar_events_fullcalendar(self): ############ 09
+        '''Test the fullcalendar format and sparse fieldsets'''
+        db.session.add_all([
+            Event(title="Dentist", start_time='2024-10-23T12:00', end_time='2024-10-23T13:00', calendar_id=1, creator_id=1),
+            Event(title="Vacation", start_time='2024-10-24T00:00', end_time='2024-10-26T00:00', all_day=True, bg_color='#51b749', calendar_id=1, creator_id=1),
+        ])
+        db.session.commit()
+        
+        with app.test_client() as client:
+            url = f"/api/calendars/{self.calendar.id}/events"
+            
+            resp = client.get(url, query_string={'format': 'fullcalendar'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['events'], [
+                {'id': 1, 'title': 'Dentist', 'start': '2024-10-23T12:00', 'end': '2024-10-23T13:00',
+                 'allDay': False, 'backgroundColor': '#e1e1e1', 'textColor': '#000000'},
+                {'id': 2, 'title': '* Vacation', 'start': '2024-10-24', 'end': '2024-10-26',
+                 'allDay': True, 'backgroundColor': '#51b749', 'textColor': '#000000'},
+            ])
+            
+            resp = client.get(url, query_string={'fields': 'title,start_time'})
+            self.assertEqual(resp.json['events'][0], {'id': 1, 'title': 'Dentist', 'start_time': '2024-10-23T12:00'})
+            
+            resp = client.get(url, query_string={'format': 'fullcalendar', 'fields': 'title,location'})
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json['message'], 'Unknown fields: location')
+            
+            
+    def test_calendar_events_recurring(self): ############ 10
+        '''Test a recurring series is stored once and expanded inside the window'''
+        weekly = Event(title="Standup", start_time='2024-10-07T09:00', end_time='2024-10-07T09:30', rrule='FREQ=WEEKLY', calendar_id=1, creator_id=1)
+        finished = Event(title="Class", start_time='2024-09-02T18:00', end_time='2024-09-02T20:00', rrule='FREQ=DAILY;COUNT=3', calendar_id=1, creator_id=1)
+        db.session.add_all([weekly, finished])
+        db.session.commit()
+        
+        with app.test_client() as client:
+            url = f"/api/calendars/{self.calendar.id}/events"
+            
+            resp = client.get(url, query_string={'start': '2024-11-01', 'end': '2024-12-01'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([event['start_time'] for event in resp.json['events']],
+                             ['2024-11-04T09:00', '2024-11-11T09:00', '2024-11-18T09:00', '2024-11-25T09:00'])
+            self.assertEqual({event['id'] for event in resp.json['events']}, {weekly.id})
+            
+            resp = client.get(url, query_string={'start': '2024-11-01', 'end': '2024-11-08', 'format': 'fullcalendar', 'fields': 'start,end'})
+            self.assertEqual(resp.json['events'], [{'id': weekly.id, 'start': '2024-11-04T09:00', 'end': '2024-11-04T09:30'}])
+            
+            self.assertEqual(Event.query.count(), 2)
+            
+            single = Event(title="Dentist", start_time='2024-11-05T12:00', end_time='2024-11-05T13:00', calendar_id=1, creator_id=1)
+            db.session.add(single)
+            bump_calendar_version(self.calendar.id)
+            db.session.commit()
+            resp = client.get(url, query_string={'start': '2024-11-01', 'end': '2024-11-15', 'fields': 'title'}) #no times to sort on in the rows
+            self.assertEqual([event['title'] for event in resp.json['events']], ['Standup', 'Dentist', 'Standup'])
+            
+            resp = client.get(url, query_string={'start': '2024-11-01T00:00Z', 'end': '2024-11-08T00:00Z'})
+            self.assertEqual(resp.status_code, 400)
+            resp = client.get(url, query_string={'start': '2024-01-01', 'end': '2124-01-01'}) #longer than MAX_WINDOW_DAYS
+            self.assertEqual(resp.status_code, 400)
+
+
+    def test_calendar_response_cache(self): ############ 11
+        '''Test calendar responses are served from the cache until a write to the calendar commits, with both backends'''
+        backend = app.extensions['response_cache']
+        event_data = {'title': 'Dentist', 'description': 'Teeth Cleaning', 'start_time': '2024-10-23T12:00', 'end_time': '2024-10-23T13:00',
+                      'location': 'Family Dentist', 'bg_color': '#e1e1e1', 'txt_color': '#000000', 'all_day': False, 'calendar_id': 1, 'creator_id': 1}
+        try:
+            for cache in [MemoryBackend(), PostgresBackend()]:
+                app.extensions['response_cache'] = cache
+                cache.clear()
+                
+                with app.test_client() as client:
+                    url = f"/api/calendars/{self.calendar.id}/events?start=2024-10-01&end=2024-11-01"
+                    
+                    self.assertEqual(client.get(url).headers['X-Cache'], 'MISS')
+                    resp = client.get(url)
+                    self.assertEqual(resp.headers['X-Cache'], 'HIT')
+                    self.assertEqual(resp.json['events'], [])
+                    self.assertEqual(client.get(url, headers={'If-None-Match': resp.headers['ETag']}).status_code, 304)
+                    self.assertEqual(client.get(f"/api/calendars/{self.calendar.id}?other=1").headers['X-Cache'], 'MISS')
+                    
+                    resp = client.post("/api/events", json=event_data)
+                    event_id = resp.json['event']['id']
+                    
+                    resp = client.get(url)
+                    self.assertEqual(resp.headers['X-Cache'], 'MISS')
+                    self.assertEqual([event['title'] for event in resp.json['events']], ['Dentist'])
+                    
+                    self.assertEqual(client.get(f"/api/events/{event_id}").headers['X-Cache'], 'MISS')
+                    client.patch(f"/api/events/{event_id}", json={'title': 'Checkup'})
+                    self.assertEqual(client.get(f"/api/events/{event_id}").json['event']['title'], 'Checkup')
+                    self.assertEqual(client.get(url).json['events'][0]['title'], 'Checkup')
+                    
+                    client.patch(f"/api/calendars/{self.calendar.id}", json={'name': 'Renamed'})
+                    self.assertEqual(client.get(f"/api/calendars/{self.calendar.id}?other=1").json['calendar']['name'], 'Renamed')
+                    
+                    client.delete(f"/api/events/{event_id}")
+                    self.assertEqual(client.get(f"/api/events/{event_id}").status_code, 404)
+                    self.assertEqual(client.get(url).json['events'], [])
+                
+                cache.clear()
+        finally:
+            app.extensions['response_cache'] = backend
+
+
+
+    def test_response_cache_eviction(self): ############ 12
+        '''Test the in-process cache drops the least recently used response when full, and expired ones'''
+        cache = MemoryBackend(max_size=2)
+        
+        cache.set('a', b'a', {}, ['calendar:1'], 60, 0)
+        cache.set('b', b'b', {}, ['calendar:2'], 60, 0)
+        cache.get('a')
+        cache.set('c', b'c', {}, ['calendar:3'], -1, 0)
+        
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b')) #least recently used
+        self.assertIsNone(cache.get('c')) #expired
+        
+        cache.invalidate(['calendar:1'])
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.keys_by_tag, {})
+
+
+    def test_delete_calendar_cascade(self): ############ 13
+        '''Test a calendar and its events go in one DELETE, cached event responses with them, and the background mode'''
+        db.session.add_all([Event(title=f"Event {n}", start_time=f'2024-10-{n + 1:02}T12:00', end_time=f'2024-10-{n + 1:02}T13:00',
+                                  calendar_id=1, creator_id=1) for n in range(25)])
+        db.session.commit()
+        event_id = Event.query.first().id
+        
+        with app.test_client() as client:
+            self.assertEqual(client.get(f"/api/events/{event_id}").status_code, 200)
+            
+            with assert_max_queries(3) as stats: #load the calendar, delete it, the NOTIFYs as it commits
+                resp = client.delete(f"/api/calendars/{self.calendar.id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(sum(count for statement, count in stats.statements.items() if statement.startswith('DELETE')), 1)
+            
+            self.assertEqual(Event.query.count(), 0)
+            self.assertEqual(client.get(f"/api/events/{event_id}").status_code, 404)
+            
+            calendar = Calendar(name="Big", owner_id=self.user.id)
+            db.session.add(calendar)
+            db.session.flush()
+            db.session.add_all([Event(title=f"Event {n}", start_time='2024-10-23T12:00', end_time='2024-10-23T13:00',
+                                      calendar_id=calendar.id, creator_id=self.user.id) for n in range(25)])
+            db.session.commit()
+            calendar_id = calendar.id
+            
+            api.calendar_routes.DELETE_BATCH_SIZE = 10
+            try:
+                resp = client.delete(f"/api/calendars/{calendar_id}", query_string={'background': 'true'})
+                self.assertEqual(resp.status_code, 202)
+                self.assertEqual(resp.json['job']['status'], 'queued')
+                self.assertIsNotNone(Calendar.query.get(calendar_id)) #nothing happens until a worker runs it
+                
+                self.assertEqual(work(burst=True), 1)
+            finally:
+                api.calendar_routes.DELETE_BATCH_SIZE = 5000
+            
+            resp = client.get(resp.headers['Location'])
+            self.assertEqual(resp.json['job']['status'], 'done')
+            self.assertEqual(resp.json['job']['result'], {'events_deleted': 25})
+            
+            db.session.expire_all()
+            self.assertIsNone(Calendar.query.get(calendar_id))
+            self.assertEqual(Event.query.count(), 0)
+
+
+    def test_import_ics(self): ############ 14
+        '''Test importing an .ics file maps its VEVENTs onto events and skips UIDs already in the calendar'''
+        with app.test_client() as client:
+            url = f"/api/calendars/{self.calendar.id}/import"
+            
+            resp = client.post(url, data={'file': (BytesIO(ICS_FILE), 'export.ics')}, query_string={'tz': 'America/New_York'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {'imported': 3, 'duplicates': 1, 'conflicts': 0, 'skipped': 2}) #moved occurrence, cancelled
+            
+            events = {event.uid: event for event in Event.query.filter_by(calendar_id=self.calendar.id)}
+            dentist = events['dentist@other.tool']
+            self.assertEqual((dentist.title, dentist.location), ('Dentist', 'Family Dentist'))
+            self.assertEqual(dentist.description, 'Teeth cleaning, bring the form\nRoom 2')
+            self.assertEqual((dentist.start_time, dentist.end_time), (datetime(2024, 10, 23, 12), datetime(2024, 10, 23, 13)))
+            
+            holiday = events['holiday@other.tool']
+            self.assertEqual((holiday.title, holiday.all_day), ('Holiday', True))
+            self.assertEqual((holiday.start_time, holiday.end_time), (datetime(2024, 12, 25), datetime(2024, 12, 26)))
+            
+            standup = events['standup@other.tool']
+            self.assertEqual((standup.start_time, standup.end_time), (datetime(2024, 10, 21, 10), datetime(2024, 10, 21, 10, 15)))
+            self.assertEqual(standup.rrule, 'FREQ=WEEKLY;BYDAY=MO;UNTIL=20241111T235959') #still has 11/11, after New York's DST change
+            self.assertEqual(standup.series_end, datetime(2024, 11, 11, 10, 15))
+            
+            resp = client.post(url, data=ICS_FILE, content_type='text/calendar')
+            self.assertEqual(resp.json['imported'], 0)
+            self.assertEqual(resp.json['duplicates'], 4)
+            
+            #in a calendar that rejects conflicts the file's own events can't overlap each other
+            room = Calendar(name="Room", owner_id=self.user.id, reject_conflicts=True)
+            db.session.add(room)
+            db.session.commit()
+            vevent = lambda uid, start, end, *extra: [b'BEGIN:VEVENT', b'UID:' + uid, b'DTSTART:' + start, b'DTEND:' + end, *extra, b'END:VEVENT']
+            overlapping = b'\r\n'.join([b'BEGIN:VCALENDAR',
+                                         *vevent(b'daily', b'20241021T100000', b'20241021T110000', b'RRULE:FREQ=DAILY;COUNT=5'),
+                                         *vevent(b'in-series', b'20241023T103000', b'20241023T113000'),
+                                         *vevent(b'after-series', b'20241026T100000', b'20241026T110000'),
+                                         *vevent(b'overlaps-previous', b'20241026T103000', b'20241026T113000'),
+                                         b'END:VCALENDAR', b''])
+            resp = client.post(f"/api/calendars/{room.id}/import", data=overlapping, content_type='text/calendar')
+            self.assertEqual((resp.json['imported'], resp.json['conflicts']), (2, 2))
+            self.assertEqual({event.uid for event in Event.query.filter_by(calendar_id=room.id)}, {'daily', 'after-series'})
+            
+            resp = client.post(url, data=b'<html></html>', content_type='text/calendar')
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(client.post(url, query_string={'tz': 'Mars/Olympus'}).status_code, 400)
+
+
+    def test_import_ics_background(self): ############ 15
+        '''Test a background import saves the upload for the worker and reports the counts on the job'''
+        with app.test_client() as client:
+            resp = client.post(f"/api/calendars/{self.calendar.id}/import", data=ICS_FILE, content_type='text/calendar',
+                               query_string={'background': 'true'})
+            self.assertEqual(resp.status_code, 202)
+            path = Job.query.get(resp.json['job']['id']).args['path']
+            self.assertTrue(os.path.exists(path))
+            
+            self.assertEqual(work(burst=True), 1)
+            
+            job = client.get(resp.headers['Location']).json['job']
+            self.assertEqual(job['status'], 'done')
+            self.assertEqual(job['result']['imported'], 3)
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual(Event.query.count(), 3)
+
+
+    def test_calendar_feed(self): ############ 16
+        '''Test the .ics feed of a public calendar, served from a snapshot until the calendar changes'''
+        app.config['FEED_DIR'] = tempfile.mkdtemp()
+        db.session.add_all([
+            Event(title="Dentist", description="Cleaning, bring the form\nRoom 2", location="Family Dentist",
+                  start_time='2024-10-23T12:00', end_time='2024-10-23T13:00', calendar_id=1, creator_id=1),
+            Event(title="Holiday", start_time='2024-12-25T00:00', end_time='2024-12-26T00:00', all_day=True, calendar_id=1, creator_id=1),
+            Event(title="Standup", description="Long " * 40, start_time='2024-10-21T10:00', end_time='2024-10-21T10:15',
+                  rrule='FREQ=WEEKLY;BYDAY=MO', calendar_id=1, creator_id=1),
+        ])
+        db.session.commit()
+        
+        with app.test_client() as client:
+            url = f"/api/calendars/{self.calendar.id}/feed.ics"
+            self.assertEqual(client.get(url).status_code, 404) #not public
+            
+            self.calendar.is_public = True
+            bump_calendar_version(self.calendar.id)
+            db.session.commit()
+            
+            resp = client.get(url, headers={'Host': 'evil.example'}) #first hit writes the snapshot everyone gets
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'text/calendar')
+            self.assertNotIn(b'evil.example', resp.data)
+            self.assertIn(f"PRODID:-//{app.config['FEED_DOMAIN']}//Calendar//EN".encode(), resp.data)
+            self.assertIn('max-age=900', resp.headers['Cache-Control'])
+            self.assertTrue(all(len(line) <= 75 for line in resp.data.split(b'\r\n')))
+            
+            vevents = {vevent['SUMMARY'][1]: vevent for vevent in iter_vevents(BytesIO(resp.data))}
+            self.assertEqual(vevents['Dentist']['DESCRIPTION'][1], 'Cleaning\\, bring the form\\nRoom 2')
+            self.assertEqual(vevents['Dentist']['DTSTART'][1], '20241023T120000')
+            self.assertEqual(vevents['Holiday']['DTSTART'], ({'VALUE': 'DATE'}, '20241225'))
+            self.assertEqual(vevents['Standup']['RRULE'][1], 'FREQ=WEEKLY;BYDAY=MO')
+            self.assertEqual(vevents['Standup']['DESCRIPTION'][1], 'Long ' * 40) #folded and unfolded back
+            self.assertTrue(vevents['Dentist']['UID'][1].endswith(f"@{app.config['FEED_DOMAIN']}"))
+            
+            snapshots = os.listdir(app.config['FEED_DIR'])
+            self.assertEqual(len(snapshots), 1)
+            
+            with assert_max_queries(1): #just the calendar
+                again = client.get(url)
+            self.assertEqual(again.data, resp.data)
+            self.assertEqual(client.get(url, headers={'If-None-Match': resp.headers['ETag']}).status_code, 304)
+            
+            client.patch(f"/api/events/{Event.query.filter_by(title='Dentist').one().id}", json={'title': 'Checkup'})
+            resp = client.get(url)
+            self.assertIn(b'SUMMARY:Checkup', resp.data)
+            self.assertNotEqual(os.listdir(app.config['FEED_DIR']), snapshots) #old version replaced
+            self.assertEqual(len(os.listdir(app.config['FEED_DIR'])), 1)
             
+            #a slow client still streaming this version mustn't remove the next one a faster request already saved
+            db.session.refresh(self.calendar)
+            newer = snapshot_path(app.config['FEED_DIR'], Calendar(id=self.calendar.id, version=self.calendar.version + 1))
+            open(newer, 'wb').close()
+            list(write_snapshot(app.config['FEED_DIR'], self.calendar, app.config['FEED_DOMAIN']))
+            self.assertTrue(os.path.exists(newer))
+            self.assertEqual(len(os.listdir(app.config['FEED_DIR'])), 2)
+            
+            client.delete(f"/api/calendars/{self.calendar.id}")
+            self.assertEqual(os.listdir(app.config['FEED_DIR']), [])
+
+
+    def test_calendar_event_stream(self): ############ 17
+        '''Test the live stream gets the events created, updated and deleted through the API (and batches), and ends with the calendar'''
+        app.config['EVENT_STREAM_HEARTBEAT'] = 1
+        event_data = {'title': "Dentist", 'description': "Teeth Cleaning", 'start_time': '2024-10-23T12:00', 'end_time': '2024-10-23T13:00',
+                      'location': 'Family Dentist', 'bg_color': '#e1e1e1', 'txt_color': '#000000', 'all_day': False,
+                      'calendar_id': self.calendar.id, 'creator_id': self.user.id}
+        
+        with app.test_client() as client:
+            self.assertEqual(client.get("/api/calendars/999/events/stream").status_code, 404)
+            
+            resp = client.get(f"/api/calendars/{self.calendar.id}/events/stream", buffered=False)
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+            stream = iter(resp.response)
+            self.assertEqual(next(stream), b'retry: 3000\n\n') #listening from here on
+            
+            event_id = client.post("/api/events", json=event_data).json['event']['id']
+            [(kind, data)] = read_messages(stream, 1)
+            self.assertEqual(kind, 'created')
+            self.assertEqual(data['events'], [{'id': event_id, 'title': 'Dentist', 'start': '2024-10-23T12:00', 'end': '2024-10-23T13:00',
+                                               'allDay': False, 'backgroundColor': '#e1e1e1', 'textColor': '#000000', 'recurring': False}])
+            
+            client.patch(f"/api/events/{event_id}", json={'title': 'Checkup'})
+            [(kind, data)] = read_messages(stream, 1)
+            self.assertEqual((kind, data['events'][0]['title']), ('updated', 'Checkup'))
+            
+            resp = client.post("/api/events/batch", json={'create': [{**event_data, 'title': 'Standup', 'start_time': '2024-10-24T09:00', 'end_time': '2024-10-24T09:15'}],
+                                                          'delete': [event_id]})
+            new_id = resp.json['results']['create'][0]['event']['id']
+            messages = dict(read_messages(stream, 2))
+            self.assertEqual([event['id'] for event in messages['created']['events']], [new_id])
+            self.assertEqual(messages['deleted'], {'ids': [event_id]})
+            
+            client.delete(f"/api/calendars/{self.calendar.id}")
+            self.assertEqual(read_messages(stream, 1), [('calendar_deleted', {})])
+            self.assertEqual(list(stream), []) #the stream ended
+            self.assertEqual(app.extensions['event_stream'].subscribers, {})
+
+
+    def test_event_stream_slow_client(self): ############ 18
+        '''Test a stream that falls too far behind gets a single reset instead of the messages it missed'''
+        subscriber = Subscriber(self.calendar.id, size=3)
+        
+        for event_id in range(3):
+            subscriber.put(sse_message('deleted', {'ids': [event_id]}))
+        self.assertEqual(len(subscriber.take(0)), 3)
+        
+        for event_id in range(4):
+            subscriber.put(sse_message('deleted', {'ids': [event_id]}))
+        self.assertEqual(subscriber.take(0), [RESET])
+        self.assertEqual(subscriber.take(0), [])
+
+
+    def test_response_encodings(self): ############ 19
+        '''Test ISO datetimes whatever JSON encoder runs, br/gzip negotiation (whole and streamed bodies) and MessagePack feeds'''
+        calendar = self.calendar.serialize()
+        self.assertEqual(app.json.dumps(calendar), json.dumps(calendar, default=encoding.iso_default, sort_keys=True, separators=(',', ':')))
+        
+        calendar['name'] = 'Café ☕ 日本' #same bytes (and ETag) whichever encoder runs
+        fast, fast_body = app.json.dumps(calendar), app.json.response(calendar=calendar).data
+        installed, encoding.orjson = encoding.orjson, None
+        try:
+            self.assertEqual(app.json.dumps(calendar), fast)
+            self.assertEqual(app.json.response(calendar=calendar).data, fast_body)
+        finally:
+            encoding.orjson = installed
+        self.assertIn('Café ☕ 日本', fast)
+        
+        db.session.add_all([Event(title=f"Meeting {n}", description="Weekly sync", start_time=f'2024-10-{n + 10}T12:00', end_time=f'2024-10-{n + 10}T13:00',
+                                  calendar_id=self.calendar.id, creator_id=self.user.id) for n in range(10)])
+        bump_calendar_version(self.calendar.id)
+        db.session.commit()
+        
+        with app.test_client() as client:
+            resp = client.get(f"/api/calendars/{self.calendar.id}", headers={'Accept-Encoding': 'gzip'})
+            self.assertNotIn('Content-Encoding', resp.headers) #too small to be worth it
+            self.assertEqual(resp.json['calendar']['created_at'], self.calendar.created_at.isoformat())
+            
+            url = f"/api/calendars/{self.calendar.id}/events"
+            plain = client.get(url)
+            self.assertNotIn('Content-Encoding', plain.headers)
+            
+            resp = client.get(url, headers={'Accept-Encoding': 'gzip, deflate, br;q=0'})
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(resp.headers['X-Cache'], 'HIT')
+            self.assertEqual(gzip.decompress(resp.data), plain.data)
+            self.assertEqual(set(resp.vary), {'Accept', 'Accept-Encoding'})
+            self.assertEqual(resp.get_etag(), (plain.get_etag()[0], True)) #same version, different bytes
+            self.assertEqual(client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': resp.headers['ETag']}).status_code, 304)
+            
+            resp = client.get("/api/events?format=ndjson", headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(len(gzip.decompress(resp.data).splitlines()), 10)
+            
+            resp = client.get(url, headers={'Accept-Encoding': 'gzip, br'})
+            self.assertEqual(resp.headers['Content-Encoding'], 'br') #best first
+            self.assertEqual(encoding.brotli.decompress(resp.data), plain.data)
+            
+            resp = client.get(url, headers={'Accept': 'application/msgpack'})
+            self.assertEqual(resp.mimetype, 'application/msgpack')
+            self.assertEqual(encoding.msgpack.unpackb(resp.data), plain.json)
+            self.assertNotEqual(resp.headers['ETag'], plain.headers['ETag'])
+
+
+    def test_event_changes_commit_order(self): ############ 20
+        '''Test a write that starts while another transaction holds the calendar waits for it before taking a change_seq,
+        so a cursor handed out in between can't skip it'''
+        bump_calendar_version(self.calendar.id) #an open write in this session
+        
+        created = []
+        def other_request():
+            with app.test_client() as client:
+                created.append(client.post("/api/events", json={'title': 'Second', 'description': None, 'start_time': '2024-10-24T12:00',
+                                                                'end_time': '2024-10-24T13:00', 'location': None, 'bg_color': '#e1e1e1',
+                                                                'txt_color': '#000000', 'all_day': False, 'calendar_id': 1, 'creator_id': 1}).json['event'])
+        thread = threading.Thread(target=other_request)
+        thread.start()
+        thread.join(0.5)
+        self.assertTrue(thread.is_alive()) #waiting for the calendar
+        
+        db.session.add(Event(title="First", start_time='2024-10-23T12:00', end_time='2024-10-23T13:00', calendar_id=1, creator_id=1))
+        db.session.commit()
+        
+        with app.test_client() as client:
+            url = f"/api/calendars/{self.calendar.id}/events/changes"
+            first_sync = client.get(url).json #Second may or may not be in yet
+            thread.join()
+            
+            resp = client.get(url)
+            self.assertEqual([event['title'] for event in resp.json['events']], ['First', 'Second']) #in change_seq order
+            next_sync = client.get(url, query_string={'since': first_sync['cursor']}).json
+            self.assertEqual({event['title'] for event in first_sync['events'] + next_sync['events']}, {'First', 'Second'})
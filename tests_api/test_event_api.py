@@ -1,8 +1,14 @@
 # python -m unittest tests_api.test_calendar_api
 
+import json
+import threading
+from datetime import datetime, timezone
 from unittest import TestCase
-from app import app
-from models import db, User, Calendar, Event
+from app import app, CURR_USER_KEY
+from models import db, User, Calendar, Event, bump_calendar_version, find_conflicts
+from user_cache import clear_users
+from response_cache import get_cache
+from api.helpers import DEFAULT_PAGE_SIZE
 
 # Use test database and don't clutter tests with SQL
 app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///calendar-tests'
@@ -10,6 +16,7 @@ app.config['SQLALCHEMY_ECHO'] = False
 
 # Make Flask errors be real errors, rather than HTML pages with error info
 app.config['TESTING'] = True
+app.config['SECRET_KEY'] = 'testing' #so the search test can log in through the session
 
 db.drop_all()
 db.create_all()
@@ -70,6 +77,9 @@ class EventTestCase(TestCase):
         '''Clean up unsuccessful tests'''
         
         db.session.rollback()
+        db.session.expunge_all() #g.user from a logged in request would otherwise keep the old user in the session
+        clear_users()
+        get_cache().clear() #ids start over in the next test
         db.drop_all()
 
 
@@ -162,4 +172,218 @@ class EventTestCase(TestCase):
             
             deleted_event = Event.query.get(self.event.id)
             self.assertIsNone(deleted_event)
+
+
+    def test_list_events_pagination(self): ############ 06
+        '''Test keyset pagination with after_id/limit'''
+        db.session.add_all([Event(**EVENT_DATA), Event(**EVENT_DATA)])
+        db.session.commit()
+        
+        with app.test_client() as client:
+            resp = client.get("/api/events", query_string={'limit': 2})
+            
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([event['id'] for event in resp.json['events']], [1, 2])
+            self.assertEqual(resp.json['next_after_id'], 2)
+            
+            resp = client.get("/api/events", query_string={'limit': 2, 'after_id': 2})
+            self.assertEqual([event['id'] for event in resp.json['events']], [3])
+            self.assertIsNone(resp.json['next_after_id'])
+            
+            db.session.add_all([Event(**EVENT_DATA) for n in range(DEFAULT_PAGE_SIZE)])
+            db.session.commit()
+            resp = client.get("/api/events") #no ?limit= is still one page, not the whole table
+            self.assertEqual(len(resp.json['events']), DEFAULT_PAGE_SIZE)
+            self.assertEqual(resp.json['next_after_id'], DEFAULT_PAGE_SIZE)
+            
+            
+    def test_list_events_ndjson(self): ############ 07
+        '''Test streaming events as newline delimited JSON'''
+        db.session.add(Event(**EVENT_DATA))
+        db.session.commit()
+        
+        with app.test_client() as client:
+            resp = client.get("/api/events", query_string={'format': 'ndjson', 'after_id': 1})
+            
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'application/x-ndjson')
+            
+            lines = resp.get_data(as_text=True).splitlines()
+            self.assertEqual(len(lines), 1)
+            self.assertEqual(json.loads(lines[0])['id'], 2)
+            
+            
+    def test_batch_events(self): ############ 08
+        '''Test creating, updating and deleting events in one batch'''
+        other = Event(**EVENT_DATA)
+        db.session.add(other)
+        db.session.commit()
+        other_id = other.id
+        
+        with app.test_client() as client:
+            batch = {
+                'create': [EVENT_DATA2, {**EVENT_DATA2, 'title': 'Checkup'}],
+                'update': [{'id': self.event.id, 'title': 'Updated Title', 'end_time': '2024-10-23T13:00'}],
+                'delete': [other_id],
+            }
+            resp = client.post("/api/events/batch", json=batch)
+            
+            self.assertEqual(resp.status_code, 200)
+            
+            results = resp.json['results']
+            self.assertEqual([result['event']['title'] for result in results['create']], ['Dentist', 'Checkup'])
+            self.assertEqual(results['update'][0]['event']['title'], 'Updated Title')
+            self.assertEqual(results['update'][0]['event']['end_time'], '2024-10-23T13:00')
+            self.assertEqual(results['delete'], [{'id': other_id, 'status': 200}])
+            
+            self.assertEqual(Event.query.count(), 3)
+            self.assertIsNone(Event.query.get(other_id))
+            self.assertIsNotNone(Event.query.get(results['create'][0]['event']['id']).created_at)
+            
+            resp = client.post("/api/events/batch", json={'create': [{**EVENT_DATA2, 'title': 'Class', 'rrule': 'FREQ=DAILY;COUNT=3'}, EVENT_DATA2]})
+            self.assertEqual(resp.status_code, 200)
+            series = Event.query.get(resp.json['results']['create'][0]['event']['id'])
+            self.assertEqual((series.rrule, series.series_end), ('FREQ=DAILY;COUNT=3', datetime(2024, 10, 25, 12, 0)))
+            
+            resp = client.post("/api/events/batch", json={'update': [{'id': series.id, 'rrule': 'FREQ=SOMETIMES'}]})
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json['results']['update'][0]['error'], 'Invalid recurrence rule')
+            
+            resp = client.post("/api/events/batch", json={'update': [{'id': series.id, 'rrule': 'FREQ=SECONDLY;COUNT=100000000'}]})
+            self.assertEqual(resp.json['results']['update'][0]['error'], 'Events can repeat at most once a day')
+            resp = client.post("/api/events", json={**EVENT_DATA2, 'rrule': 'FREQ=DAILY;COUNT=100000'})
+            self.assertEqual(resp.status_code, 400)
+            
+            
+    def test_batch_events_invalid(self): ############ 09
+        '''Test a batch with a bad item applies nothing'''
+        with app.test_client() as client:
+            batch = {
+                'create': [EVENT_DATA2],
+                'update': [{'id': self.event.id, 'end_time': '2024-10-22T12:00'}],
+                'delete': [999],
+            }
+            resp = client.post("/api/events/batch", json=batch)
+            
+            self.assertEqual(resp.status_code, 400)
+            
+            results = resp.json['results']
+            self.assertEqual(results['create'][0], {'status': 201})
+            self.assertEqual(results['update'][0]['error'], 'End time must be after start time')
+            self.assertEqual(results['delete'][0]['status'], 404)
+            self.assertEqual(Event.query.count(), 1)
+            
+            batch = {
+                'create': [{**EVENT_DATA2, 'calendar_id': 'abc'}, {**EVENT_DATA2, 'title': 'x' * 51, 'all_day': 'yes'}],
+                'update': [{'id': 'abc', 'title': 'Renamed'}],
+                'delete': ['abc', 2**40, self.event.id],
+            }
+            resp = client.post("/api/events/batch", json=batch) #bad types are reported per item, never sent to Postgres
+            self.assertEqual(resp.status_code, 400)
+            results = resp.json['results']
+            self.assertEqual([result['error'] for result in results['create']],
+                             ['calendar_id must be an integer id', 'title can be at most 50 characters, all_day must be true or false'])
+            self.assertEqual(results['update'][0]['error'], 'id must be an integer')
+            self.assertEqual([result['status'] for result in results['delete']], [400, 400, 200])
+            self.assertEqual(Event.query.count(), 1)
+            
+            for batch in [[], {'delete': 1}, {'create': {'title': 'Dentist'}}]:
+                resp = client.post("/api/events/batch", json=batch)
+                self.assertEqual(resp.status_code, 400)
+            
+            
+    def test_create_event_conflict(self): ############ 10
+        '''Test overlapping events are rejected in a calendar with reject_conflicts'''
+        self.event.end_time = datetime(2024, 10, 23, 13, 0)
+        self.calendar.reject_conflicts = True
+        db.session.commit()
+        
+        with app.test_client() as client:
+            resp = client.post("/api/events", json={**EVENT_DATA2, 'start_time': '2024-10-23T12:30', 'end_time': '2024-10-23T14:00'})
+            
+            self.assertEqual(resp.status_code, 409)
+            self.assertEqual(resp.json['conflicts'][0]['id'], self.event.id)
+            self.assertEqual(Event.query.count(), 1)
+            
+            #back to back is fine
+            resp = client.post("/api/events", json={**EVENT_DATA2, 'start_time': '2024-10-23T13:00', 'end_time': '2024-10-23T14:00'})
+            
+            self.assertEqual(resp.status_code, 201)
+            
+            resp = client.post("/api/events/batch", json={'create': [{**EVENT_DATA2, 'start_time': '2024-10-23T13:30', 'end_time': '2024-10-23T15:00'}]})
+            
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json['results']['create'][0]['status'], 409)
+            self.assertEqual(Event.query.count(), 2)
+            
+            #items of one batch can't overlap each other either
+            resp = client.post("/api/events/batch", json={'create': [{**EVENT_DATA2, 'start_time': '2024-10-24T12:00', 'end_time': '2024-10-24T13:00'},
+                                                                     {**EVENT_DATA2, 'start_time': '2024-10-24T14:00', 'end_time': '2024-10-24T15:00'},
+                                                                     {**EVENT_DATA2, 'start_time': '2024-10-24T12:30', 'end_time': '2024-10-24T14:30'}]})
+            self.assertEqual([result['status'] for result in resp.json['results']['create']], [201, 201, 409])
+            self.assertEqual(Event.query.count(), 2)
+            
+            #a UTC offset would make tsrange(timestamptz, timestamptz), times are stored without a time zone
+            resp = client.post("/api/events", json={**EVENT_DATA2, 'start_time': '2024-10-23T16:00Z', 'end_time': '2024-10-23T17:00Z'})
+            self.assertEqual(resp.status_code, 400)
+            resp = client.post("/api/events/batch", json={'create': [{**EVENT_DATA2, 'start_time': '2024-10-23T16:00+02:00', 'end_time': '2024-10-23T17:00'}]})
+            self.assertEqual(resp.json['results']['create'][0]['status'], 400)
+            resp = client.get(f"/api/calendars/{self.calendar.id}/conflicts", query_string={'start': '2024-10-23T12:00Z', 'end': '2024-10-23T13:00Z'})
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(Event.query.count(), 2)
+        
+        with self.assertRaises(ValueError):
+            find_conflicts(self.calendar.id, datetime(2024, 10, 23, 12, tzinfo=timezone.utc), datetime(2024, 10, 23, 13, tzinfo=timezone.utc))
+        
+        #a create that starts while another write holds the calendar is checked once that one commits
+        bump_calendar_version(self.calendar.id)
+        statuses = []
+        def other_request():
+            with app.test_client() as client:
+                statuses.append(client.post("/api/events", json={**EVENT_DATA2, 'start_time': '2024-10-25T12:00', 'end_time': '2024-10-25T13:00'}).status_code)
+        thread = threading.Thread(target=other_request)
+        thread.start()
+        thread.join(0.5)
+        db.session.add(Event(**{**EVENT_DATA2, 'start_time': '2024-10-25T12:30', 'end_time': '2024-10-25T13:30'}))
+        db.session.commit()
+        thread.join()
+        self.assertEqual(statuses, [409])
+        self.assertEqual(Event.query.count(), 3)
+            
+            
+    def test_search_events(self): ############ 11
+        '''Test searching the logged in user's events, best match first'''
+        other_user = User(email='user2@email.com', password='password2', f_name='Other', l_name='User')
+        db.session.add(other_user)
+        db.session.commit()
+        other_calendar = Calendar(name='Other', owner_id=other_user.id)
+        db.session.add(other_calendar)
+        db.session.commit()
+        
+        db.session.add_all([
+            Event(**{**EVENT_DATA, 'title': 'Lunch', 'description': 'Before the dentist', 'location': 'Cafe'}),
+            Event(**{**EVENT_DATA, 'title': 'Dentist', 'calendar_id': other_calendar.id, 'creator_id': other_user.id}),
+        ])
+        db.session.commit()
+        
+        with app.test_client() as client:
+            resp = client.get("/api/events/search?q=dentist")
+            
+            self.assertEqual(resp.status_code, 401)
+            
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user.id
+            
+            resp = client.get("/api/events/search?q=dentist")
+            
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([event['title'] for event in resp.json['events']], ['Dentist', 'Lunch']) #title match first, other user's event left out
+            
+            resp = client.get("/api/events/search?q=dentists&limit=1&fields=title")
+            
+            self.assertEqual([event['title'] for event in resp.json['events']], ['Dentist'])
+            self.assertEqual(resp.json['next_offset'], 1)
+            
+            resp = client.get("/api/events/search?q=cafe -lunch")
             
+            self.assertEqual(resp.json['events'], [])
@@ -0,0 +1,96 @@
+# python -m unittest tests_api.test_freebusy_api
+
+from unittest import TestCase
+from app import app
+from models import db, User, Calendar, Event
+from freebusy import merge_intervals
+
+# Use test database and don't clutter tests with SQL
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///calendar-tests'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+db.drop_all()
+db.create_all()
+
+
+class FreeBusyTestCase(TestCase):
+    '''Tests for views of Free/Busy API'''
+
+    def setUp(self):
+        '''Make demo data | two users with a calendar each, both busy on Monday 2024-10-21'''
+        db.drop_all()
+        db.create_all()
+
+        larry = User(email="user1@email.com", password="password1", f_name='Larry', l_name="Davis")
+        jeff = User(email="user2@email.com", password="password2", f_name='Jeff', l_name="Greene")
+        db.session.add_all([larry, jeff])
+        db.session.commit()
+        
+        db.session.add_all([Calendar(name="Personal", owner_id=larry.id), Calendar(name="Work", owner_id=jeff.id)])
+        db.session.commit()
+        
+        db.session.add_all([
+            Event(title="Dentist", start_time='2024-10-21T09:00', end_time='2024-10-21T10:00', calendar_id=1, creator_id=larry.id),
+            Event(title="Standup", start_time='2024-10-21T09:30', end_time='2024-10-21T11:00', calendar_id=2, creator_id=jeff.id),
+            Event(title="Lunch", start_time='2024-10-21T12:00', end_time='2024-10-21T13:00', rrule='FREQ=DAILY', calendar_id=2, creator_id=jeff.id),
+            Event(title="Review", start_time='2024-10-21T13:00', end_time='2024-10-21T16:30', calendar_id=1, creator_id=larry.id),
+        ])
+        db.session.commit()
+
+        self.user_ids = f'{larry.id},{jeff.id}'
+
+    def tearDown(self):
+        '''Clean up unsuccessful tests'''
+        
+        db.session.rollback()
+        db.drop_all()
+
+
+    def test_merge_intervals(self): ############ 01
+        '''Test overlapping and touching intervals are merged'''
+        starts, ends = merge_intervals([1, 2, 5, 8, 8], [3, 4, 8, 9, 10])
+        
+        self.assertEqual(list(starts), [1, 5])
+        self.assertEqual(list(ends), [4, 10])
+
+
+    def test_freebusy(self): ############ 02
+        '''Test the busy times of both users are merged'''
+        with app.test_client() as client:
+            resp = client.get("/api/freebusy", query_string={'users': self.user_ids, 'start': '2024-10-21', 'end': '2024-10-22'})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['busy'], [
+                {'start': '2024-10-21T09:00', 'end': '2024-10-21T11:00'},
+                {'start': '2024-10-21T12:00', 'end': '2024-10-21T16:30'},
+            ])
+
+
+    def test_free_slots(self): ############ 03
+        '''Test finding slots where everyone is free during working hours'''
+        with app.test_client() as client:
+            resp = client.get("/api/freebusy/slots", query_string={'users': self.user_ids, 'start': '2024-10-21', 'end': '2024-10-22', 'duration': 30})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['slots'], [
+                {'start': '2024-10-21T11:00', 'end': '2024-10-21T12:00'},
+                {'start': '2024-10-21T16:30', 'end': '2024-10-21T17:00'},
+            ])
+            
+            #the weekend is skipped and the daily lunch still counts
+            resp = client.get("/api/freebusy/slots", query_string={'users': self.user_ids, 'start': '2024-10-25T14:00', 'end': '2024-10-29', 'duration': 120, 'limit': 2})
+            self.assertEqual(resp.json['slots'], [
+                {'start': '2024-10-25T14:00', 'end': '2024-10-25T17:00'},
+                {'start': '2024-10-28T09:00', 'end': '2024-10-28T12:00'},
+            ])
+            
+            resp = client.get("/api/freebusy/slots", query_string={'users': self.user_ids, 'start': '2024-10-21'})
+            self.assertEqual(resp.status_code, 400)
+            
+            for start, end in [('2024-10-21T00:00Z', '2024-10-22T00:00Z'), ('2024-10-21T00:00+02:00', '2024-10-22')]:
+                for route in ['/api/freebusy', '/api/freebusy/slots']:
+                    resp = client.get(route, query_string={'users': self.user_ids, 'start': start, 'end': end, 'duration': 30})
+                    self.assertEqual(resp.status_code, 400) #compared to naive event times, they would be a TypeError
@@ -0,0 +1,138 @@
+# python -m unittest tests_api.test_invalidation
+
+from unittest import TestCase
+import json
+import multiprocessing
+import os
+import select
+import time
+from app import app
+from models import db, User, Calendar, mark_stale, process_origin, INVALIDATION_CHANNEL
+from response_cache import get_cache
+from user_cache import get_user, clear_users
+from invalidation import receive_invalidation
+import user_cache
+
+# Use test database and don't clutter tests with SQL
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///calendar-tests'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+db.drop_all()
+db.create_all()
+
+WORKERS = 3
+TIMEOUT = 10 #seconds to wait on the worker processes
+EVENTS_KEY = '/api/calendars/1/events?' #response_cache key of the calendar's events
+
+
+def cache_worker(ready, reports):
+    '''A stand-in gunicorn worker, forked from the test process | warms its response and user caches,
+    then reports which of them a write made in the test process emptied'''
+    with app.app_context():
+        db.engine.dispose(close=False) #the pooled connections belong to the test process
+
+    with app.test_client() as client:
+        client.get("/api/calendars/1/events") #the first request also starts this worker's listener
+    with app.app_context():
+        get_user(1)
+        cache = get_cache()
+        warmed = cache.get(EVENTS_KEY) is not None and 1 in user_cache._users
+    ready.put(os.getpid())
+
+    deadline = time.monotonic() + TIMEOUT
+    while time.monotonic() < deadline:
+        response_evicted = cache.get(EVENTS_KEY) is None
+        user_evicted = 1 not in user_cache._users
+        if response_evicted and user_evicted:
+            break
+        time.sleep(0.02)
+    reports.put({'pid': os.getpid(), 'warmed': warmed, 'response_evicted': response_evicted, 'user_evicted': user_evicted})
+
+
+class InvalidationTestCase(TestCase):
+    '''Tests for the cross-worker cache invalidation bus'''
+
+    def setUp(self):
+        '''Make demo data'''
+        db.drop_all()
+        db.create_all()
+
+        db.session.add(User(email="user1@email.com", password="password1", f_name='Larry', l_name="Davis"))
+        db.session.commit()
+        db.session.add(Calendar(name="Personal", owner_id=1))
+        db.session.commit()
+        db.session.expunge_all()
+        get_cache().clear()
+        clear_users()
+
+    def tearDown(self):
+        '''Clean up unsuccessful tests'''
+
+        db.session.rollback()
+        db.session.expunge_all()
+        get_cache().clear()
+        clear_users()
+        db.drop_all()
+
+
+    def test_invalidation_across_workers(self): ############ 01
+        '''Test a write in one process empties the response and user caches of every other worker'''
+        context = multiprocessing.get_context('fork')
+        ready, reports = context.Queue(), context.Queue()
+        workers = [context.Process(target=cache_worker, args=(ready, reports)) for n in range(WORKERS)]
+        for worker in workers:
+            worker.start()
+
+        try:
+            pids = {ready.get(timeout=TIMEOUT) for worker in workers}
+            with app.test_client() as client:
+                resp = client.patch("/api/calendars/1", json={'name': 'Renamed'}) #calendar:1 and its owner, user:1
+                self.assertEqual(resp.status_code, 200)
+            results = [reports.get(timeout=TIMEOUT) for worker in workers]
+        finally:
+            for worker in workers:
+                worker.join(TIMEOUT)
+
+        self.assertEqual({result.pop('pid') for result in results}, pids)
+        self.assertEqual(results, [{'warmed': True, 'response_evicted': True, 'user_evicted': True}] * WORKERS)
+
+
+    def test_invalidation_messages(self): ############ 02
+        '''Test only committed writes are published, tags must be typed and a worker skips its own messages'''
+        with app.app_context():
+            listen = db.engine.raw_connection()
+        try:
+            listen.driver_connection.autocommit = True
+            listen.cursor().execute(f'LISTEN {INVALIDATION_CHANNEL}')
+
+            def published():
+                select.select([listen.driver_connection], [], [], 1)
+                listen.driver_connection.poll()
+                messages = [json.loads(notify.payload) for notify in listen.driver_connection.notifies]
+                listen.driver_connection.notifies.clear()
+                return messages
+
+            calendar = db.session.get(Calendar, 1)
+            calendar.name = "Rolled back"
+            db.session.flush()
+            db.session.rollback()
+            self.assertEqual(published(), [])
+
+            calendar.name = "Committed"
+            db.session.commit()
+            self.assertEqual(published(), [{'origin': process_origin(), 'tags': ['calendar:1', 'user:1']}])
+        finally:
+            listen.close()
+
+        with self.assertRaises(ValueError):
+            mark_stale('calendars:1')
+        db.session.rollback()
+
+        get_user(1)
+        receive_invalidation(json.dumps({'origin': process_origin(), 'tags': ['user:1']}))
+        self.assertIn(1, user_cache._users) #evicted on commit already
+        receive_invalidation(json.dumps({'origin': 'other-host:1', 'tags': ['user:1']}))
+        self.assertNotIn(1, user_cache._users)
@@ -0,0 +1,160 @@
+# python -m unittest tests_api.test_job_api
+
+from unittest import TestCase
+from app import app
+from models import db, Job
+from jobs import job, enqueue, claim_job, work
+from sqlalchemy import func, update
+
+# Use test database and don't clutter tests with SQL
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///calendar-tests'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+db.drop_all()
+db.create_all()
+
+CALLS = [] #(kind, args) of every test job run
+
+
+@job('test_add')
+def add(a, b):
+    CALLS.append(('test_add', (a, b)))
+    return a + b
+
+
+@job('test_flaky')
+def flaky(fail_times):
+    '''Fails the first fail_times runs'''
+    CALLS.append(('test_flaky', fail_times))
+    if len([call for call in CALLS if call[0] == 'test_flaky']) <= fail_times:
+        raise RuntimeError('Not yet')
+
+
+class JobTestCase(TestCase):
+    '''Tests for the job queue and views of Job API'''
+
+    def setUp(self):
+        '''Start with an empty queue'''
+        db.drop_all()
+        db.create_all()
+        CALLS.clear()
+
+    def tearDown(self):
+        '''Clean up unsuccessful tests'''
+
+        db.session.rollback()
+        db.session.expunge_all()
+        db.drop_all()
+
+    def make_due(self):
+        '''Skip the retry delays'''
+        db.session.execute(update(Job).values(run_at=func.now()))
+        db.session.commit()
+
+
+    def test_job_status(self): ############ 01
+        '''Test a job only exists once enqueued and committed, and its status through the API'''
+        queued = enqueue('test_add', a=2, b=3)
+        db.session.rollback()
+        self.assertEqual(work(burst=True), 0)
+
+        queued = enqueue('test_add', a=2, b=3)
+        db.session.commit()
+        job_id = queued.id
+
+        with app.test_client() as client:
+            resp = client.get(f"/api/jobs/{job_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['job']['status'], 'queued')
+            self.assertEqual(resp.json['job']['args'], {'a': 2, 'b': 3})
+
+            self.assertEqual(work(burst=True), 1)
+
+            resp = client.get(f"/api/jobs/{job_id}")
+            self.assertEqual(resp.json['job']['status'], 'done')
+            self.assertEqual(resp.json['job']['result'], 5)
+            self.assertEqual(resp.json['job']['attempts'], 1)
+
+            resp = client.get("/api/jobs", query_string={'status': 'done'})
+            self.assertEqual([job['id'] for job in resp.json['jobs']], [job_id])
+            self.assertEqual(client.get("/api/jobs", query_string={'status': 'queued'}).json['jobs'], [])
+            self.assertEqual(client.get("/api/jobs", query_string={'status': 'nope'}).status_code, 400)
+            self.assertEqual(client.get("/api/jobs/999").status_code, 404)
+
+        with self.assertRaises(ValueError):
+            enqueue('not_a_job')
+
+
+    def test_job_retries(self): ############ 02
+        '''Test a failing job is retried later, not right away, and works once it stops failing'''
+        queued = enqueue('test_flaky', fail_times=2)
+        db.session.commit()
+        job_id = queued.id
+
+        self.assertEqual(work(burst=True), 1)
+        failed_once = db.session.get(Job, job_id)
+        self.assertEqual(failed_once.status, 'queued')
+        self.assertEqual(failed_once.attempts, 1)
+        self.assertIn('Not yet', failed_once.error)
+        self.assertEqual(work(burst=True), 0) #backing off
+
+        self.make_due()
+        work(burst=True)
+        self.make_due()
+        work(burst=True)
+
+        done = db.session.get(Job, job_id)
+        self.assertEqual(done.status, 'done')
+        self.assertEqual(done.attempts, 3)
+        self.assertEqual(len(CALLS), 3)
+
+
+    def test_job_gives_up(self): ############ 03
+        '''Test a job is failed after max_attempts and can be queued again through the API'''
+        queued = enqueue('test_flaky', fail_times=10)
+        queued.max_attempts = 2
+        db.session.commit()
+        job_id = queued.id
+
+        work(burst=True)
+        self.make_due()
+        work(burst=True)
+
+        with app.test_client() as client:
+            resp = client.get(f"/api/jobs/{job_id}")
+            self.assertEqual(resp.json['job']['status'], 'failed')
+            self.assertEqual(resp.json['job']['attempts'], 2)
+
+            resp = client.post(f"/api/jobs/{job_id}/retry")
+            self.assertEqual(resp.status_code, 202)
+            self.assertEqual(resp.json['job']['status'], 'queued')
+            self.assertEqual(work(burst=True), 1)
+
+            self.assertEqual(client.post(f"/api/jobs/{job_id}/retry").status_code, 409) #queued again, not failed
+        self.assertEqual(len(CALLS), 3)
+
+
+    def test_claim_skip_locked(self): ############ 04
+        '''Test a worker skips a job another worker holds and takes over one whose worker's lease ran out'''
+        first = enqueue('test_add', a=1, b=1)
+        db.session.flush()
+        second = enqueue('test_add', a=2, b=2)
+        db.session.commit()
+        first_id, second_id = first.id, second.id
+
+        with db.engine.connect() as other_worker:
+            other_worker.execute(db.select(Job).where(Job.id == first_id).with_for_update())
+            self.assertEqual(claim_job().id, second_id)
+            self.assertIsNone(claim_job())
+            other_worker.rollback()
+
+        self.assertEqual(claim_job().id, first_id)
+        self.assertIsNone(claim_job()) #both are running, with a lease
+
+        db.session.execute(update(Job).where(Job.id == first_id).values(run_at=func.now())) #its worker died
+        db.session.commit()
+        self.assertEqual(work(burst=True), 1)
+        self.assertEqual(db.session.get(Job, first_id).attempts, 2)
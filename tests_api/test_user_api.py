@@ -2,8 +2,14 @@
 
 from unittest import TestCase
 from app import app
-from models import db, User
+from models import db, User, Calendar, Event
 from datetime import datetime, timezone
+from io import BytesIO, TextIOWrapper
+from user_cache import clear_users
+import csv
+import json
+import zipfile
+import export
 
 # Use test database and don't clutter tests with SQL
 app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///calendar-tests'
@@ -47,6 +53,8 @@ class UserTestCase(TestCase):
         '''Clean up unsuccessful tests'''
         
         db.session.rollback()
+        db.session.expunge_all()
+        clear_users()
         db.drop_all()
 
 
@@ -128,3 +136,56 @@ class UserTestCase(TestCase):
             deleted_user = User.query.get(self.user.id)
             self.assertIsNone(deleted_user)
             
+
+
+    def test_export_user(self): ############ 06
+        '''Test exporting an account as NDJSON and zipped CSV, including events made in someone else's calendar'''
+        app.config['SECRET_KEY'] = 'testing'
+        other = User(**USER_DATA2)
+        db.session.add(other)
+        db.session.commit()
+        mine = Calendar(name="Personal", owner_id=self.user.id)
+        theirs = Calendar(name="Team", owner_id=other.id)
+        db.session.add_all([mine, theirs])
+        db.session.commit()
+        db.session.add_all([Event(title=f"Event {n}", start_time='2024-10-23T12:00', end_time='2024-10-23T13:00',
+                                  calendar_id=mine.id, creator_id=self.user.id) for n in range(7)])
+        db.session.add_all([Event(title="Guest", start_time='2024-10-24T12:00', end_time='2024-10-24T13:00', calendar_id=theirs.id, creator_id=self.user.id),
+                            Event(title="Not mine", start_time='2024-10-24T12:00', end_time='2024-10-24T13:00', calendar_id=theirs.id, creator_id=other.id)])
+        db.session.commit()
+        user_id = self.user.id
+        
+        with app.test_client() as client:
+            url = f"/api/users/{user_id}/export"
+            self.assertEqual(client.get(url).status_code, 401)
+            with client.session_transaction() as session:
+                session['curr_user'] = other.id
+            self.assertEqual(client.get(url).status_code, 403)
+            with client.session_transaction() as session:
+                session['curr_user'] = user_id
+            
+            export.EXPORT_BATCH_SIZE = 3 #several chunks per section
+            try:
+                resp = client.get(url)
+                self.assertEqual(resp.status_code, 200)
+                self.assertTrue(resp.is_streamed)
+                self.assertIn('attachment', resp.headers['Content-Disposition'])
+                lines = [json.loads(line) for line in resp.data.decode().splitlines()]
+                self.assertEqual([line['type'] for line in lines], ['user', 'calendar'] + ['event'] * 8)
+                self.assertEqual(lines[0]['email'], USER_DATA['email'])
+                self.assertNotIn('password', lines[0])
+                self.assertEqual(lines[-1]['title'], 'Guest')
+                
+                resp = client.get(url, query_string={'format': 'csv'})
+                self.assertEqual(resp.mimetype, 'application/zip')
+                with zipfile.ZipFile(BytesIO(resp.data)) as bundle:
+                    self.assertEqual(bundle.namelist(), ['user.csv', 'calendars.csv', 'events.csv'])
+                    events = list(csv.DictReader(TextIOWrapper(bundle.open('events.csv'), encoding='utf-8')))
+                    calendars = list(csv.DictReader(TextIOWrapper(bundle.open('calendars.csv'), encoding='utf-8')))
+                self.assertEqual(len(events), 8)
+                self.assertEqual(events[0]['start_time'], '2024-10-23T12:00')
+                self.assertEqual([calendar['name'] for calendar in calendars], ['Personal'])
+            finally:
+                export.EXPORT_BATCH_SIZE = 1000
+            
+            self.assertEqual(client.get(url, query_string={'format': 'xml'}).status_code, 400)
@@ -1,9 +1,11 @@
 # python -m unittest tests_event.test_event_model
 
 import os
+from datetime import datetime
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
-from models import db, User, Event, Calendar
+from models import db, User, Event, Calendar, find_conflicts
+from recurrence import series_end, occurrences, MAX_WINDOW_OCCURRENCES
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -22,6 +24,18 @@ from app import app
 db.create_all()
 
 
+def query_plan(query):
+    '''EXPLAIN output for an ORM query, as one string | seq scans are turned off so the plan shows if an index *can* be used
+    | the test tables are tiny, so the planner would scan them whatever the indexes are'''
+    
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    connection = db.session.connection()
+    connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+    plan = connection.exec_driver_sql('EXPLAIN ' + str(compiled), compiled.params).scalars().all()
+    db.session.rollback()
+    return '\n'.join(plan)
+
+
 class EventModelTestCase(TestCase):
     '''Test Events'''
 
@@ -136,3 +150,86 @@ class EventModelTestCase(TestCase):
         db.session.commit()
 
         self.assertTrue(event.all_day)
+        
+    def test_event_feed_query(self): ############## 06
+        '''Test the fast feed rows serialize exactly like Event.serialize()'''
+        
+        events = [
+            Event(title="Dentist", description="Teeth Cleaning", start_time='2024-12-12T09:05', end_time='2024-12-12T10:30',
+                  location='Family Dentist', calendar_id=self.c_id, creator_id=self.u_id),
+            Event(title="Conference", start_time='2024-12-13', end_time='2024-12-14', all_day=True,
+                  calendar_id=self.c_id, creator_id=self.u_id),
+        ]
+        db.session.add_all(events)
+        db.session.commit()
+        
+        rows = Event.feed_query().order_by(Event.id).all()
+        
+        self.assertEqual(app.json.dumps([row._asdict() for row in rows]),
+                         app.json.dumps([event.serialize() for event in events]))
+        
+    def test_event_series_end(self): ############## 07
+        '''Test recurring events keep track of when the series ends'''
+        
+        event = Event(
+            title="Class",
+            start_time='2024-12-02T18:00',
+            end_time='2024-12-02T20:00',
+            rrule='FREQ=WEEKLY;COUNT=4',
+            calendar_id=self.c_id,
+            creator_id=self.u_id
+        )
+        db.session.add(event)
+        db.session.commit()
+        
+        self.assertEqual(event.series_end.isoformat(), '2024-12-23T20:00:00')
+        
+        event.rrule = 'FREQ=WEEKLY'
+        db.session.commit()
+        
+        self.assertIsNone(event.series_end)
+        
+        with self.assertRaises(ValueError, msg="Invalid recurrence rule"):
+            event.rrule = 'FREQ=SOMETIMES'
+        
+        #rules that would be expensive to expand
+        for rrule in ['FREQ=SECONDLY;COUNT=100000000', 'FREQ=MINUTELY;UNTIL=21000101T000000', 'FREQ=DAILY;BYHOUR=9,10,11',
+                      'FREQ=DAILY;COUNT=1001', 'FREQ=DAILY;UNTIL=20450101T000000']:
+            with self.assertRaises(ValueError):
+                event.rrule = rrule
+        event.rrule = 'FREQ=WEEKLY;UNTIL=20441101T000000'
+        db.session.commit()
+        self.assertEqual(event.series_end.isoformat(), '2044-10-31T20:00:00')
+        
+        #rules stored before the limits don't get walked to the end
+        self.assertIsNone(series_end('FREQ=MINUTELY;COUNT=100000000', datetime(2024, 12, 2, 18), datetime(2024, 12, 2, 19)))
+        minutely = occurrences('FREQ=MINUTELY', datetime(2024, 12, 2, 18), datetime(2024, 12, 2, 19), datetime(2024, 12, 2), datetime(2025, 12, 2))
+        self.assertEqual(len(list(minutely)), MAX_WINDOW_OCCURRENCES)
+            
+    def test_event_find_conflicts(self): ############## 08
+        '''Test finding the events a time overlaps, single and recurring'''
+        
+        dentist = Event(title="Dentist", start_time='2024-12-12T09:00', end_time='2024-12-12T10:00', calendar_id=self.c_id, creator_id=self.u_id)
+        standup = Event(title="Standup", start_time='2024-12-02T11:00', end_time='2024-12-02T11:15', rrule='FREQ=DAILY',
+                        calendar_id=self.c_id, creator_id=self.u_id)
+        db.session.add_all([dentist, standup])
+        db.session.commit()
+        
+        self.assertEqual(find_conflicts(self.c_id, '2024-12-12T09:30', '2024-12-12T11:05'), [dentist, standup])
+        self.assertEqual(find_conflicts(self.c_id, '2024-12-12T10:00', '2024-12-12T11:00'), []) #back to back
+        self.assertEqual(find_conflicts(self.c_id, '2024-12-12T09:30', '2024-12-12T09:45', exclude_id=dentist.id), [])
+        self.assertEqual(find_conflicts(self.c_id + 1, '2024-12-12T09:30', '2024-12-12T09:45'), [])
+        
+    def test_event_hot_query_indexes(self): ############## 09
+        '''Test the hottest queries (user_home, event_new, get_calendar_events) are planned with their indexes'''
+        
+        now = datetime(2024, 12, 1)
+        upcoming = Event.query.filter(Event.creator_id == self.u_id, Event.start_time >= now).order_by(Event.start_time).limit(5)
+        calendars = Calendar.query.filter(Calendar.owner_id == self.u_id)
+        feed = (Event.feed_query().filter(Event.calendar_id == self.c_id, Event.rrule.is_(None), Event.start_time < now, Event.end_time >= now)
+                .order_by(Event.start_time))
+        
+        for query, index in [(upcoming, 'ix_events_creator_start'), (calendars, 'ix_calendars_owner_id'), (feed, 'ix_events_calendar_time')]:
+            plan = query_plan(query)
+            self.assertIn(index, plan)
+            self.assertNotIn('Seq Scan', plan)
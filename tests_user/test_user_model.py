@@ -1,10 +1,16 @@
 # python -m unittest tests_user.test_user_model
 
 import os
+import threading
 from unittest import TestCase
 from sqlalchemy import exc
 from sqlalchemy.exc import IntegrityError
-from models import db, User, Event, Calendar
+from sqlalchemy import event
+from models import db, User, Event, Calendar, EventTombstone, remove_user
+from user_cache import get_user, forget_user, clear_users
+from passwords import hash_rounds, HashingBusy
+import passwords
+from query_stats import assert_max_queries
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -15,7 +21,7 @@ os.environ['DATABASE_URL'] = "postgresql:///calendar-tests"
 
 # Now we can import app
 
-from app import app
+from app import app, CURR_USER_KEY
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -100,4 +106,152 @@ class UserModelTestCase(TestCase):
         
         deleted_user = User.query.get(user.id)
         self.assertIsNone(deleted_user)
-            
\ No newline at end of file
+            
+        
+    def test_user_cache(self): ############## 06
+        '''Test the cached current user skips the DB until it is forgotten'''
+        
+        clear_users()
+        user = User.register("cache@email.com", "testing123", 'Test', 'Ing')
+        user.id = self.u_id
+        db.session.add_all([user, Calendar(name="Cached Calendar", owner_id=self.u_id)])
+        db.session.commit()
+        db.session.expunge_all()
+        
+        queries = []
+        count_query = lambda *args: queries.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', count_query)
+        try:
+            self.assertEqual([calendar.name for calendar in get_user(self.u_id).calendars], ["Cached Calendar"])
+            self.assertEqual(len(queries), 1) #user and calendars in one query
+            
+            db.session.expunge_all() #like a new request
+            self.assertEqual(get_user(self.u_id).calendars[0].name, "Cached Calendar")
+            self.assertEqual(len(queries), 1) #no query at all
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_query)
+        
+        db.session.execute(db.update(Calendar).values(name="Renamed"))
+        db.session.commit()
+        forget_user(self.u_id)
+        db.session.expunge_all()
+        
+        self.assertEqual(get_user(self.u_id).calendars[0].name, "Renamed")
+        self.assertIsNone(get_user(999))
+        clear_users()
+        
+    def test_user_rehash_on_login(self): ############## 07
+        '''Test a password hashed with an old work factor is rehashed on login, and the hashing cap works'''
+        
+        rounds, workers = app.config['BCRYPT_LOG_ROUNDS'], app.config['PASSWORD_HASH_WORKERS']
+        try:
+            app.config['BCRYPT_LOG_ROUNDS'] = 4
+            user = User.register("rehash@email.com", "testing123", 'Test', 'Ing')
+            db.session.add(user)
+            db.session.commit()
+            self.assertEqual(hash_rounds(user.password), 4)
+            
+            app.config['BCRYPT_LOG_ROUNDS'] = 5
+            app.config['PASSWORD_HASH_WORKERS'] = 2
+            self.assertFalse(User.authenticate("rehash@email.com", "wrong"))
+            self.assertEqual(hash_rounds(user.password), 4) #no rehash without the right password
+            
+            self.assertEqual(User.authenticate("rehash@email.com", "testing123"), user)
+            self.assertEqual(hash_rounds(user.password), 5)
+            self.assertTrue(User.authenticate("rehash@email.com", "testing123"))
+            
+            slots = passwords._slots[1]
+            taken = 0
+            while slots.acquire(blocking=False): #every hashing slot busy
+                taken += 1
+            try:
+                with self.assertRaises(HashingBusy): #shed, not queued behind the others
+                    User.authenticate("rehash@email.com", "testing123")
+                with app.test_request_context('/login', method='POST'):
+                    resp = app.make_response(app.handle_user_exception(HashingBusy()))
+                self.assertEqual((resp.status_code, resp.headers['Retry-After']), (503, '1'))
+            finally:
+                for n in range(taken):
+                    slots.release()
+            
+            app.config['PASSWORD_HASH_WORKERS'] = 1
+            self.assertTrue(User.authenticate("rehash@email.com", "testing123"))
+            self.assertEqual(passwords._slots[0], (1, app.config['PASSWORD_HASH_QUEUE'])) #rebuilt for the new setting
+            self.assertIsNot(passwords._slots[1], slots)
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'], app.config['PASSWORD_HASH_WORKERS'] = rounds, workers
+        
+    def test_user_home_queries(self): ############## 08
+        '''Test user_home doesn't run a query per calendar (N+1) and reports its SQL in Server-Timing'''
+        
+        clear_users()
+        app.config['SECRET_KEY'] = 'testing'
+        user = User.register("home@email.com", "testing123", 'Test', 'Ing')
+        user.id = self.u_id
+        db.session.add(user)
+        db.session.add_all([Calendar(name=f"Calendar {n}", owner_id=self.u_id) for n in range(5)])
+        db.session.commit()
+        db.session.expunge_all()
+        
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u_id
+            
+            with assert_max_queries(2): #user with calendars, upcoming events
+                resp = client.get(f"/user/{self.u_id}")
+            
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('desc="2 queries"', resp.headers['Server-Timing'])
+            
+            db.session.expunge_all()
+            with assert_max_queries(1): #cached user, only the upcoming events
+                client.get(f"/user/{self.u_id}")
+            
+            with self.assertRaises(AssertionError):
+                with assert_max_queries(0):
+                    client.get(f"/user/{self.u_id}")
+            
+            def other_thread():
+                with app.app_context():
+                    db.session.execute(db.text('SELECT 1'))
+                    db.session.remove()
+            with assert_max_queries(0): #another thread's statements (the listener, the stream hub) aren't this block's
+                thread = threading.Thread(target=other_thread)
+                thread.start()
+                thread.join()
+        
+        db.session.expunge_all()
+        clear_users()
+    
+    
+    def test_remove_user(self): ############## 09
+        '''Test deleting a user takes their calendars and events with it in a fixed number of statements
+        and leaves tombstones for their events in other users' calendars'''
+        
+        user = User.register("leaving@email.com", "testing123", 'Test', 'Ing')
+        user.id = self.u_id
+        other = User.register("staying@email.com", "testing123", 'Other', 'User')
+        db.session.add_all([user, other])
+        db.session.flush()
+        mine = Calendar(name="Mine", owner_id=user.id)
+        theirs = Calendar(name="Theirs", owner_id=other.id)
+        db.session.add_all([mine, theirs])
+        db.session.flush()
+        db.session.add_all([Event(title=f"Event {n}", start_time=f'2024-10-{n + 1:02}T12:00', end_time=f'2024-10-{n + 1:02}T13:00',
+                                  calendar_id=mine.id, creator_id=user.id) for n in range(20)])
+        guest = Event(title="Guest", start_time='2024-10-23T12:00', end_time='2024-10-23T13:00', calendar_id=theirs.id, creator_id=user.id)
+        host = Event(title="Host", start_time='2024-10-23T14:00', end_time='2024-10-23T15:00', calendar_id=theirs.id, creator_id=other.id)
+        db.session.add_all([guest, host])
+        db.session.commit()
+        guest_id, theirs_id, version = guest.id, theirs.id, theirs.version
+        db.session.expunge_all()
+        
+        with assert_max_queries(5): #own calendars, version bump of the other calendars (locked before their tombstones), tombstones, delete
+            remove_user(self.u_id)
+        db.session.commit()
+        
+        self.assertIsNone(User.query.get(self.u_id))
+        self.assertEqual(Calendar.query.count(), 1)
+        self.assertEqual([event.title for event in Event.query.all()], ['Host'])
+        self.assertEqual([(tombstone.event_id, tombstone.calendar_id) for tombstone in EventTombstone.query.all()], [(guest_id, theirs_id)])
+        self.assertEqual(Calendar.query.get(theirs_id).version, version + 1)
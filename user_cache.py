@@ -0,0 +1,63 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+from sqlalchemy.orm import joinedload
+from models import db, User
+from invalidation import invalidates
+
+USER_CACHE_SIZE = 1024 #most logged in users kept in memory per process
+USER_CACHE_TTL = 60 #seconds before a cached user is loaded again, in case an invalidation from another process was missed
+
+_users = OrderedDict() #user_id -> (loaded_at, detached User with its calendars loaded) | least recently used first
+_lock = Lock()
+
+
+def get_user(user_id):
+    '''The user with their calendars preloaded, attached to the current session | None if they don't exist
+    | cached users are merged in with load=False so there is no query at all, misses load the user and calendars in one query'''
+
+    with _lock:
+        cached = _users.get(user_id)
+        if cached and time.monotonic() - cached[0] < USER_CACHE_TTL:
+            _users.move_to_end(user_id)
+            return db.session.merge(cached[1], load=False)
+
+    user = db.session.get(User, user_id, options=[joinedload(User.calendars)], populate_existing=True)
+    if user is None:
+        forget_user(user_id)
+        return None
+
+    #a detached copy goes in the cache so later requests (and sessions) never share the same instance
+    db.session.expunge(user)
+    with _lock:
+        _users[user_id] = (time.monotonic(), user)
+        _users.move_to_end(user_id)
+        if len(_users) > USER_CACHE_SIZE:
+            _users.popitem(last=False)
+
+    return db.session.merge(user, load=False)
+
+
+def forget_user(*user_ids):
+    '''Drop users from this process's cache | writes don't call it, they mark 'user:<id>' stale and every worker drops it'''
+
+    with _lock:
+        for user_id in user_ids:
+            _users.pop(user_id, None)
+
+
+def clear_users():
+    '''Empty the whole cache (tests, or after bulk changes to users)'''
+
+    with _lock:
+        _users.clear()
+
+
+@invalidates('user')
+def drop_stale_users(tags, remote):
+    '''Forget users whose 'user:<id>' tag went stale (invalidation.py), in this worker or another'''
+
+    if tags is None:
+        clear_users()
+    else:
+        forget_user(*[int(tag.partition(':')[2]) for tag in tags])